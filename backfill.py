@@ -0,0 +1,304 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import sys
+import time
+
+from optparse import OptionParser
+
+from config import Config
+from constants import LogEvents
+from build_data import BuildData
+from build_steps import BuildSteps
+from build_index import BUILD_ID_REGEX, BUILD_NUMBER_REGEX
+from delta_generator import DeltaGenerator, EXIT_CODE_REGEX
+from log_manager import LogManager
+from log_pipeline import build_pipeline, OUTPUT_MARKER
+from line_classifier import LineClassifier
+from warning_diff import DIFF_ENGINES
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: backfill.py                                                    #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module mines every build of a project/configuration that  #
+#          is still held in the TeamCity logs, in a single pass over      #
+#          them, and loads the results into the cache (e.g., after        #
+#          --reset-cache, or for a configuration new to the Watcher).     #
+#                                                                         #
+# Example (on the Build Agent host):                                      #
+#                                                                         #
+#     cd build_system/warning_watcher                                     #
+#     python backfill.py --first 120 -- -b 140 -p "Project" \             #
+#        -c "Config" -B "main" -a "agent"                                 #
+#                                                                         #
+# Everything after '--' is a warning_watcher.py command line: '-b' is the #
+# newest build mined, and --build-step, --all-steps, --reset-cache and    #
+# the cache options apply as they do to a step.                           #
+#-------------------------------------------------------------------------#
+
+class Backfill(DeltaGenerator):
+    """
+    Collects the builds numbered 'first_build' (the oldest in the logs, if
+    None) to config.teamcity.build_number, reporting the changes each made
+    to the warnings of the one before it.  Each build is what a step run
+    at the end of it would have seen: the last successful step with
+    warnings (or the --build-step step, or every step with --all-steps).
+
+    A cache file holds a single baseline, so only the newest build goes
+    into one; the SQLite cache is given all of them (as many as it keeps),
+    in a single transaction.  Builds no newer than the cached one are
+    left out.
+    """
+    def __init__(self, config, log_manager, first_build=None):
+        super(Backfill, self).__init__(config, log_manager)
+
+        self.first_build = first_build
+
+        # the builds collected, oldest first (BuildSteps with --all-steps)
+        self.mined = []
+
+        # the build being collected
+        self.mining_number = None
+        self.mining_build = None
+        self.mining_steps = None
+
+    def _process_event(self, event, log_line):
+        if event == LogEvents.BUILD_START:
+            # whatever step was being collected is over
+            self.current_step = None
+
+            result = BUILD_ID_REGEX.search(log_line)
+            if not result:
+                return False
+            build_name = result.group(1)
+            if not build_name.startswith('%s::%s' % (self.config.teamcity.project_name,
+                                                     self.config.teamcity.config_name)):
+                return False
+            result = BUILD_NUMBER_REGEX.search(build_name)
+            if not result:
+                return False
+
+            build_prefix, build_number = result.groups()
+            build_number = int(build_number)
+            if build_number > self.config.teamcity.build_number:
+                # every build asked for is behind us
+                return True
+            if (self.first_build is not None) and (build_number < self.first_build):
+                return False
+
+            if build_number != self.mining_number:
+                self._finish_build()
+                self.mining_number = build_number
+                self.mining_steps = BuildSteps()
+                self.build_step_count = 0
+
+            self.build_step_count += 1
+            if (self.config.teamcity.build_step == 0) or \
+               (self.build_step_count == self.config.teamcity.build_step):
+                self.current_step = BuildData()
+                self.current_step.id = build_name
+                self.current_step.prefix = build_prefix
+                self.current_step.number = build_number
+
+        elif event == LogEvents.BUILD_END:
+            # the step must end successfully to count
+            result = EXIT_CODE_REGEX.search(log_line)
+            if (self.current_step is not None) and (result.group(1) == '0'):
+                if self.config.all_steps:
+                    self.mining_steps.builds[self.build_step_count] = self.current_step
+                elif (self.config.teamcity.build_step != 0) or len(self.current_step.warnings):
+                    self.mining_build = self.current_step
+            self.current_step = None
+
+        elif event == LogEvents.WARNING:
+            line, _ = log_line
+            self.current_step.warnings.append(line)
+
+        return False
+
+    def _finish_build(self):
+        if self.config.all_steps:
+            if (self.mining_steps is not None) and len(self.mining_steps.builds):
+                self.mined.append(self.mining_steps)
+        elif self.mining_build is not None:
+            self.mined.append(self.mining_build)
+
+        self.mining_number = None
+        self.mining_build = None
+        self.mining_steps = None
+
+    def run(self):
+        current_log = self.log_manager.get_oldest()
+        if not current_log:
+            print 'Warning: Failed to locate TeamCity logs'
+            print '    - Is the Builder running?'
+            print '    - Is the configured path correct? (%s)' \
+                % self.config.teamcity.build_agent_log_path
+            return 1
+
+        with self.timer.phase('cacheRead'):
+            self._restore_state()
+
+        start_offset = 0
+        if self.build_index and (self.first_build is not None):
+            # skip straight to the first build, if we know where it is
+            with self.timer.phase('index'):
+                self.build_index.update()
+                located = self.build_index.locate('%s::%s' % \
+                                                  (self.config.teamcity.project_name,
+                                                   self.config.teamcity.config_name),
+                                                  self.first_build)
+            if located is not None:
+                current_log, start_offset = located
+
+        # the one pass over the logs.  (a parallel scan only classifies the
+        # output of a single build, so the logs are read in this process.)
+        self.classifier = LineClassifier.create(self.config.teamcity)
+        scan_start = time.time()
+
+        markers = (self.build_start, self.build_end, OUTPUT_MARKER)
+        collecting = lambda: self.current_step is not None
+        events = build_pipeline(self.config,
+                                self.classifier,
+                                self.log_manager,
+                                current_log,
+                                start_offset,
+                                markers,
+                                collecting)
+        with self.timer.phase('scan'):
+            for event, payload in events:
+                if self._process_event(event, payload):
+                    break
+            self._finish_build()
+
+        if self.config.debug_mode:
+            self.classifier.report(time.time() - scan_start)
+
+        if not len(self.mined):
+            print 'Warning: Failed to locate any builds to backfill in the TeamCity logs'
+            print '    - Are the logs too short?'
+            print '    - Did the builds complete successfully?'
+            return 1
+
+        if self.cached_build is not None:
+            newer = [build for build in self.mined if build.number > self.cached_build.number]
+            if len(newer) != len(self.mined):
+                print 'Builds up to #%d are already cached; %d mined build%s left out.' % \
+                    (self.cached_build.number,
+                     len(self.mined) - len(newer),
+                     's were' if len(self.mined) - len(newer) != 1 else ' was')
+            self.mined = newer
+            if not len(self.mined):
+                print 'Nothing to backfill.'
+                return 0
+
+        self._report_deltas()
+
+        with self.timer.phase('cacheWrite'):
+            self._load_cache()
+
+        if len(self.mined) == 1:
+            print 'Backfilled build #%d into cache "%s".' % \
+                (self.mined[0].number, str(self.config.cache_file))
+        else:
+            print 'Backfilled %d builds (#%d to #%d) into cache "%s".' % \
+                (len(self.mined), self.mined[0].number, self.mined[-1].number,
+                 str(self.config.cache_file))
+        return 0
+
+    def _report_deltas(self):
+        """
+        Prints the number of warnings in each build, and how many were new
+        or no longer detected since the build before it.
+        """
+        diff = DIFF_ENGINES[self._diff_engine()]
+
+        previous = self.cached_build
+        for build in self.mined:
+            if self.config.all_steps:
+                for step in build.steps():
+                    cached_build = previous.builds.get(step) if previous is not None else None
+                    self._report_delta('Build #%d step %d' % (build.number, step),
+                                       cached_build, build.builds[step], diff)
+            else:
+                self._report_delta('Build #%d' % build.number, previous, build, diff)
+            previous = self._next_baseline(previous, build)
+
+    def _next_baseline(self, previous, build):
+        # what the build after 'build' is compared against
+        if not self.config.all_steps:
+            return build
+
+        # (a step the build did not complete keeps its old baseline)
+        steps = BuildSteps()
+        if previous is not None:
+            steps.builds.update(previous.builds)
+        steps.builds.update(build.builds)
+        return steps
+
+    def _report_delta(self, title, cached_build, latest_build, diff):
+        if cached_build is None:
+            print '%s: %d warnings (the first baseline)' % (title, len(latest_build.warnings))
+            return
+
+        if self.config.teamcity.warning_format is not None:
+            self._normalized_keys(cached_build)
+            self._normalized_keys(latest_build)
+            with self.timer.phase('diff'):
+                removed, added = diff(cached_build.key_names(), latest_build.key_names())
+            removed = len(removed)
+            added = len(added)
+        else:
+            with self.timer.phase('diff'):
+                cached_set = set(cached_build.warnings)
+                latest_set = set(latest_build.warnings)
+                removed = len(cached_set - latest_set)
+                added = len(latest_set - cached_set)
+
+        print '%s: %d warnings, %d new, %d no longer detected' % \
+            (title, len(latest_build.warnings), added, removed)
+
+    def _load_cache(self):
+        database = self.config.cache_file.database
+        if database:
+            if self.config.teamcity.warning_format is not None:
+                # store the builds ready to be compared against
+                for build in self.mined:
+                    if self.config.all_steps:
+                        for step in build.steps():
+                            self._normalized_keys(build.builds[step])
+                    else:
+                        self._normalized_keys(build)
+            if not database.store_builds(self.mined):
+                sys.exit(1)
+            return
+
+        # the newest baseline (of each step) is all a cache file holds
+        baseline = self.cached_build
+        for build in self.mined:
+            baseline = self._next_baseline(baseline, build)
+        # (with --all-steps, steps kept from the cache stay in use)
+        baseline.release()
+        self._replace_cached_build(baseline)
+        self._save_state()
+
+def main():
+    parser = OptionParser(usage='python backfill.py [options] -- <warning_watcher.py options>')
+    parser.add_option("-F", "--first", type="int", dest="first_build", default=None,
+                      metavar="<number>",
+                      help="The oldest build to mine (default: the oldest in the logs).")
+
+    (options, args) = parser.parse_args()
+
+    config = Config(args)
+    if config.config_file is None:
+        print 'BuildAgent config file not found; nothing to backfill.'
+        return 1
+
+    return Backfill(config, LogManager(config), options.first_build).run()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,20 @@
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: benchmark/__init__.py                                          #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This package measures the Warning Watcher away from a live     #
+#          TeamCity agent:                                                #
+#                                                                         #
+#     log_generator.py : writes synthetic agent logs                      #
+#     replay.py        : runs the Watcher over a folder of logs, without  #
+#                        an agent or a builders_conf/ configuration       #
+#     run.py           : times a set of scenarios, and writes the         #
+#                        results as JSON                                  #
+#                                                                         #
+# Each is run as a module from the Warning Watcher folder, e.g.:          #
+#                                                                         #
+#     cd build_system/warning_watcher                                     #
+#     python -m benchmark.run --output results.json                       #
+#-------------------------------------------------------------------------#
@@ -0,0 +1,319 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import sys
+import bz2
+import gzip
+import json
+import random
+import shutil
+
+from optparse import OptionParser
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: benchmark/log_generator.py                                     #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module writes the logs of a synthetic TeamCity Build      #
+#          Agent, for benchmarking the Warning Watcher.                   #
+#-------------------------------------------------------------------------#
+
+# The agent builds one project/configuration (by default 'Bench::Main')
+# over and over, with builds of another project mixed in.  Each build has
+# a number of steps (think Debug and Release), all with the same set of
+# warnings, which changes a little from one build to the next (so there
+# is always something to report), among ordinary output and agent
+# chatter.  Some steps fail.  The logs are rotated (as TeamCity does)
+# every so many lines, regardless of where the builds are, so builds run
+# across rotations.
+
+LINEPREFIX = '[2016-01-01 12:00:00,000]   INFO - '
+OUTPUTPREFIX = LINEPREFIX + '  out - '
+
+# output that is not a warning
+CHATTER = [
+    'Compiling %s...',
+    'Generating code for %s',
+    'Linking %s',
+    '%s -> c:\\work\\build\\bin\\bench.exe',
+]
+
+# what a failed step leaves behind (and what --fail-on-fragment looks for)
+FAILURE = 'error LNK2019: unresolved external symbol "void __cdecl missing(void)"'
+
+FORMATS = ['microsoft', 'gcc']
+
+# the messages of 'microsoft' warnings.  a WarningFormat compares what
+# follows the warning number (up to the first ','), so each names a
+# symbol of its own, and a warning that changes is seen to
+MICROSOFT_WARNINGS = [
+    (4244, "'%s' : conversion from 'int' to 'short', possible loss of data"),
+    (4267, "'%s' : conversion from 'size_t' to 'int', possible loss of data"),
+    (4305, "'%s' : truncation from 'double' to 'float'"),
+    (4996, "'%s': was declared deprecated"),
+    (4100, "'%s' : unreferenced formal parameter"),
+    (4189, "'%s' : local variable is initialized but not referenced"),
+]
+
+SYMBOLS = ['count', 'index', 'length', 'offset', 'size', 'value', 'width', 'result']
+
+def _source_file(rng):
+    return 'c:\\work\\src\\module%d\\file%d.cpp' % (rng.randint(0, 49), rng.randint(0, 199))
+
+def _warning(compiler, rng):
+    if compiler == 'microsoft':
+        number, message = rng.choice(MICROSOFT_WARNINGS)
+        symbol = '%s%d' % (rng.choice(SYMBOLS), rng.randint(0, 99))
+        return "%s(%d) : warning C%d: %s" % (_source_file(rng),
+                                             rng.randint(1, 3000),
+                                             number,
+                                             message % symbol)
+
+    warning = "%s:%d:%d: warning: unused variable 'x%d' [-Wunused-variable]" % \
+        (_source_file(rng), rng.randint(1, 3000), rng.randint(1, 80), rng.randint(0, 99))
+    if rng.random() < 0.1:
+        # OS X style: several warnings on one line, each with its '[-W...]'
+        warning += " %s:%d:%d: warning: comparison of integers of different signs " \
+                   "[-Wsign-compare]" % (_source_file(rng), rng.randint(1, 3000),
+                                         rng.randint(1, 80))
+    return warning
+
+class LogGenerator(object):
+    """
+    Writes 'builds' builds of the project (and those of the other project
+    mixed in) into '<folder>/logs/teamcity-build.log*'.  Each step has
+    'lines' lines of output, about 'warning_ratio' of them warnings.
+    """
+    def __init__(self,
+                 folder,
+                 compiler='microsoft',
+                 builds=20,
+                 steps=3,
+                 lines=2000,
+                 warning_ratio=0.2,
+                 churn=0.02,
+                 failure_ratio=0.1,
+                 other_ratio=0.25,
+                 log_lines=250000,
+                 compress=None,
+                 project='Bench',
+                 config='Main',
+                 seed=1):
+        super(LogGenerator, self).__init__()
+
+        assert compiler in FORMATS, 'Unknown compiler format: "%s"' % compiler
+        assert compress in [None, 'gz', 'bz2'], 'Unknown compression: "%s"' % compress
+
+        self.folder = os.path.abspath(folder)
+        self.log_folder = os.path.join(self.folder, 'logs')
+        self.compiler = compiler
+        self.builds = builds
+        self.steps = steps
+        self.lines = lines
+        self.warning_ratio = warning_ratio
+        self.churn = churn
+        self.failure_ratio = failure_ratio
+        self.other_ratio = other_ratio
+        self.log_lines = max(1000, log_lines)
+        self.compress = compress
+        self.project = project
+        self.config = config
+        self.seed = seed
+
+        self.rng = random.Random(seed)
+
+        # the log currently being written
+        self.log_files = []
+        self.log_output = None
+        self.log_count = 0
+        self.total_lines = 0
+
+    def generate(self):
+        """
+        Writes the logs, replacing any already in the folder.  Returns a
+        summary of what was written.
+        """
+        if os.path.exists(self.log_folder):
+            shutil.rmtree(self.log_folder)
+        os.makedirs(self.log_folder)
+
+        # the warnings of the project's steps; they drift from build to
+        # build
+        per_step = max(1, int(self.lines * self.warning_ratio))
+        warnings = [_warning(self.compiler, self.rng) for _ in xrange(per_step)]
+
+        self._write(LINEPREFIX + 'Build Agent starting')
+        self._write(LINEPREFIX + 'Agent name: bench')
+        self._write(LINEPREFIX + 'Agent is ready')
+
+        build_numbers = []
+        other_number = 0
+        for number in xrange(1, self.builds + 1):
+            while self.rng.random() < self.other_ratio:
+                other_number += 1
+                self._write_build('Other::Thing', other_number,
+                                  [_warning(self.compiler, self.rng) \
+                                   for _ in xrange(per_step // 4)], 1)
+
+            self._drift(warnings)
+            self._write_build('%s::%s' % (self.project, self.config),
+                              number, warnings, self.steps)
+            build_numbers.append(number)
+
+        file_names = self._finish()
+
+        return {'folder'     : self.folder,
+                'logs'       : file_names,
+                'lines'      : self.total_lines,
+                'bytes'      : sum([os.path.getsize(file_name) for file_name in file_names]),
+                'project'    : self.project,
+                'config'     : self.config,
+                'compiler'   : self.compiler,
+                'builds'     : build_numbers,
+                'steps'      : self.steps,
+                'step_lines' : self.lines}
+
+    def _drift(self, warnings):
+        changes = int(len(warnings) * self.churn)
+        for _ in xrange(changes):
+            warnings[self.rng.randrange(len(warnings))] = _warning(self.compiler, self.rng)
+
+    def _write_build(self, build_name, number, warnings, steps):
+        for _ in xrange(steps):
+            self._write(LINEPREFIX + '--------- [ %s #%d ] ---------' % (build_name, number))
+
+            failed = self.rng.random() < self.failure_ratio
+
+            # the warnings (a few of them twice), spread among the chatter
+            output = list(warnings)
+            output.extend(self.rng.sample(warnings, len(warnings) // 20))
+            chatter = max(0, self.lines - len(output))
+            output.extend([self.rng.choice(CHATTER) % _source_file(self.rng) \
+                           for _ in xrange(chatter)])
+            self.rng.shuffle(output)
+            if failed:
+                output.insert(self.rng.randrange(len(output) + 1), FAILURE)
+
+            for line in output:
+                self._write(OUTPUTPREFIX + line)
+                if self.rng.random() < 0.02:
+                    self._write(LINEPREFIX + 'Sending build progress to the server')
+
+            self._write(LINEPREFIX + 'Process exited with code %d' % (1 if failed else 0))
+
+    def _write(self, line):
+        if self.log_output is None:
+            file_name = os.path.join(self.log_folder, 'generated.%06d' % len(self.log_files))
+            self.log_files.append(file_name)
+            self.log_output = open(file_name, 'wb', 1024 * 1024)
+            self.log_count = 0
+
+        self.log_output.write(line)
+        self.log_output.write('\n')
+        self.log_count += 1
+        self.total_lines += 1
+
+        if self.log_count >= self.log_lines:
+            # rotate
+            self.log_output.close()
+            self.log_output = None
+
+    def _finish(self):
+        if self.log_output is not None:
+            self.log_output.close()
+            self.log_output = None
+
+        # the newest log is 'teamcity-build.log', the one before it
+        # 'teamcity-build.log.1', and so on; their times follow suit
+        file_names = []
+        count = len(self.log_files)
+        for ndx, file_name in enumerate(self.log_files):
+            rotation = count - ndx - 1
+            log_name = os.path.join(self.log_folder, 'teamcity-build.log')
+            if rotation:
+                log_name = '%s.%d' % (log_name, rotation)
+            os.rename(file_name, log_name)
+
+            timestamp = 1000000000 + ndx * 60
+            os.utime(log_name, (timestamp, timestamp))
+
+            if rotation and self.compress:
+                log_name = self._compress(log_name, timestamp)
+            file_names.append(log_name)
+
+        return file_names
+
+    def _compress(self, file_name, timestamp):
+        compressed_name = '%s.%s' % (file_name, self.compress)
+        if self.compress == 'gz':
+            compressed = gzip.GzipFile(compressed_name, 'wb')
+        else:
+            compressed = bz2.BZ2File(compressed_name, 'w')
+
+        with open(file_name, 'rb') as log_input:
+            try:
+                shutil.copyfileobj(log_input, compressed, 1024 * 1024)
+            finally:
+                compressed.close()
+
+        os.remove(file_name)
+        os.utime(compressed_name, (timestamp, timestamp))
+        return compressed_name
+
+def main():
+    parser = OptionParser(usage='python -m benchmark.log_generator [options] <agent_folder>')
+    parser.add_option("-C", "--compiler", type="choice", dest="compiler",
+                      choices=FORMATS, default='microsoft', metavar="<format>",
+                      help="The warning format: 'microsoft' (default) or 'gcc'.")
+    parser.add_option("-n", "--builds", type="int", dest="builds", default=20,
+                      metavar="<count>", help="Builds of the project to write (default 20).")
+    parser.add_option("-s", "--steps", type="int", dest="steps", default=3,
+                      metavar="<count>", help="Steps in each build (default 3).")
+    parser.add_option("-l", "--lines", type="int", dest="lines", default=2000,
+                      metavar="<count>", help="Lines of output in each step (default 2000).")
+    parser.add_option("-w", "--warning-ratio", type="float", dest="warning_ratio",
+                      default=0.2, metavar="<ratio>",
+                      help="The share of the output that is warnings (default 0.2).")
+    parser.add_option("-c", "--churn", type="float", dest="churn", default=0.02,
+                      metavar="<ratio>",
+                      help="The share of a step's warnings replaced in each build " \
+                           "(default 0.02).")
+    parser.add_option("-f", "--failure-ratio", type="float", dest="failure_ratio",
+                      default=0.1, metavar="<ratio>",
+                      help="The share of steps that fail (default 0.1).")
+    parser.add_option("-o", "--other-ratio", type="float", dest="other_ratio",
+                      default=0.25, metavar="<ratio>",
+                      help="How often another project's build is mixed in (default 0.25).")
+    parser.add_option("-r", "--log-lines", type="int", dest="log_lines", default=250000,
+                      metavar="<count>",
+                      help="Lines after which the log is rotated (default 250000).")
+    parser.add_option("-z", "--compress", type="choice", dest="compress",
+                      choices=['gz', 'bz2'], default=None, metavar="<gz|bz2>",
+                      help="Compress the rotated logs.")
+    parser.add_option("-S", "--seed", type="int", dest="seed", default=1,
+                      metavar="<number>", help="The random seed (default 1).")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('an agent folder is required')
+
+    generator = LogGenerator(args[0],
+                             compiler=options.compiler,
+                             builds=options.builds,
+                             steps=options.steps,
+                             lines=options.lines,
+                             warning_ratio=options.warning_ratio,
+                             churn=options.churn,
+                             failure_ratio=options.failure_ratio,
+                             other_ratio=options.other_ratio,
+                             log_lines=options.log_lines,
+                             compress=options.compress,
+                             seed=options.seed)
+    print json.dumps(generator.generate(), indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import re
+import sys
+
+from optparse import OptionParser
+
+from config import Config, TeamCity
+from cache_file import CacheFile
+from log_manager import LogManager
+from warning_watcher import run_step
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: benchmark/replay.py                                            #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module runs the Warning Watcher over a folder of agent    #
+#          logs (e.g., those of log_generator.py, or copies taken from a  #
+#          real agent), with the settings of a builders_conf/ file given  #
+#          on the command line instead.                                   #
+#                                                                         #
+# Example:                                                                #
+#                                                                         #
+#     python -m benchmark.replay -L /tmp/bench/logs -C /tmp/bench/cache \ #
+#        -F microsoft -- -b 20 -p Bench -c Main -B main -a bench -i       #
+#                                                                         #
+# Everything after '--' is passed on as the warning_watcher.py command    #
+# line.  As the Watcher is run as the last step of a build, the build     #
+# replayed should be the newest one in the logs.                          #
+#-------------------------------------------------------------------------#
+
+class ReplayConfig(Config):
+    """
+    A Config whose agent settings (those of builders_conf/<agent>.xml)
+    are supplied directly: the folder holding the logs, the cache location
+    (anything a 'Cache' setting accepts; the system temp folder if None),
+    and one of a warning format ('microsoft' or 'gcc'), regex or text.
+    """
+    def __init__(self, log_folder, cache=None, warning_format=None,
+                 warning_regex=None, warning_text=None, argv=None):
+        self.replay_log_folder = os.path.abspath(log_folder)
+        self.replay_cache = cache
+        self.replay_format = warning_format
+        self.replay_regex = warning_regex
+        self.replay_text = warning_text
+
+        super(ReplayConfig, self).__init__(list(argv or []))
+
+    def _read_config(self):
+        self.config_file = '<replay>'
+
+        self.teamcity.build_agent_log_path = self.replay_log_folder
+        self.teamcity.build_agent_path = os.path.dirname(self.replay_log_folder)
+        if not os.path.isdir(self.replay_log_folder):
+            print 'Error: Log folder cannot be accessed: "%s"' % self.replay_log_folder
+            sys.exit(1)
+
+        if self.replay_regex is not None:
+            self.teamcity.warning_regex = re.compile('(%s)' % self.replay_regex)
+        elif self.replay_text is not None:
+            self.teamcity.warning_text = self.replay_text
+        elif self.replay_format is not None:
+            if self.replay_format.lower() in ['microsoft', 'visualstudio']:
+                self.teamcity.warning_format = TeamCity.MICROSOFT
+            else:
+                self.teamcity.warning_format = TeamCity.GCC
+
+        if self.replay_cache is None:
+            self.cache_file = CacheFile(self)
+        else:
+            self.cache_file = CacheFile(self, self.replay_cache)
+        self.state_path = self.cache_file.local_folder()
+
+        self.teamcity.interested_parties[self.teamcity.project_name] = []
+        self.teamcity.interested_parties['%s_%s' % (self.teamcity.project_name,
+                                                    self.teamcity.config_name)] = []
+
+def replay(log_folder, argv, cache=None, warning_format=None,
+           warning_regex=None, warning_text=None):
+    """
+    Runs one Warning Watcher step over 'log_folder'.  Returns the step's
+    exit code.
+    """
+    config = ReplayConfig(log_folder, cache, warning_format, warning_regex, warning_text, argv)
+    if config.config_file is None:
+        return 1
+    return run_step(config, LogManager(config))
+
+def main():
+    parser = OptionParser(usage='python -m benchmark.replay [options] -- ' \
+                                '<warning_watcher.py options>')
+    parser.add_option("-L", "--logs", dest="log_folder", default=None,
+                      metavar="<folder>",
+                      help="The folder holding the teamcity-build.log* files.")
+    parser.add_option("-C", "--cache", dest="cache", default=None,
+                      metavar="<location>",
+                      help="Where the cache is kept: a folder, or an ftp://, " \
+                           "dropbox: or sqlite: location (default: the temp folder).")
+    parser.add_option("-F", "--format", type="choice", dest="warning_format",
+                      choices=['microsoft', 'visualstudio', 'gcc'], default=None,
+                      metavar="<format>", help="Detect warnings of this compiler.")
+    parser.add_option("-R", "--regex", dest="warning_regex", default=None,
+                      metavar="<expression>", help="Detect warnings with this expression.")
+    parser.add_option("-T", "--text", dest="warning_text", default=None,
+                      metavar="<text>", help="Detect warnings holding this text.")
+
+    (options, args) = parser.parse_args()
+    if options.log_folder is None:
+        parser.error('a log folder is required')
+    if [options.warning_format, options.warning_regex, options.warning_text].count(None) != 2:
+        parser.error('exactly one of --format, --regex or --text is required')
+
+    return replay(options.log_folder, args, options.cache, options.warning_format,
+                  options.warning_regex, options.warning_text)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,554 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+from cStringIO import StringIO
+
+from backfill import Backfill
+from build_data import BuildData
+from build_journal import BuildJournal
+from line_classifier import LineClassifier
+from log_manager import LogManager
+from log_pipeline import build_pipeline, OUTPUT_MARKER
+from delta_generator import DeltaGenerator
+from warning_fingerprint import NUMPY_AVAILABLE
+
+from benchmark.log_generator import LogGenerator, FORMATS, _warning
+from benchmark.replay import ReplayConfig
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: benchmark/run.py                                               #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module times the Warning Watcher over a set of scenarios, #
+#          and writes the results as JSON, so that they can be compared   #
+#          from one change (or machine) to the next.                      #
+#                                                                         #
+# Example:                                                                #
+#                                                                         #
+#     python -m benchmark.run --builds 40 --output results.json           #
+#     python -m benchmark.run --builds 40 --baseline results.json         #
+#-------------------------------------------------------------------------#
+
+# The scenarios:
+#
+#    scan:<engine>       the log pipeline over all of the logs, with every
+#                        line classified (the worst case)
+#    step:<variant>      a whole step (as warning_watcher.py runs it) for
+#                        the newest build, against the build before it
+#                        ('step:all-steps' reviews every step of the build,
+#                        and 'step:fragments' looks for FRAGMENTS failure
+#                        fragments in every output line)
+#    backfill:<engine>   every build of the project in the logs mined
+#                        (backfill.py) into a freshly reset cache
+#    delta:<path>        the comparison of two builds' warnings, by the
+#                        WarningFormat path (with each diff engine) and by
+#                        the WarningText/WarningRegex path (the fingerprint
+#                        variants only if NumPy is available)
+#    store:<backend>     writing a build to the cache
+#    retrieve:<backend>  reading it back
+#    append:journal      adding the next build to a journal cache (-J),
+#                        when a warning has been added at the top of it
+#                        (the size of the delta is also reported, as
+#                        'bytes'; it should be a few hundred at most)
+#    startup:<variant>   starting a step in a new process: loading the
+#                        modules, and reading the agent's configuration
+#                        from builders_conf/ (or the snapshot of it)
+#
+# Each is run --repeat times, and the quickest run is the one reported.
+
+RESULTSVERSION = 1
+
+# how many --fail-on-fragment fragments the 'step:fragments' scenario uses
+FRAGMENTS = 64
+
+# the folder holding the Watcher's modules
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what a step run without the watcher daemon loads
+IMPORTSCRIPT = 'import sys; sys.path.insert(0, %r); ' \
+               'import config, log_manager, delta_generator' % APP_FOLDER
+CONFIGSCRIPT = 'import sys; sys.path.insert(0, %r); ' \
+               'from config import Config; Config()' % APP_FOLDER
+
+class _Quiet(object):
+    # the Watcher reports on stdout (and may sys.exit() on an error); a
+    # benchmark only wants to know how long it took
+    def __init__(self):
+        self.saved_stdout = None
+        self.exited = False
+
+    def __enter__(self):
+        self.saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        output = sys.stdout.getvalue()
+        sys.stdout = self.saved_stdout
+        if exc_type is SystemExit:
+            print 'Warning: The Watcher exited (%s):' % str(exc_value)
+            print output
+            self.exited = True
+            return True
+        return False
+
+class Benchmark(object):
+    """
+    Runs the scenarios over the logs in 'log_folder', whose newest build
+    is 'build_number' of 'project'::'config'.  'work_folder' holds the
+    caches written along the way.
+    """
+    def __init__(self,
+                 log_folder,
+                 work_folder,
+                 compiler='microsoft',
+                 project='Bench',
+                 config='Main',
+                 build_number=1,
+                 repeat=3,
+                 workers=2,
+                 delta_warnings=5000,
+                 ftp=None,
+                 dropbox=None):
+        super(Benchmark, self).__init__()
+
+        self.log_folder = log_folder
+        self.work_folder = work_folder
+        self.compiler = compiler
+        self.project = project
+        self.config = config
+        self.build_number = build_number
+        self.repeat = max(1, repeat)
+        self.workers = workers
+        self.delta_warnings = delta_warnings
+        self.ftp = ftp
+        self.dropbox = dropbox
+
+        self.results = {}
+
+    def run(self):
+        self._scan('scan:readline', ['-E', 'readline'])
+        self._scan('scan:mmap', ['-E', 'mmap'])
+
+        self._step('step:readline', ['-N'])
+        self._step('step:mmap', ['-N', '-E', 'mmap'])
+        self._step('step:indexed', [])
+        self._step('step:workers', ['-N', '-w', str(self.workers)])
+        self._step('step:all-steps', ['-A'])
+        self._step('step:fragments', ['-N', '--fail-on-fragment-file', self._fragment_file()])
+
+        self._backfill('backfill:readline', ['-E', 'readline'])
+        self._backfill('backfill:mmap', ['-E', 'mmap'])
+
+        self._delta('delta:format:merge', ['-d', 'merge'])
+        self._delta('delta:format:difflib', ['-d', 'difflib'])
+        self._delta('delta:text', [])
+        if NUMPY_AVAILABLE:
+            self._delta('delta:format:fingerprint', ['-d', 'fingerprint'])
+            self._delta('delta:text:fingerprint', ['-d', 'fingerprint'])
+
+        backends = [('local', self._cache_folder('local'), [], []),
+                    ('compressed', self._cache_folder('compressed'), ['-z'], []),
+                    ('mapped', self._cache_folder('mapped'), [], ['-m']),
+                    ('journal', self._cache_folder('journal'), ['-J'], ['-J']),
+                    ('sqlite', 'sqlite:%s' % os.path.join(self._cache_folder('sqlite'),
+                                                          'bench.db'), [], [])]
+        if self.ftp is not None:
+            backends.append(('ftp', self.ftp, [], []))
+        if self.dropbox is not None:
+            backends.append(('dropbox', self.dropbox, [], []))
+        for name, cache, store_args, retrieve_args in backends:
+            self._cache(name, cache, store_args, retrieve_args)
+        self._journal_append('append:journal')
+
+        self._startup('startup:import', [IMPORTSCRIPT])
+        self._startup('startup:config', [CONFIGSCRIPT] + \
+                      self._arguments(self.build_number, ['--no-config-snapshot']))
+        self._startup('startup:snapshot', [CONFIGSCRIPT] + \
+                      self._arguments(self.build_number, []))
+
+        return self.results
+
+    def _cache_folder(self, name):
+        folder = os.path.join(self.work_folder, 'cache', name)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return folder
+
+    def _fragment_file(self):
+        # linker and compiler errors, as a build might be failed on
+        file_name = os.path.join(self.work_folder, 'fragments.txt')
+        with open(file_name, 'w') as fragment_file:
+            fragment_file.write('# failure fragments for the step:fragments scenario\n')
+            for ndx in xrange(FRAGMENTS / 2):
+                fragment_file.write('error LNK%d\n' % (2001 + ndx))
+                fragment_file.write('fatal error C%d\n' % (1001 + ndx))
+        return file_name
+
+    def _arguments(self, build_number, extra):
+        return ['-b', str(build_number),
+                '-p', self.project,
+                '-c', self.config,
+                '-B', 'bench',
+                '-a', 'bench',
+                '-i',
+                '--no-daemon'] + extra
+
+    def _make_config(self, extra, cache=None, build_number=None, text=False):
+        if build_number is None:
+            build_number = self.build_number
+        if text:
+            return ReplayConfig(self.log_folder, cache, warning_text='warning',
+                                argv=self._arguments(build_number, extra))
+        return ReplayConfig(self.log_folder, cache, self.compiler,
+                            argv=self._arguments(build_number, extra))
+
+    def _time(self, name, function, setup=None):
+        """
+        Times 'function' (handed whatever 'setup' returns, if there is a
+        'setup') --repeat times.
+        """
+        runs = []
+        for _ in xrange(self.repeat):
+            quiet = _Quiet()
+            with quiet:
+                argument = setup() if setup is not None else None
+                start = time.time()
+                if setup is not None:
+                    function(argument)
+                else:
+                    function()
+                runs.append(time.time() - start)
+            if quiet.exited:
+                break
+
+        if len(runs) != self.repeat:
+            self.results[name] = {'seconds' : None, 'runs' : runs}
+            print '%-24s %10s' % (name, 'failed')
+            return
+
+        self.results[name] = {'seconds' : min(runs), 'runs' : runs}
+        print '%-24s %10.4f' % (name, min(runs))
+        sys.stdout.flush()
+
+    def _scan(self, name, extra):
+        config = self._make_config(extra, self._cache_folder('scan'))
+        markers = ('--------- [ ', 'Process exited with code', OUTPUT_MARKER)
+
+        def scan():
+            log_manager = LogManager(config)
+            classifier = LineClassifier.create(config.teamcity)
+            for _ in build_pipeline(config, classifier, log_manager,
+                                    log_manager.get_oldest(), 0, markers, lambda: True):
+                pass
+
+        self._time(name, scan)
+
+    def _step(self, name, extra):
+        cache = self._cache_folder(name.replace(':', '_'))
+
+        def setup():
+            # the build before gives the step something to compare against
+            # (and brings the index up to date, where there is one)
+            if self.build_number > 1:
+                self._run_step(self._make_config(extra, cache, self.build_number - 1))
+            return self._make_config(extra, cache)
+
+        self._time(name, self._run_step, setup)
+
+    def _backfill(self, name, extra):
+        cache = self._cache_folder(name.replace(':', '_'))
+
+        def setup():
+            return self._make_config(['-x'] + extra, cache)
+
+        self._time(name, lambda config: Backfill(config, LogManager(config)).run(), setup)
+
+    def _run_step(self, config):
+        if config.config_file is None:
+            return
+        DeltaGenerator(config, LogManager(config)).run()
+
+    def _delta_builds(self):
+        rng = random.Random(self.delta_warnings)
+        cached = BuildData()
+        cached.id = '%s::%s #%d' % (self.project, self.config, self.build_number - 1)
+        cached.prefix = '%s::%s #' % (self.project, self.config)
+        cached.number = self.build_number - 1
+        cached.warnings = [_warning(self.compiler, rng) for _ in xrange(self.delta_warnings)]
+
+        # a few percent of the warnings change from one build to the next
+        latest = BuildData()
+        latest.id = '%s::%s #%d' % (self.project, self.config, self.build_number)
+        latest.prefix = cached.prefix
+        latest.number = self.build_number
+        latest.warnings = list(cached.warnings)
+        for _ in xrange(max(1, self.delta_warnings // 50)):
+            latest.warnings[rng.randrange(len(latest.warnings))] = _warning(self.compiler, rng)
+
+        return (cached, latest)
+
+    def _delta(self, name, extra):
+        text = name.startswith('delta:text')
+        config = self._make_config(['-N'] + extra, self._cache_folder('delta'), text=text)
+
+        def setup():
+            generator = DeltaGenerator(config, None)
+            generator.cached_build, generator.latest_build = self._delta_builds()
+            if not text:
+                # as it would have been stored in the cache
+                generator._normalized_keys(generator.cached_build)
+            return generator
+
+        if text:
+            function = lambda generator: generator._generate_delta(generator.cached_build,
+                                                                   generator.latest_build)
+        else:
+            function = lambda generator: generator._generate_delta_format(generator.cached_build,
+                                                                          generator.latest_build)
+        self._time(name, function, setup)
+
+    def _cache(self, name, cache, store_args, retrieve_args):
+        cached, _ = self._delta_builds()
+
+        def setup():
+            generator = DeltaGenerator(self._make_config(['-N'] + store_args, cache), None)
+            build = BuildData()
+            build.id, build.prefix, build.number = cached.id, cached.prefix, cached.number
+            build.warnings = list(cached.warnings)
+            generator.cached_build = build
+            return generator
+
+        self._time('store:%s' % name, lambda generator: generator._save_state(), setup)
+        self._time('retrieve:%s' % name,
+                   lambda generator: generator._restore_state(),
+                   lambda: DeltaGenerator(self._make_config(['-N'] + retrieve_args, cache),
+                                          None))
+
+    def _journal_append(self, name):
+        cached, _ = self._delta_builds()
+
+        # a warning added at the top of the build moves every other one
+        latest = BuildData()
+        latest.id = '%s::%s #%d' % (self.project, self.config, self.build_number)
+        latest.prefix = cached.prefix
+        latest.number = self.build_number
+        latest.warnings = [_warning(self.compiler, random.Random(self.build_number))] + \
+                          cached.warnings
+
+        # (both as they would have been stored in the cache)
+        generator = DeltaGenerator(self._make_config(['-N'], self._cache_folder('delta')), None)
+        generator._normalized_keys(cached)
+        generator._normalized_keys(latest)
+
+        sizes = []
+
+        def setup():
+            journal = BuildJournal()
+            journal_file = StringIO()
+            journal.store(journal_file, cached)
+            return (journal, journal_file)
+
+        def append(journal_and_file):
+            journal, journal_file = journal_and_file
+            start = journal_file.tell()
+            journal.append(journal_file, latest)
+            sizes.append(journal_file.tell() - start)
+
+        self._time(name, append, setup)
+        if sizes:
+            self.results[name]['bytes'] = sizes[-1]
+            print '%-24s %10d bytes' % ('', sizes[-1])
+
+    def _builders_conf(self):
+        # a builders_conf/ file for the agent, as a real one would have
+        folder = os.path.join(self.work_folder, 'builders_conf')
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'bench.xml'), 'w') as conf_output:
+                conf_output.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                                  '<TCWW><Settings>'
+                                  '<Cache value="%s"/>'
+                                  '<AgentPath value="%s"/>'
+                                  '<WarningFormat value="%s"/>'
+                                  '</Settings></TCWW>\n' % \
+                                      (self._cache_folder('startup'),
+                                       os.path.dirname(self.log_folder),
+                                       self.compiler))
+        return folder
+
+    def _startup(self, name, arguments):
+        # (anything the step leaves in the temp folder stays in ours)
+        temp_folder = self._cache_folder('temp')
+        environment = dict(os.environ)
+        environment['WWBLDRCFG'] = self._builders_conf()
+        for variable in ['TMPDIR', 'TEMP', 'TMP']:
+            environment[variable] = temp_folder
+        command = [sys.executable, '-c'] + arguments
+
+        def start():
+            with open(os.devnull, 'w') as output:
+                if subprocess.call(command, env=environment,
+                                   stdout=output, stderr=subprocess.STDOUT):
+                    sys.exit(1)
+
+        # (each run follows an untimed one, which leaves the file cache
+        # warm and the configuration snapshot written)
+        self._time(name, lambda ignored: start(), start)
+
+def compare(results, baseline):
+    """
+    Prints each scenario's time against that of the same scenario in
+    'baseline' (an earlier set of results).
+    """
+    print
+    print '%-24s %10s %10s %8s' % ('scenario', 'baseline', 'now', 'change')
+    for name in sorted(results['scenarios']):
+        now = results['scenarios'][name]['seconds']
+        before = baseline.get('scenarios', {}).get(name, {}).get('seconds')
+        if (now is None) or (before is None):
+            print '%-24s %10s %10s' % (name,
+                                       '-' if before is None else '%.4f' % before,
+                                       '-' if now is None else '%.4f' % now)
+            continue
+        change = ((now - before) / before * 100.0) if before else 0.0
+        print '%-24s %10.4f %10.4f %+7.1f%%' % (name, before, now, change)
+
+def main():
+    parser = OptionParser(usage='python -m benchmark.run [options]')
+    parser.add_option("-L", "--logs", dest="log_folder", default=None,
+                      metavar="<folder>",
+                      help="Use the teamcity-build.log* files in this folder, rather " \
+                           "than generating them (--project, --config and --build " \
+                           "then describe its newest build).")
+    parser.add_option("-p", "--project", dest="project", default='Bench',
+                      metavar="<project_name>", help="The project (default 'Bench').")
+    parser.add_option("-c", "--config", dest="config", default='Main',
+                      metavar="<config_name>", help="The configuration (default 'Main').")
+    parser.add_option("-b", "--build", type="int", dest="build_number", default=None,
+                      metavar="<number>", help="The newest build in --logs.")
+    parser.add_option("-C", "--compiler", type="choice", dest="compiler",
+                      choices=FORMATS, default='microsoft', metavar="<format>",
+                      help="The warning format: 'microsoft' (default) or 'gcc'.")
+    parser.add_option("-n", "--builds", type="int", dest="builds", default=20,
+                      metavar="<count>", help="Builds to generate (default 20).")
+    parser.add_option("-s", "--steps", type="int", dest="steps", default=3,
+                      metavar="<count>", help="Steps in each build (default 3).")
+    parser.add_option("-l", "--lines", type="int", dest="lines", default=2000,
+                      metavar="<count>", help="Lines of output in each step (default 2000).")
+    parser.add_option("--log-lines", type="int", dest="log_lines", default=250000,
+                      metavar="<count>",
+                      help="Lines after which the generated log is rotated (default 250000).")
+    parser.add_option("-z", "--compress", type="choice", dest="compress",
+                      choices=['gz', 'bz2'], default=None, metavar="<gz|bz2>",
+                      help="Compress the rotated logs that are generated.")
+    parser.add_option("-S", "--seed", type="int", dest="seed", default=1,
+                      metavar="<number>", help="The random seed (default 1).")
+    parser.add_option("-W", "--delta-warnings", type="int", dest="delta_warnings",
+                      default=5000, metavar="<count>",
+                      help="Warnings in each build compared (and cached) by the " \
+                           "delta and cache scenarios (default 5000).")
+    parser.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                      metavar="<count>", help="Runs of each scenario (default 3).")
+    parser.add_option("-w", "--workers", type="int", dest="workers", default=2,
+                      metavar="<count>",
+                      help="Processes used by the 'step:workers' scenario (default 2).")
+    parser.add_option("--ftp", dest="ftp", default=None, metavar="<location>",
+                      help="Also time an FTP cache (e.g., ftp://user:pw@host/folder).")
+    parser.add_option("--dropbox", dest="dropbox", default=None, metavar="<location>",
+                      help="Also time a Dropbox cache (e.g., dropbox:<token>:/folder).")
+    parser.add_option("-o", "--output", dest="output", default=None, metavar="<file>",
+                      help="Write the results to this JSON file.")
+    parser.add_option("-B", "--baseline", dest="baseline", default=None, metavar="<file>",
+                      help="Compare the results with those in this JSON file.")
+    parser.add_option("-k", "--keep", action="store_true", dest="keep", default=False,
+                      help="Keep the working folder (logs and caches).")
+
+    (options, _) = parser.parse_args()
+
+    baseline = None
+    if options.baseline is not None:
+        try:
+            with open(options.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        except (IOError, ValueError), error_object:
+            print 'Error: Baseline results could not be read: "%s": %s' % \
+                (options.baseline, str(error_object))
+            return 1
+
+    work_folder = tempfile.mkdtemp(prefix='tcww_bench_')
+    try:
+        if options.log_folder is None:
+            generator = LogGenerator(work_folder,
+                                     compiler=options.compiler,
+                                     builds=options.builds,
+                                     steps=options.steps,
+                                     lines=options.lines,
+                                     log_lines=options.log_lines,
+                                     compress=options.compress,
+                                     seed=options.seed)
+            logs = generator.generate()
+            log_folder = generator.log_folder
+            build_number = logs['builds'][-1]
+            # (the folder is gone once we are done)
+            del logs['folder']
+            logs['logs'] = [os.path.basename(file_name) for file_name in logs['logs']]
+        else:
+            if options.build_number is None:
+                parser.error('--build is required with --logs')
+            log_folder = os.path.abspath(options.log_folder)
+            build_number = options.build_number
+            logs = {'folder'  : log_folder,
+                    'project' : options.project,
+                    'config'  : options.config,
+                    'build'   : build_number}
+
+        benchmark = Benchmark(log_folder,
+                              work_folder,
+                              compiler=options.compiler,
+                              project=logs.get('project', options.project),
+                              config=logs.get('config', options.config),
+                              build_number=build_number,
+                              repeat=options.repeat,
+                              workers=options.workers,
+                              delta_warnings=options.delta_warnings,
+                              ftp=options.ftp,
+                              dropbox=options.dropbox)
+
+        results = {'version'        : RESULTSVERSION,
+                   'python'         : sys.version.split()[0],
+                   'platform'       : sys.platform,
+                   'time'           : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'repeat'         : benchmark.repeat,
+                   'delta_warnings' : options.delta_warnings,
+                   'logs'           : logs,
+                   'scenarios'      : benchmark.run()}
+    finally:
+        if options.keep:
+            print 'Working folder kept: "%s"' % work_folder
+        else:
+            shutil.rmtree(work_folder, True)
+
+    if options.output is not None:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        compare(results, baseline)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,53 +1,404 @@
-# pylint: disable=missing-docstring
-# pylint: disable=bad-whitespace
-
-import sys
-import cPickle
-
-#-------------------------------------------------------------------------#
-#     App: TeamCity9 Warning Watcher                                      #
-#  Module: build_data.py                                                  #
-#  Author: Bob Hood                                                       #
-# License: LGPL-3.0                                                       #
-#   PyVer: 2.7.x                                                          #
-#  Detail: Data class that holds the information mined from the build     #
-#          logs.                                                          #
-#-------------------------------------------------------------------------#
-
-class BuildData(object):
-    DATAVERSION = 1
-    def __init__(self):
-        super(BuildData, self).__init__()
-
-        self.id = None          # id of the build (full)
-        self.prefix = None      # prefix of the build (without build numbers)
-        self.number = 0
-        self.warnings = []      # text lines from build output that are warnings
-
-    # cPickle decided, rather arbitrarily, to stop working for me when I pickled
-    # a class or builtin (like set()).  subsequent load()'s produced errors about
-    # the modules not existing.  Google showed many other people with similar
-    # problems, but no real solutions.
-    #
-    # so, this class saves and reconstructs itself piecemeal--which at least
-    # works, and allows me to focus on more important technical issues...
-
-    def store(self, pickle_file):
-        cPickle.dump(BuildData.DATAVERSION, pickle_file)
-        cPickle.dump(self.id, pickle_file)
-        cPickle.dump(self.prefix, pickle_file)
-        cPickle.dump(self.number, pickle_file)
-        cPickle.dump(len(self.warnings), pickle_file)
-        for warning in self.warnings:
-            cPickle.dump(warning, pickle_file)
-
-    def retrieve(self, pickle_file):
-        version = cPickle.load(pickle_file)
-        self.id = cPickle.load(pickle_file)
-        self.prefix = cPickle.load(pickle_file)
-        self.number = cPickle.load(pickle_file)
-        warning_count = cPickle.load(pickle_file)
-        self.warnings = []
-        while warning_count:
-            self.warnings.append(cPickle.load(pickle_file))
-            warning_count -= 1
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import cPickle
+
+from array import array
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: build_data.py                                                  #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: Data class that holds the information mined from the build     #
+#          logs.                                                          #
+#-------------------------------------------------------------------------#
+
+# the binary cache format is:
+#
+#    header   : HEADER (see DataHeader)
+#    payload  : (optionally zlib-compressed)
+#        meta     : META (number, id, prefix, key format, key version)
+#        offsets  : (string count + 1) uint32 offsets into the string blob
+#        strings  : the (deduplicated) string blob
+#        warnings : warning count uint32 string indices
+#        keys     : key count (uint32 string index, uint32 line_no) pairs
+#
+# all values are little-endian; string indices of -1 stand in for None.
+
+MAGIC = 'TCWWDATA'
+HEADER = struct.Struct('<8sHHIIIIII')
+META = struct.Struct('<qiiii')
+UINT = struct.Struct('<I')
+UINTPAIR = struct.Struct('<II')
+
+FLAG_COMPRESSED = 0x01
+FLAG_KEYS = 0x02
+
+def _pack_uints(values):
+    packed = array('I', values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tostring()
+
+def _unpack_uints(data, offset, count):
+    unpacked = array('I')
+    unpacked.fromstring(data[offset:offset + (count * unpacked.itemsize)])
+    if sys.byteorder != 'little':
+        unpacked.byteswap()
+    return unpacked
+
+class MappedStrings(object):
+    """
+    The string table of a memory-mapped cache file.  Strings are only
+    created as they are asked for.
+    """
+    def __init__(self, buf, offsets_pos, count):
+        super(MappedStrings, self).__init__()
+        self.buf = buf
+        self.offsets_pos = offsets_pos
+        self.blob_pos = offsets_pos + ((count + 1) * UINT.size)
+        self.blob_size = UINT.unpack_from(buf, offsets_pos + (count * UINT.size))[0]
+
+    def get(self, ndx):
+        start, end = UINTPAIR.unpack_from(self.buf, self.offsets_pos + (ndx * UINT.size))
+        return self.buf[self.blob_pos + start:self.blob_pos + end]
+
+class MappedSequence(object):
+    """
+    A read-only sequence over a packed table of a memory-mapped cache file
+    (each entry being 'width' uint32 values).  Entries are only created as
+    they are asked for.
+    """
+    def __init__(self, strings, table_pos, count, width=1):
+        super(MappedSequence, self).__init__()
+        self.strings = strings
+        self.table_pos = table_pos
+        self.count = count
+        self.stride = width * UINT.size
+
+    def _entry(self, ndx):
+        return self.strings.get(UINT.unpack_from(self.strings.buf,
+                                                 self.table_pos + (ndx * self.stride))[0])
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, ndx):
+        if isinstance(ndx, slice):
+            return [self._entry(i) for i in xrange(*ndx.indices(self.count))]
+        if ndx < 0:
+            ndx += self.count
+        if (ndx < 0) or (ndx >= self.count):
+            raise IndexError('cache sequence index out of range')
+        return self._entry(ndx)
+
+    def __iter__(self):
+        for ndx in xrange(self.count):
+            yield self._entry(ndx)
+
+class MappedKeys(MappedSequence):
+    """
+    The (key, line_no) tuples of a memory-mapped cache file.
+    """
+    def __init__(self, strings, table_pos, count):
+        super(MappedKeys, self).__init__(strings, table_pos, count, 2)
+
+    def _entry(self, ndx):
+        key_ndx, line_no = UINTPAIR.unpack_from(self.strings.buf,
+                                                self.table_pos + (ndx * self.stride))
+        return (self.strings.get(key_ndx), line_no)
+
+    def names(self):
+        # the first value of each entry is the index of the key itself
+        return MappedSequence(self.strings, self.table_pos, self.count, 2)
+
+class DataHeader(object):
+    def __init__(self, data):
+        super(DataHeader, self).__init__()
+
+        (self.magic,
+         self.version,
+         self.flags,
+         self.string_count,
+         self.warning_count,
+         self.key_count,
+         self.raw_size,         # size of the payload, uncompressed
+         self.payload_size,     # size of the payload, as stored
+         self.checksum) = HEADER.unpack(data)
+
+    def compressed(self):
+        return (self.flags & FLAG_COMPRESSED) != 0
+
+    def has_keys(self):
+        return (self.flags & FLAG_KEYS) != 0
+
+class BuildData(object):
+    DATAVERSION = 3
+    def __init__(self):
+        super(BuildData, self).__init__()
+
+        self.id = None          # id of the build (full)
+        self.prefix = None      # prefix of the build (without build numbers)
+        self.number = 0
+        self.warnings = []      # text lines from build output that are warnings
+
+        # the normalized warnings as sorted (key, line_no) tuples, and the
+        # WarningFormat and WarningNormalizer.VERSION that produced them
+        self.keys = None
+        self.key_format = None
+        self.key_version = None
+
+        # set when the warnings are backed by a memory-mapped cache file
+        self.mapping = None
+
+        # the sorted fingerprints of the keys or warnings, once they have
+        # been compared by them (see warning_fingerprint.py); not stored
+        self.fingerprints = None
+
+    def release(self):
+        """
+        Materializes any memory-mapped warnings, and releases the mapping
+        (so the cache file can be replaced), for a build that stays in use.
+        """
+        if self.mapping is None:
+            return
+
+        self.warnings = list(self.warnings)
+        if self.keys is not None:
+            self.keys = list(self.keys)
+        self.mapping.close()
+        self.mapping = None
+
+    def close(self):
+        """
+        Releases the mapping of a build that is being discarded, without
+        reading its warnings.
+        """
+        if self.mapping is None:
+            return
+
+        self.warnings = []
+        self.keys = None
+        self.fingerprints = None
+        self.mapping.close()
+        self.mapping = None
+
+    def set_keys(self, keys, key_format, key_version):
+        self.keys = keys
+        self.fingerprints = None
+        self.key_format = key_format
+        self.key_version = key_version
+
+    def has_keys(self, key_format, key_version):
+        return (self.keys is not None) and \
+               (self.key_format == key_format) and \
+               (self.key_version == key_version)
+
+    def key_names(self):
+        """
+        The keys without their line numbers (left mapped if they are).
+        """
+        if isinstance(self.keys, MappedKeys):
+            return self.keys.names()
+        return [key[0] for key in self.keys]
+
+    # cPickle decided, rather arbitrarily, to stop working for me when I pickled
+    # a class or builtin (like set()).  subsequent load()'s produced errors about
+    # the modules not existing.  Google showed many other people with similar
+    # problems, but no real solutions.
+    #
+    # so, this class originally saved and reconstructed itself piecemeal, one
+    # pickle record per warning.  that got slow as warning counts grew, so it
+    # now writes a compact binary format instead (see the top of this module).
+    # the old format can still be read.
+
+    def store(self, data_file, compress=False):
+        strings = []
+        string_map = {}
+
+        def _index(value):
+            if value is None:
+                return -1
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            ndx = string_map.get(value)
+            if ndx is None:
+                ndx = len(strings)
+                string_map[value] = ndx
+                strings.append(value)
+            return ndx
+
+        warning_indices = [_index(warning) for warning in self.warnings]
+
+        flags = 0
+        key_indices = []
+        if self.keys is not None:
+            flags |= FLAG_KEYS
+            for key, line_no in self.keys:
+                key_indices.append(_index(key))
+                key_indices.append(line_no)
+
+        meta = META.pack(self.number,
+                         _index(self.id),
+                         _index(self.prefix),
+                         -1 if self.key_format is None else self.key_format,
+                         -1 if self.key_version is None else self.key_version)
+
+        offsets = [0]
+        for value in strings:
+            offsets.append(offsets[-1] + len(value))
+
+        payload = ''.join([meta,
+                           _pack_uints(offsets),
+                           ''.join(strings),
+                           _pack_uints(warning_indices),
+                           _pack_uints(key_indices)])
+        raw_size = len(payload)
+
+        if compress:
+            flags |= FLAG_COMPRESSED
+            payload = zlib.compress(payload)
+
+        data_file.write(HEADER.pack(MAGIC,
+                                    BuildData.DATAVERSION,
+                                    flags,
+                                    len(strings),
+                                    len(self.warnings),
+                                    len(self.keys) if self.keys is not None else 0,
+                                    raw_size,
+                                    len(payload),
+                                    zlib.crc32(payload) & 0xffffffff))
+        data_file.write(payload)
+
+    @staticmethod
+    def read_header(data_file):
+        """
+        Reads and sanity-checks the header of a binary cache file, without
+        touching the warnings themselves.  Returns a DataHeader, or None if
+        the file is not in the binary format (e.g., it is an older pickle
+        cache).  Raises ValueError if the header is damaged.
+        """
+        data = data_file.read(HEADER.size)
+        if not data.startswith(MAGIC):
+            return None
+        if len(data) != HEADER.size:
+            raise ValueError('Truncated cache file header')
+
+        header = DataHeader(data)
+        if header.version > BuildData.DATAVERSION:
+            raise ValueError('Unsupported cache file version %d' % header.version)
+        if (not header.compressed()) and (header.raw_size != header.payload_size):
+            raise ValueError('Inconsistent cache file header')
+
+        try:
+            remaining = os.fstat(data_file.fileno()).st_size - data_file.tell()
+        except (AttributeError, OSError, IOError):
+            remaining = None
+        if (remaining is not None) and (remaining < header.payload_size):
+            raise ValueError('Truncated cache file')
+
+        return header
+
+    def retrieve(self, data_file, lazy=False):
+        """
+        Loads the build from 'data_file'.  If 'lazy' is True, and the file
+        is an uncompressed binary cache on disk, it is memory-mapped rather
+        than read, and warnings are only materialized as they are accessed
+        (processes mapping the same file share its pages).  The payload
+        checksum is not verified in that case, since that would touch every
+        page.  The mapping is held until release() is called.
+        """
+        header = BuildData.read_header(data_file)
+        if header is None:
+            data_file.seek(0)
+            self._retrieve_pickle(data_file)
+            return
+
+        if lazy and (not header.compressed()):
+            self._map(header, data_file)
+            return
+
+        payload = data_file.read(header.payload_size)
+        if (len(payload) != header.payload_size) or \
+           ((zlib.crc32(payload) & 0xffffffff) != header.checksum):
+            raise ValueError('Cache file checksum mismatch')
+
+        if header.compressed():
+            payload = zlib.decompress(payload)
+            if len(payload) != header.raw_size:
+                raise ValueError('Cache file payload size mismatch')
+
+        self._unpack(header, payload)
+
+    def _unpack(self, header, payload):
+        number, id_ndx, prefix_ndx, key_format, key_version = META.unpack_from(payload, 0)
+        offset = META.size
+
+        offsets = _unpack_uints(payload, offset, header.string_count + 1)
+        offset += len(offsets) * offsets.itemsize
+
+        strings = [payload[offset + offsets[ndx]:offset + offsets[ndx + 1]] \
+                   for ndx in xrange(header.string_count)]
+        offset += offsets[-1]
+
+        warning_indices = _unpack_uints(payload, offset, header.warning_count)
+        offset += len(warning_indices) * warning_indices.itemsize
+
+        self.id = strings[id_ndx] if id_ndx != -1 else None
+        self.prefix = strings[prefix_ndx] if prefix_ndx != -1 else None
+        self.number = number
+        self.warnings = [strings[ndx] for ndx in warning_indices]
+
+        self.set_keys(None, None, None)
+        if header.has_keys():
+            key_indices = _unpack_uints(payload, offset, header.key_count * 2)
+            keys = zip([strings[ndx] for ndx in key_indices[0::2]], key_indices[1::2])
+            self.set_keys(keys,
+                          key_format if key_format != -1 else None,
+                          key_version if key_version != -1 else None)
+
+    def _map(self, header, data_file):
+        buf = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        base = data_file.tell()
+        number, id_ndx, prefix_ndx, key_format, key_version = META.unpack_from(buf, base)
+
+        strings = MappedStrings(buf, base + META.size, header.string_count)
+        warnings_pos = strings.blob_pos + strings.blob_size
+        keys_pos = warnings_pos + (header.warning_count * UINT.size)
+
+        self.mapping = buf
+        self.id = strings.get(id_ndx) if id_ndx != -1 else None
+        self.prefix = strings.get(prefix_ndx) if prefix_ndx != -1 else None
+        self.number = number
+        self.warnings = MappedSequence(strings, warnings_pos, header.warning_count)
+
+        self.set_keys(None, None, None)
+        if header.has_keys():
+            self.set_keys(MappedKeys(strings, keys_pos, header.key_count),
+                          key_format if key_format != -1 else None,
+                          key_version if key_version != -1 else None)
+
+    def _retrieve_pickle(self, pickle_file):
+        version = cPickle.load(pickle_file)
+        self.id = cPickle.load(pickle_file)
+        self.prefix = cPickle.load(pickle_file)
+        self.number = cPickle.load(pickle_file)
+        warning_count = cPickle.load(pickle_file)
+        self.warnings = []
+        while warning_count:
+            self.warnings.append(cPickle.load(pickle_file))
+            warning_count -= 1
+
+        self.set_keys(None, None, None)
+        if version >= 2:
+            key_format = cPickle.load(pickle_file)
+            key_version = cPickle.load(pickle_file)
+            self.set_keys(cPickle.load(pickle_file), key_format, key_version)
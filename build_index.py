@@ -0,0 +1,189 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import re
+import cPickle
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: build_index.py                                                 #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module maintains a persistent index of the build markers  #
+#          found in the TeamCity build logs, so the log scan can seek     #
+#          directly to the build being examined instead of reading every  #
+#          log from the beginning.                                        #
+#-------------------------------------------------------------------------#
+
+# the build marker, and the expressions that identify the build it starts
+# (shared by everything that reads build markers)
+BUILD_START = '--------- [ '
+BUILD_ID_REGEX = re.compile(r'\-\-\- \[ (.+) \] \-\-\-')
+BUILD_NUMBER_REGEX = re.compile(r'(.+) \#(\d+)')
+
+class BuildIndex(object):
+    """
+    Maps each build marker ('--------- [ <project>::<config> #<build> ] ---')
+    to the log (by Log.key signature) and byte offset at which it appears.
+    Each marker of a build is one step, in log order.
+
+    Logs are only parsed from the point where the previous run stopped, so
+    each invocation only pays for the bytes that were appended since then.
+    """
+
+    INDEXVERSION = 1
+
+    def __init__(self, config, log_manager):
+        super(BuildIndex, self).__init__()
+        self.config = config
+        self.log_manager = log_manager
+
+        self.index_file = os.path.join(config.state_path,
+                                       'tcww_%s.index' % config.teamcity.agent_name)
+
+        # Log.key -> {'scanned' : <bytes parsed>,
+        #             'markers' : [(prefix, number, offset), ...],
+        #             'final'   : True, once the log is known to be complete}
+        self.logs = {}
+        self.modified = False
+
+        self._load()
+
+    def _load(self):
+        if self.config.reset_cache or (not os.path.exists(self.index_file)):
+            return
+
+        try:
+            with open(self.index_file, 'rb') as index_input:
+                version = cPickle.load(index_input)
+                if version == BuildIndex.INDEXVERSION:
+                    self.logs = cPickle.load(index_input)
+        except:
+            print 'Warning: Build index "%s" could not be read; rebuilding.' % self.index_file
+            self.logs = {}
+
+    def _save(self):
+        try:
+            with open(self.index_file, 'wb') as index_output:
+                cPickle.dump(BuildIndex.INDEXVERSION, index_output, 2)
+                cPickle.dump(self.logs, index_output, 2)
+        except:
+            print 'Warning: Build index "%s" could not be written.' % self.index_file
+        self.modified = False
+
+    def _scan_log(self, log, entry):
+        """
+        Parse the complete lines appended to 'log' since the last scan,
+        recording the offset of each build marker.
+        """
+        with log.open() as log_file:
+            log_file.seek(entry['scanned'])
+            offset = entry['scanned']
+            while True:
+                log_line = log_file.readline()
+                if not log_line.endswith('\n'):
+                    # a partial line is still being written; pick it up next time
+                    break
+
+                if BUILD_START in log_line:
+                    result = BUILD_ID_REGEX.search(log_line)
+                    if result:
+                        result = BUILD_NUMBER_REGEX.search(result.group(1))
+                        if result:
+                            entry['markers'].append(
+                                (result.group(1), int(result.group(2)), offset))
+
+                offset += len(log_line)
+
+        if offset != entry['scanned']:
+            entry['scanned'] = offset
+            self.modified = True
+
+    def update(self):
+        """
+        Bring the index in line with the logs currently on disk.
+        """
+        current = {}
+        for log in self.log_manager.logs:
+            if log.key is None:
+                continue
+
+            entry = self.logs.get(log.key)
+            if (entry is not None) and entry.get('final'):
+                # a compressed log, fully indexed; there is nothing new in it
+                current[log.key] = entry
+                continue
+
+            if (entry is None) or \
+               ((not log.compressed) and (os.path.getsize(log.file_name) < entry['scanned'])):
+                # new (or truncated) log; start from the top
+                entry = {'scanned' : 0, 'markers' : []}
+                self.modified = True
+
+            try:
+                self._scan_log(log, entry)
+            except (IOError, EOFError):
+                continue
+
+            if log.compressed:
+                # a log is complete once it has been compressed, but it may
+                # have grown after it was last indexed (under the same key),
+                # and before it was rotated; that tail has now been read
+                entry['final'] = True
+                self.modified = True
+
+            current[log.key] = entry
+
+        if len(current) != len(self.logs):
+            # rotated logs have fallen off the end
+            self.modified = True
+        self.logs = current
+
+        if self.modified:
+            self._save()
+
+    def locate(self, project_config, build_number):
+        """
+        Returns a (Log, offset) tuple for the first marker of the indicated
+        build, or None if it cannot be (reliably) located with the index.
+        """
+        logs = self.log_manager.logs
+        if (not len(logs)) or any(log.key not in self.logs for log in logs):
+            # a log we could not index might hold the build; don't guess
+            return None
+
+        # walk oldest first, just as the scan would
+        for log in reversed(logs):
+            for prefix, number, offset in self.logs[log.key]['markers']:
+                if (number == build_number) and prefix.startswith(project_config):
+                    if not self._verify(log, offset):
+                        # the log changed beneath us; re-index it next time
+                        del self.logs[log.key]
+                        self._save()
+                        return None
+                    return (log, offset)
+
+        return None
+
+    def build_offsets(self, log, project_config=None, build_number=None):
+        """
+        The offsets of the build markers in 'log' (only those of the
+        indicated build, if one is given), in log order, or None if the log
+        has not been indexed.
+        """
+        entry = self.logs.get(log.key)
+        if entry is None:
+            return None
+        return [offset for prefix, number, offset in entry['markers'] \
+                if (build_number is None) or \
+                   ((number == build_number) and prefix.startswith(project_config))]
+
+    def _verify(self, log, offset):
+        try:
+            with log.open() as log_file:
+                log_file.seek(offset)
+                return BUILD_START in log_file.readline()
+        except (IOError, EOFError):
+            return False
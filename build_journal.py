@@ -0,0 +1,400 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import zlib
+import struct
+
+from cStringIO import StringIO
+
+from build_data import BuildData, _pack_uints, _unpack_uints
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: build_journal.py                                               #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module keeps the cache as a journal: a full snapshot of   #
+#          one build, followed by a delta record for each later build, so #
+#          that each run only has to add what changed.                    #
+#-------------------------------------------------------------------------#
+
+# the journal format is:
+#
+#    header  : JOURNAL_HEADER (magic, version)
+#    records : any number of
+#        record header : RECORD (tag, payload size, payload crc32)
+#        payload       : for a 'SNAP' record, a complete BuildData (see
+#                        build_data.py); for a 'DELT' record:
+#            delta     : DELTA (number, base number, id, prefix, string
+#                        count, op count)
+#            offsets   : (string count + 1) uint32 offsets into the blob
+#            strings   : the string blob (the inserted warnings and keys)
+#            ops       : op count (uint32, uint32) pairs
+#            and, if the build carries normalized keys:
+#            keys      : DELTA_KEYS (key format, key version, key op count,
+#                        inserted key count)
+#            key ops   : key op count (uint32, uint32) pairs
+#            inserted  : inserted key count (uint32 string index, uint32
+#                        line_no) pairs
+#
+# the first record is always a snapshot.  a delta rebuilds its build's
+# warnings from those of the build before it ('base number'): each op
+# either copies a run of the previous warnings (start, length), or inserts
+# a new one (INSERT, string index).  anything not copied was removed.  the
+# keys are rebuilt the same way (an INSERT op indexing the inserted keys),
+# so a build rebuilt from a delta is not normalized again.  they are copied
+# from the keys of the build before it as those keys stand once carried
+# over by the warning ops: each line_no moved to where its warning was
+# copied to (the keys of warnings that were not copied are dropped), and
+# the keys sorted again.  a warning added near the top of a build then
+# costs a key or two, rather than every key that follows it.
+#
+# all values are little-endian; string indices of -1 stand in for None.
+# a record that is truncated or fails its checksum (e.g., an append that
+# did not complete) ends the journal.
+
+JOURNAL_MAGIC = 'TCWWJRNL'
+JOURNAL_HEADER = struct.Struct('<8sH')
+RECORD = struct.Struct('<4sII')
+DELTA = struct.Struct('<qqiiII')
+DELTA_KEYS = struct.Struct('<iiII')
+
+SNAPSHOT = 'SNAP'
+DELTA_RECORD = 'DELT'
+
+INSERT = 0xffffffff
+
+JOURNALLIMIT = 25
+
+def _diff_warnings(previous, warnings):
+    """
+    Expresses 'warnings' as a list of ops against 'previous'.  Each warning
+    is matched to the earliest unused identical warning of the previous
+    build, so unchanged (or merely reordered) warnings cost a copy op, and
+    only new warnings are stored.  Returns (ops, inserted).
+    """
+    positions = {}
+    for ndx in xrange(len(previous) - 1, -1, -1):
+        positions.setdefault(previous[ndx], []).append(ndx)
+
+    ops = []
+    inserted = []
+    run_start = run_length = 0
+
+    for warning in warnings:
+        candidates = positions.get(warning)
+        if candidates:
+            ndx = candidates.pop()
+            if run_length and (ndx == run_start + run_length):
+                run_length += 1
+                continue
+            if run_length:
+                ops.append((run_start, run_length))
+            run_start = ndx
+            run_length = 1
+        else:
+            if run_length:
+                ops.append((run_start, run_length))
+                run_length = 0
+            ops.append((INSERT, len(inserted)))
+            inserted.append(warning)
+
+    if run_length:
+        ops.append((run_start, run_length))
+
+    return (ops, inserted)
+
+def _carry_keys(keys, ops, previous_count):
+    """
+    Returns the sorted (key, line_no) tuples of 'keys' (those of a build of
+    'previous_count' warnings), with each line_no moved to where the warning
+    ops copy that warning.
+    """
+    moved = [-1] * previous_count
+    position = 0
+    for start, length in ops:
+        if start == INSERT:
+            position += 1
+        else:
+            moved[start:start + length] = xrange(position, position + length)
+            position += length
+
+    carried = [(key, moved[line_no]) for key, line_no in keys \
+               if (line_no < previous_count) and (moved[line_no] != -1)]
+    carried.sort()
+    return carried
+
+class BuildJournal(object):
+    VERSION = 1
+    def __init__(self):
+        super(BuildJournal, self).__init__()
+
+        self.records = []       # (tag, number, payload), oldest first
+        self.latest = None      # the BuildData of the last record
+        self.damaged = False    # records were dropped from the end
+
+        # the keys the journal holds for the latest build, as a (key format,
+        # key version, keys) tuple (the build itself may have been given
+        # keys since, which a delta cannot copy)
+        self.latest_keys = None
+
+        # the size of the last delta written
+        self.removed = 0
+        self.added = 0
+
+    @staticmethod
+    def is_journal(data_file):
+        magic = data_file.read(len(JOURNAL_MAGIC))
+        data_file.seek(0)
+        return magic == JOURNAL_MAGIC
+
+    def numbers(self):
+        return [number for _, number, _ in self.records]
+
+    def delta_count(self):
+        return len(self.records) - 1 if self.records else 0
+
+    def can_append(self, limit=JOURNALLIMIT):
+        """
+        True if the next build can be appended as a delta; otherwise, the
+        journal should be compacted by store()-ing a new snapshot.
+        """
+        return (self.latest is not None) and \
+               (not self.damaged) and \
+               (self.delta_count() < limit)
+
+    def build(self, number=None):
+        """
+        Rebuilds the BuildData of build 'number' (the latest, if None) by
+        applying deltas to the snapshot.  Returns None if the build is not
+        in the journal.
+        """
+        if number is None:
+            return self.latest
+        if number not in self.numbers():
+            return None
+
+        build = None
+        for tag, record_number, payload in self.records:
+            build = self._apply(tag, payload, build)
+            if record_number == number:
+                break
+        return build
+
+    def retrieve(self, data_file):
+        """
+        Loads the journal from 'data_file', and rebuilds its latest build.
+        Raises ValueError if the journal has no usable snapshot.
+        """
+        data = data_file.read(JOURNAL_HEADER.size)
+        if len(data) != JOURNAL_HEADER.size:
+            raise ValueError('Truncated cache journal header')
+        magic, version = JOURNAL_HEADER.unpack(data)
+        if magic != JOURNAL_MAGIC:
+            raise ValueError('Not a cache journal')
+        if version > BuildJournal.VERSION:
+            raise ValueError('Unsupported cache journal version %d' % version)
+
+        self.records = []
+        self.latest = None
+        self.latest_keys = None
+        self.damaged = False
+
+        while True:
+            data = data_file.read(RECORD.size)
+            if len(data) == 0:
+                break
+            if len(data) != RECORD.size:
+                self.damaged = True
+                break
+
+            tag, size, checksum = RECORD.unpack(data)
+            payload = data_file.read(size)
+            if (len(payload) != size) or \
+               ((zlib.crc32(payload) & 0xffffffff) != checksum) or \
+               (tag not in (SNAPSHOT, DELTA_RECORD)) or \
+               ((tag == DELTA_RECORD) and (self.latest is None)):
+                self.damaged = True
+                break
+
+            try:
+                build = self._apply(tag, payload, self.latest)
+            except ValueError:
+                # a delta against some other build (e.g., two agents
+                # appended at once) breaks the chain here
+                self.damaged = True
+                break
+
+            self.records.append((tag, build.number, payload))
+            self.latest = build
+            self.latest_keys = self._held_keys(build)
+
+        if self.latest is None:
+            raise ValueError('Cache journal has no snapshot')
+
+    def store(self, data_file, build, compress=False):
+        """
+        Writes a new journal to 'data_file', holding only a snapshot of
+        'build' (this is also how the journal is compacted).
+        """
+        snapshot = StringIO()
+        build.store(snapshot, compress)
+
+        data_file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, BuildJournal.VERSION))
+        self._write_record(data_file, SNAPSHOT, build.number, snapshot.getvalue())
+
+        self.latest = build
+        self.latest_keys = self._held_keys(build)
+        self.damaged = False
+        self.removed = 0
+        self.added = len(build.warnings)
+
+    def append(self, data_file, build):
+        """
+        Writes a delta from the latest build to 'build' onto the end of
+        the journal ('data_file' must be opened for appending).
+        """
+        ops, inserted = _diff_warnings(self.latest.warnings, build.warnings)
+
+        strings = [build.id, build.prefix] + inserted
+        keys_section = ''
+        if build.keys is not None:
+            # (copied from the keys of the latest build, where it has them
+            # in the same form)
+            previous_keys = []
+            if (self.latest_keys is not None) and \
+               (self.latest_keys[:2] == (build.key_format, build.key_version)):
+                previous_keys = _carry_keys(self.latest_keys[2], ops,
+                                            len(self.latest.warnings))
+            key_ops, inserted_keys = _diff_warnings(previous_keys, list(build.keys))
+
+            key_values = []
+            key_strings = {}
+            for key, line_no in inserted_keys:
+                if key not in key_strings:
+                    key_strings[key] = len(strings)
+                    strings.append(key)
+                key_values.extend([key_strings[key], line_no])
+
+            keys_section = ''.join([DELTA_KEYS.pack(-1 if build.key_format is None \
+                                                        else build.key_format,
+                                                    -1 if build.key_version is None \
+                                                        else build.key_version,
+                                                    len(key_ops),
+                                                    len(inserted_keys)),
+                                    _pack_uints([value for op in key_ops for value in op]),
+                                    _pack_uints(key_values)])
+
+        offsets = [0]
+        for value in strings:
+            offsets.append(offsets[-1] + (len(value) if value is not None else 0))
+
+        op_values = []
+        for op in ops:
+            op_values.extend(op)
+
+        payload = ''.join([DELTA.pack(build.number,
+                                      self.latest.number,
+                                      -1 if build.id is None else 0,
+                                      -1 if build.prefix is None else 1,
+                                      len(offsets) - 1,
+                                      len(ops)),
+                           _pack_uints(offsets),
+                           ''.join([value for value in strings if value is not None]),
+                           _pack_uints(op_values),
+                           keys_section])
+
+        self._write_record(data_file, DELTA_RECORD, build.number, payload)
+
+        self.added = len(inserted)
+        self.removed = len(self.latest.warnings) - (len(build.warnings) - len(inserted))
+        self.latest = build
+        self.latest_keys = self._held_keys(build)
+
+    def _held_keys(self, build):
+        if build.keys is None:
+            return None
+        return (build.key_format, build.key_version, build.keys)
+
+    def _write_record(self, data_file, tag, number, payload):
+        data_file.write(RECORD.pack(tag, len(payload), zlib.crc32(payload) & 0xffffffff))
+        data_file.write(payload)
+        if tag == SNAPSHOT:
+            self.records = []
+        self.records.append((tag, number, payload))
+
+    def _apply(self, tag, payload, previous):
+        if tag == SNAPSHOT:
+            build = BuildData()
+            build.retrieve(StringIO(payload))
+            return build
+
+        number, base_number, id_ndx, prefix_ndx, string_count, op_count = \
+            DELTA.unpack_from(payload, 0)
+        if base_number != previous.number:
+            raise ValueError('Cache journal delta for build #%d does not follow build #%d' % \
+                             (number, previous.number))
+        offset = DELTA.size
+
+        offsets = _unpack_uints(payload, offset, string_count + 1)
+        offset += len(offsets) * offsets.itemsize
+
+        strings = [payload[offset + offsets[ndx]:offset + offsets[ndx + 1]] \
+                   for ndx in xrange(string_count)]
+        offset += offsets[-1]
+
+        op_values = _unpack_uints(payload, offset, op_count * 2)
+        offset += len(op_values) * op_values.itemsize
+
+        ops = zip(op_values[0::2], op_values[1::2])
+
+        warnings = []
+        for start, length in ops:
+            if start == INSERT:
+                warnings.append(strings[2 + length])
+            else:
+                warnings.extend(previous.warnings[start:start + length])
+
+        build = BuildData()
+        build.id = strings[id_ndx] if id_ndx != -1 else None
+        build.prefix = strings[prefix_ndx] if prefix_ndx != -1 else None
+        build.number = number
+        build.warnings = warnings
+
+        if offset < len(payload):
+            key_format, key_version, key_op_count, key_count = \
+                DELTA_KEYS.unpack_from(payload, offset)
+            offset += DELTA_KEYS.size
+            key_op_values = _unpack_uints(payload, offset, key_op_count * 2)
+            offset += len(key_op_values) * key_op_values.itemsize
+            key_values = _unpack_uints(payload, offset, key_count * 2)
+
+            key_format = key_format if key_format != -1 else None
+            key_version = key_version if key_version != -1 else None
+            previous_keys = []
+            if previous.has_keys(key_format, key_version):
+                previous_keys = _carry_keys(previous.keys, ops, len(previous.warnings))
+
+            keys = []
+            for ndx in xrange(0, len(key_op_values), 2):
+                start, length = key_op_values[ndx], key_op_values[ndx + 1]
+                if start == INSERT:
+                    keys.append((strings[key_values[length * 2]],
+                                 key_values[(length * 2) + 1]))
+                else:
+                    if start + length > len(previous_keys):
+                        raise ValueError('Cache journal delta for build #%d copies keys ' \
+                                         'build #%d does not have' % (number, previous.number))
+                    keys.extend(previous_keys[start:start + length])
+            build.set_keys(keys, key_format, key_version)
+
+        return build
+
+    def size(self):
+        return JOURNAL_HEADER.size + \
+               sum([RECORD.size + len(payload) for _, _, payload in self.records])
+
+    def __str__(self):
+        return 'journal of %d build%s (%d bytes)' % \
+            (len(self.records), 's' if len(self.records) != 1 else '', self.size())
@@ -0,0 +1,117 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import struct
+
+from cStringIO import StringIO
+
+from build_data import BuildData, UINTPAIR, _pack_uints, _unpack_uints
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: build_steps.py                                                 #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module keeps the cache as a set of builds, one for each   #
+#          step of the build (see --all-steps), so that every step is     #
+#          compared against its own baseline, and all of them are        #
+#          written at once.                                               #
+#-------------------------------------------------------------------------#
+
+# the step set format is:
+#
+#    header  : STEPS_HEADER (magic, version, step count)
+#    index   : step count (uint32 step, uint32 record size) pairs
+#    records : a complete BuildData (see build_data.py) for each step, in
+#              the order of the index
+#
+# all values are little-endian.
+
+STEPS_MAGIC = 'TCWWSTEP'
+STEPS_HEADER = struct.Struct('<8sHI')
+
+class BuildSteps(object):
+    VERSION = 1
+
+    def __init__(self):
+        super(BuildSteps, self).__init__()
+
+        self.builds = {}    # step number -> BuildData
+
+    @staticmethod
+    def is_steps(data_file):
+        magic = data_file.read(len(STEPS_MAGIC))
+        data_file.seek(0)
+        return magic == STEPS_MAGIC
+
+    @property
+    def number(self):
+        # the newest build any of the steps came from
+        if not self.builds:
+            return 0
+        return max([build.number for build in self.builds.values()])
+
+    def steps(self):
+        return sorted(self.builds.keys())
+
+    def release(self):
+        for build in self.builds.values():
+            build.release()
+
+    def close(self):
+        for build in self.builds.values():
+            build.close()
+
+    def retrieve(self, data_file, lazy=False):
+        """
+        Loads the build of each step from 'data_file' (see BuildData.retrieve()
+        for 'lazy').  Raises ValueError if the file is not a step set, or is
+        damaged.
+        """
+        data = data_file.read(STEPS_HEADER.size)
+        if len(data) != STEPS_HEADER.size:
+            raise ValueError('Truncated cache step set header')
+        magic, version, count = STEPS_HEADER.unpack(data)
+        if magic != STEPS_MAGIC:
+            raise ValueError('Not a cache step set')
+        if version > BuildSteps.VERSION:
+            raise ValueError('Unsupported cache step set version %d' % version)
+
+        data = data_file.read(count * UINTPAIR.size)
+        if len(data) != count * UINTPAIR.size:
+            raise ValueError('Truncated cache step set index')
+        index = _unpack_uints(data, 0, count * 2)
+
+        self.builds = {}
+        for step, size in zip(index[0::2], index[1::2]):
+            start = data_file.tell()
+            build = BuildData()
+            build.retrieve(data_file, lazy)
+            self.builds[step] = build
+
+            # (a mapped build leaves the file where its payload begins)
+            data_file.seek(start + size)
+
+    def store(self, data_file, compress=False):
+        """
+        Writes the build of each step to 'data_file'.
+        """
+        index = []
+        records = []
+        for step in self.steps():
+            record = StringIO()
+            self.builds[step].store(record, compress)
+            records.append(record.getvalue())
+            index.extend([step, len(records[-1])])
+
+        data_file.write(STEPS_HEADER.pack(STEPS_MAGIC, BuildSteps.VERSION, len(records)))
+        data_file.write(_pack_uints(index))
+        for record in records:
+            data_file.write(record)
+
+    def __str__(self):
+        return 'steps %s' % ', '.join(['%d (build #%d, %d warnings)' % \
+                                           (step, self.builds[step].number,
+                                            len(self.builds[step].warnings)) \
+                                       for step in self.steps()])
@@ -0,0 +1,318 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import time
+import sqlite3
+
+from build_data import BuildData
+from build_steps import BuildSteps
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: cache_database.py                                              #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module provides a cache backend that keeps the builds of  #
+#          every project/configuration/branch in a single SQLite          #
+#          database, one row per warning.                                 #
+#-------------------------------------------------------------------------#
+
+# the number of builds of each project/configuration/branch/step that are
+# kept (the most recently stored of them being the baseline), so that later
+# builds can be compared against any of them
+HISTORY = 25
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS builds (
+           build_key   INTEGER PRIMARY KEY,
+           project     TEXT NOT NULL,
+           config      TEXT NOT NULL,
+           branch      TEXT NOT NULL,
+           step        INTEGER NOT NULL,
+           number      INTEGER NOT NULL,
+           id          TEXT,
+           prefix      TEXT,
+           key_format  INTEGER,
+           key_version INTEGER,
+           stored      REAL NOT NULL)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS builds_by_number
+           ON builds (project, config, branch, step, number)''',
+    '''CREATE TABLE IF NOT EXISTS warnings (
+           build_key   INTEGER NOT NULL,
+           position    INTEGER NOT NULL,
+           warning     TEXT NOT NULL,
+           key         TEXT,
+           PRIMARY KEY (build_key, position))''',
+    '''CREATE INDEX IF NOT EXISTS warnings_by_key
+           ON warnings (build_key, key, position)''',
+]
+
+class CacheDatabase(object):
+    """
+    A SQLite database holding the cached builds.  Builds are identified by
+    (project, configuration, branch, step, build number), and each warning
+    is a row of its own, so the latest build, any build still held, or the
+    changes between two builds are all found through an index.
+    """
+    def __init__(self, config, database_path):
+        super(CacheDatabase, self).__init__()
+        self.config = config
+        self.database_path = os.path.abspath(database_path)
+
+        self.combination = (config.teamcity.project_name,
+                            config.teamcity.config_name,
+                            config.teamcity.branch_name,
+                            config.teamcity.build_step)
+
+        self.connection = None
+
+    def connect(self):
+        folder = os.path.dirname(self.database_path)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except:
+                pass
+
+        try:
+            self.connection = sqlite3.connect(self.database_path, timeout=60.0)
+            # warnings are stored exactly as they were read from the logs
+            self.connection.text_factory = str
+            with self.connection:
+                for statement in SCHEMA:
+                    self.connection.execute(statement)
+        except sqlite3.Error:
+            self.connection = None
+            return False
+
+        return True
+
+    def available(self):
+        return self.connection is not None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def local_folder(self):
+        return os.path.dirname(self.database_path)
+
+    def numbers(self):
+        cursor = self.connection.execute(
+            'SELECT number FROM builds '
+            'WHERE project = ? AND config = ? AND branch = ? AND step = ? '
+            'ORDER BY number', self.combination)
+        return [row[0] for row in cursor]
+
+    def _step_combination(self, step):
+        # our project/configuration/branch, at another step
+        if step is None:
+            return self.combination
+        return self.combination[:3] + (step,)
+
+    def _steps(self):
+        # the steps (see --all-steps) that have builds held
+        cursor = self.connection.execute(
+            'SELECT DISTINCT step FROM builds '
+            'WHERE project = ? AND config = ? AND branch = ? AND step > 0 '
+            'ORDER BY step', self.combination[:3])
+        return [row[0] for row in cursor]
+
+    def _build_row(self, number=None, step=None):
+        if number is None:
+            return self.connection.execute(
+                'SELECT build_key, number, id, prefix, key_format, key_version FROM builds '
+                'WHERE project = ? AND config = ? AND branch = ? AND step = ? '
+                'ORDER BY build_key DESC LIMIT 1', self._step_combination(step)).fetchone()
+
+        return self.connection.execute(
+            'SELECT build_key, number, id, prefix, key_format, key_version FROM builds '
+            'WHERE project = ? AND config = ? AND branch = ? AND step = ? AND number = ?',
+            self._step_combination(step) + (number,)).fetchone()
+
+    def retrieve(self):
+        """
+        Returns the BuildData of the most recently stored build (the
+        baseline), or None if there is none.
+        """
+        try:
+            return self._retrieve()
+        except sqlite3.Error, error_object:
+            print 'Warning: SQLite cache could not be read: %s' % str(error_object)
+            return None
+
+    def retrieve_steps(self):
+        """
+        Returns a BuildSteps holding the most recently stored build of each
+        step (see --all-steps), or None if there are none.
+        """
+        steps = BuildSteps()
+        try:
+            for step in self._steps():
+                build = self._retrieve(step)
+                if build is not None:
+                    steps.builds[step] = build
+        except sqlite3.Error, error_object:
+            print 'Warning: SQLite cache could not be read: %s' % str(error_object)
+            return None
+        return steps if len(steps.builds) else None
+
+    def _retrieve(self, step=None):
+        row = self._build_row(None, step)
+        if row is None:
+            return None
+
+        build_key, number, build_id, prefix, key_format, key_version = row
+
+        build = BuildData()
+        build.id = build_id
+        build.prefix = prefix
+        build.number = number
+        build.warnings = [warning for warning, in self.connection.execute(
+            'SELECT warning FROM warnings WHERE build_key = ? ORDER BY position',
+            (build_key,))]
+
+        if key_format is not None:
+            build.set_keys([(key, position) for key, position in self.connection.execute(
+                'SELECT key, position FROM warnings WHERE build_key = ? '
+                'ORDER BY key, position', (build_key,))],
+                           key_format, key_version)
+
+        return build
+
+    def store(self, build, history=HISTORY):
+        """
+        Adds (or replaces) 'build', and drops all but the 'history' most
+        recent builds of this project/configuration/branch/step, in a
+        single transaction.  Returns False if the database could not be
+        updated.
+        """
+        try:
+            with self.connection:
+                self._store(build, history)
+        except sqlite3.Error, error_object:
+            print 'Error: SQLite cache could not be updated: %s' % str(error_object)
+            return False
+        return True
+
+    def store_steps(self, steps, history=HISTORY):
+        """
+        Stores the build of each step in 'steps' (a BuildSteps) as store()
+        does, all in a single transaction.
+        """
+        try:
+            with self.connection:
+                for step in steps.steps():
+                    self._store(steps.builds[step], history, step)
+        except sqlite3.Error, error_object:
+            print 'Error: SQLite cache could not be updated: %s' % str(error_object)
+            return False
+        return True
+
+    def store_builds(self, builds, history=HISTORY):
+        """
+        Stores each of 'builds' (oldest first; BuildSteps with --all-steps)
+        as store() does, all in a single transaction.
+        """
+        try:
+            with self.connection:
+                for build in builds:
+                    if isinstance(build, BuildSteps):
+                        for step in build.steps():
+                            self._store(build.builds[step], history, step)
+                    else:
+                        self._store(build, history)
+        except sqlite3.Error, error_object:
+            print 'Error: SQLite cache could not be updated: %s' % str(error_object)
+            return False
+        return True
+
+    def _store(self, build, history, step=None):
+        # (within the caller's transaction)
+        combination = self._step_combination(step)
+
+        keys = {}
+        if build.keys is not None:
+            for key, position in build.keys:
+                keys[position] = key
+
+        row = self._build_row(build.number, step)
+        if row is not None:
+            self._delete(row[0])
+
+        cursor = self.connection.execute(
+            'INSERT INTO builds (project, config, branch, step, number, id, prefix, '
+            'key_format, key_version, stored) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            combination + (build.number,
+                           build.id,
+                           build.prefix,
+                           build.key_format if build.keys is not None else None,
+                           build.key_version if build.keys is not None else None,
+                           time.time()))
+        build_key = cursor.lastrowid
+
+        self.connection.executemany(
+            'INSERT INTO warnings (build_key, position, warning, key) VALUES (?, ?, ?, ?)',
+            ((build_key, position, warning, keys.get(position)) \
+             for position, warning in enumerate(build.warnings)))
+
+        expired = self.connection.execute(
+            'SELECT build_key FROM builds '
+            'WHERE project = ? AND config = ? AND branch = ? AND step = ? '
+            'ORDER BY build_key DESC LIMIT -1 OFFSET ?',
+            combination + (max(1, history),)).fetchall()
+        for expired_key, in expired:
+            self._delete(expired_key)
+
+    def changes_since(self, number):
+        """
+        Compares the warnings of build 'number' with those of the latest
+        build.  Returns an (added, removed) tuple of lists of warnings
+        (repeated as many times as their count changed), or None if build
+        'number' is not held.
+        """
+        then = self._build_row(number)
+        latest = self._build_row()
+        if (then is None) or (latest is None):
+            return None
+        if then[0] == latest[0]:
+            return ([], [])
+
+        added = []
+        removed = []
+        for warning, change in self.connection.execute(
+                'SELECT warning, SUM(CASE WHEN build_key = ? THEN 1 ELSE -1 END) AS change '
+                'FROM warnings WHERE build_key IN (?, ?) '
+                'GROUP BY warning HAVING change != 0 ORDER BY warning',
+                (latest[0], latest[0], then[0])):
+            if change > 0:
+                added.extend([warning] * change)
+            else:
+                removed.extend([warning] * -change)
+
+        return (added, removed)
+
+    def reset(self):
+        if self.config.all_steps:
+            # the builds of every step
+            query = ('SELECT build_key FROM builds '
+                     'WHERE project = ? AND config = ? AND branch = ? AND step > 0',
+                     self.combination[:3])
+        else:
+            query = ('SELECT build_key FROM builds '
+                     'WHERE project = ? AND config = ? AND branch = ? AND step = ?',
+                     self.combination)
+
+        with self.connection:
+            for build_key, in self.connection.execute(*query).fetchall():
+                self._delete(build_key)
+
+    def _delete(self, build_key):
+        self.connection.execute('DELETE FROM warnings WHERE build_key = ?', (build_key,))
+        self.connection.execute('DELETE FROM builds WHERE build_key = ?', (build_key,))
+
+    def __str__(self):
+        return 'sqlite:%s [%s/%s/%s]' % ((self.database_path,) + self.combination[:3])
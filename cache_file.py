@@ -1,224 +1,590 @@
-# pylint: disable=missing-docstring
-# pylint: disable=missing-docstring
-# pylint: disable=bad-whitespace
-# pylint: disable=too-many-instance-attributes
-# Classes may contain as many instance attributes required to perform their function
-
-import os
-import re
-import sys
-import tempfile
-
-from ftplib import FTP
-
-from constants import FileModes
-from dropbox import Dropbox
-
-#-------------------------------------------------------------------------#
-#     App: TeamCity9 Warning Watcher                                      #
-#  Module: cache_file.py                                                  #
-#  Author: Bob Hood                                                       #
-# License: LGPL-3.0                                                       #
-#   PyVer: 2.7.x                                                          #
-#  Detail: This module houses a class that takes responsibility for       #
-#          managing the cache file, abstracting away its true location.   #
-#-------------------------------------------------------------------------#
-
-class CacheFile(object):
-
-    def __init__(self, config, path=tempfile.gettempdir()):
-        super(CacheFile, self).__init__()
-        self.config = config
-
-        # we do not use the agent name in the file.  this
-        # would prevent multiple different agents from
-        # accessing/updating the same cache file.
-
-        self.cache_file_name = '%s_%s_%s.pickle' % \
-                                (config.teamcity.project_name,
-                                 config.teamcity.config_name,
-                                 config.teamcity.branch_name)
-
-        self.local_file = None
-        self.local_file_fp = None
-        self.local_file_open_state = FileModes.CLOSED
-
-        self.path = path
-
-        self.ftp = None
-        self.ftp_username = None
-        self.ftp_password = None
-        self.ftp_address = None
-        self.ftp_path = None
-        self.ftp_display = None
-
-        self.dropbox = None
-
-        temp_folder = tempfile.gettempdir()
-        self.local_file = os.path.join(temp_folder, self.cache_file_name)
-
-        if self.path.startswith('ftp://'):
-            # open the FTP connection
-            if not self._connect_to_ftp():
-                print 'Warning: FTP cache folder could not be accessed: "%s"' % self.path
-                print 'Warning: Defaulting to local file: "%s"' % self.local_file
-            else:
-                self.reset()
-
-        elif self.path.startswith('dropbox:'):
-            self.dropbox = Dropbox(self.path)
-            if not self.dropbox.available():
-                print 'Warning: Dropbox could not be accessed: "%s"' % self.path
-                print 'Warning: Defaulting to local file: "%s"' % self.local_file
-                self.dropbox = None
-
-        else:
-            if not os.path.exists(self.path):
-                # make sure the full path to the cache folder exists
-                try:
-                    os.makedirs(self.path)
-                except:
-                    pass
-
-            if not os.path.exists(self.path):
-                print 'Error: Cache folder does not exist: "%s"' % self.path
-                sys.exit(1)
-
-            self.local_file = os.path.join(self.path, self.cache_file_name)
-
-    def __del__(self):
-        if self.ftp:
-            self.ftp.close()
-            if os.path.exists(self.local_file):
-                os.remove(self.local_file)
-
-    def reset(self):
-        if os.path.exists(self.local_file):
-            os.remove(self.local_file)
-
-    def open(self, mode=FileModes.READ_ONLY):
-        if mode not in [FileModes.READ_ONLY, FileModes.WRITE_ONLY]:
-            return None
-
-        self.local_file_open_state = mode
-        self.local_file_fp = None
-
-        if self.ftp:
-            if not os.path.exists(self.local_file):
-                if not self._retrieve_pickle_file():
-                    return None
-
-            try:
-                self.local_file_fp = open(self.local_file,
-                                          'rb' if mode == FileModes.READ_ONLY else 'wb')
-            except:
-                self.local_file_fp = None
-
-        elif self.dropbox:
-            self.local_file_fp = self.dropbox.open(self.cache_file_name, mode)
-
-        else:
-            try:
-                self.local_file_fp = open(self.local_file,
-                                          'rb' if mode == FileModes.READ_ONLY else 'wb')
-            except:
-                self.local_file_fp = None
-
-        return self.local_file_fp
-
-    def close(self):
-        if self.ftp:
-            if (not os.path.exists(self.local_file)) or (not self.local_file_fp):
-                return
-
-            try:
-                self.local_file_fp.close()
-            except:
-                pass
-            self.local_file_fp = None
-
-            if self.local_file_open_state == FileModes.WRITE_ONLY:
-                # upload the (presumably) updated cache file
-                if not self._store_pickle_file():
-                    print 'Error: Could not store cache file to FTP'
-                    sys.exit(1)
-                else:
-                    self.reset()
-
-        elif self.dropbox:
-            self.dropbox.close()
-            self.local_file_fp = None
-
-        else:
-            try:
-                self.local_file_fp.close()
-            except:
-                pass
-            self.local_file_fp = None
-
-    def _retrieve_pickle_file(self):
-        if self.ftp:
-            files = []
-            self.ftp.retrlines('NLST', files.append)
-            if self.cache_file_name in files:
-                try:
-                    self.ftp.retrbinary('RETR %s' % self.cache_file_name,
-                                        open(self.local_file, 'wb').write)
-                except:
-                    return False
-
-        return True
-
-    def _store_pickle_file(self):
-        if self.ftp:
-            with open(self.local_file, 'rb') as local_file_input:
-                try:
-                    self.ftp.storbinary('STOR %s' % self.cache_file_name, local_file_input)
-                except:
-                    return False
-
-        return True
-
-    def _connect_to_ftp(self):
-        result = re.search(r'^ftp:\/\/([\da-z]+):([^\@]+)\@([^\/\s]+)\/(.+)$', self.path)
-        if not result:
-            return False
-
-        self.ftp_username = result.group(1)
-        self.ftp_password = result.group(2)
-        self.ftp_address = result.group(3)
-        self.ftp_path = result.group(4)
-
-        # take the username/password info out of any displayed value
-        self.ftp_display = 'ftp://%s/%s' % (self.ftp_address, self.ftp_path)
-
-        try:
-            self.ftp = FTP(self.ftp_address)
-        except:
-            self.ftp = None
-            return False
-
-        try:
-            self.ftp.login(self.ftp_username, self.ftp_password)
-        except:
-            self.ftp.close()
-            self.ftp = None
-            return False
-
-        #print self.ftp.getwelcome()
-
-        try:
-            self.ftp.cwd(self.ftp_path)
-        except:
-            self.ftp.close()
-            self.ftp = None
-            return False
-
-        return True
-
-    def __str__(self):
-        if self.ftp:
-            return '%s/%s' % (self.ftp_display, self.cache_file_name)
-        if self.dropbox:
-            return str(self.dropbox)
-        return os.path.join(os.path.abspath(self.path), self.cache_file_name)
+# pylint: disable=missing-docstring
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+# pylint: disable=too-many-instance-attributes
+# Classes may contain as many instance attributes required to perform their function
+
+import os
+import re
+import sys
+import errno
+import time
+import tempfile
+
+from constants import FileModes
+from cache_mirror import CacheMirror
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: cache_file.py                                                  #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module houses a class that takes responsibility for       #
+#          managing the cache file, abstracting away its true location.   #
+#-------------------------------------------------------------------------#
+
+# Several agents may share one cache file, so writes are optimistic: the
+# version of the cache file (a token that changes whenever the file does)
+# is noted when it is read, and a write only goes through if the cache file
+# is still at that version.  Otherwise, close() reports the conflict, and
+# the caller re-reads the cache and decides what to do.  The version is:
+#
+#    local   : the file's inode, size and modification time, checked while
+#              holding a lock file
+#    FTP     : the file's MDTM and SIZE (FTP cannot lock or swap a file,
+#              so this only narrows the window to the check and the upload)
+#    Dropbox : the file's revision, given as the 'parent_rev' of the upload
+#
+# The modules behind each kind of cache (ftplib, the Dropbox client,
+# sqlite3) are only loaded for the kind in use, and an FTP server is only
+# connected to when the cache is first used, so a step that never gets as
+# far as the cache (e.g., its build is not in the logs) does not wait on it.
+
+LOCKTIMEOUT = 30.0      # seconds to wait for another agent's lock
+LOCKEXPIRY = 120.0      # seconds after which a lock is assumed abandoned
+
+class CacheFile(object):
+
+    def __init__(self, config, path=tempfile.gettempdir()):
+        super(CacheFile, self).__init__()
+        self.config = config
+
+        # we do not use the agent name in the file.  this
+        # would prevent multiple different agents from
+        # accessing/updating the same cache file.
+
+        self.cache_file_name = '%s_%s_%s.pickle' % \
+                                (config.teamcity.project_name,
+                                 config.teamcity.config_name,
+                                 config.teamcity.branch_name)
+
+        self.local_file = None
+        self.local_file_fp = None
+        self.local_file_open_state = FileModes.CLOSED
+
+        # the version of the cache file when it was last read (None if it
+        # did not exist); writes are unconditional if it was never read
+        self.version = None
+        self.version_known = False
+
+        self.path = path
+
+        self.ftp = None
+        self.ftp_pending = False    # the FTP connection is yet to be opened
+        self.ftp_username = None
+        self.ftp_password = None
+        self.ftp_address = None
+        self.ftp_path = None
+        self.ftp_display = None
+
+        self.dropbox = None
+        self.database = None
+
+        # bytes sent to, and received from, a remote (FTP) cache
+        self.bytes_transferred = 0
+
+        # remote caches are copied into a persistent local mirror, which
+        # is only transferred again when the remote file has changed
+        self.mirror = None
+
+        temp_folder = tempfile.gettempdir()
+        self.local_file = os.path.join(temp_folder, self.cache_file_name)
+
+        if self.path.startswith('ftp://'):
+            # the connection is opened by _connect()
+            if self._parse_ftp_path():
+                self.mirror = CacheMirror(self.ftp_display, self.cache_file_name)
+                self.local_file = self.mirror.file_name
+                self.ftp_pending = True
+            else:
+                print 'Warning: FTP cache folder could not be accessed: "%s"' % self.path
+                self._use_stale_mirror()
+
+        elif self.path.startswith('dropbox:'):
+            from dropbox import Dropbox
+
+            # (the App access token is left out of the mirror's identity)
+            self.mirror = CacheMirror('dropbox:%s' % self.path.split(':', 2)[-1],
+                                      self.cache_file_name)
+            with config.timer.phase('transfer'):
+                self.dropbox = Dropbox(self.path, mirror=self.mirror,
+                                       stale_limit=config.stale_if_error)
+            if self.dropbox.available():
+                self.local_file = self.mirror.file_name
+            else:
+                print 'Warning: Dropbox could not be accessed: "%s"' % self.path
+                self.dropbox = None
+                self._use_stale_mirror()
+
+        elif self.path.startswith('sqlite:'):
+            # builds are read and written through the database, rather
+            # than through open()/close()
+            from cache_database import CacheDatabase
+
+            self.database = CacheDatabase(config, self.path[len('sqlite:'):])
+            if not self.database.connect():
+                print 'Warning: SQLite cache could not be opened: "%s"' % self.path
+                print 'Warning: Defaulting to local file: "%s"' % self.local_file
+                self.database = None
+
+        else:
+            if not os.path.exists(self.path):
+                # make sure the full path to the cache folder exists
+                try:
+                    os.makedirs(self.path)
+                except:
+                    pass
+
+            if not os.path.exists(self.path):
+                print 'Error: Cache folder does not exist: "%s"' % self.path
+                sys.exit(1)
+
+            self.local_file = os.path.join(self.path, self.cache_file_name)
+
+    def __del__(self):
+        if self.database:
+            self.database.close()
+
+        if self.ftp:
+            self.ftp.close()
+
+    def local_folder(self):
+        if self.database:
+            return self.database.local_folder()
+        return os.path.dirname(self.local_file)
+
+    def is_local(self):
+        # the cache file lives where we use it (it is not a copy of a
+        # remote file)
+        self._connect()
+        return (self.ftp is None) and (self.dropbox is None) and (self.database is None)
+
+    def version_token(self):
+        """
+        The version of the cache file as of the last read or write of it,
+        or None if that is not known.
+        """
+        if self.dropbox:
+            return self.dropbox.rev if self.dropbox.rev_known else None
+        return self.version if self.version_known else None
+
+    def transferred(self):
+        """
+        The number of bytes sent to, and received from, a remote cache.
+        """
+        if self.dropbox:
+            return self.bytes_transferred + self.dropbox.bytes_transferred
+        return self.bytes_transferred
+
+    def _use_stale_mirror(self):
+        # the remote cannot be reached, so work from the mirror of it if
+        # that is recent enough; otherwise, from a local file
+        if (self.mirror is None) or \
+           (not self.mirror.usable_when_stale(self.config.stale_if_error)):
+            self.mirror = None
+            print 'Warning: Defaulting to local file: "%s"' % self.local_file
+            return False
+
+        self.local_file = self.mirror.file_name
+        print 'Warning: Using the local copy last matched %d seconds ago: "%s"' % \
+            (int(self.mirror.age()), self.local_file)
+        return True
+
+    def reset(self):
+        self._connect()
+        if self.database:
+            self.database.reset()
+            return
+
+        if self.mirror:
+            self.mirror.discard()
+            return
+
+        if os.path.exists(self.local_file):
+            os.remove(self.local_file)
+
+    def open(self, mode=FileModes.READ_ONLY):
+        if mode not in [FileModes.READ_ONLY, FileModes.WRITE_ONLY, FileModes.APPEND]:
+            return None
+        if self.database:
+            return None
+
+        self._connect()
+        self.local_file_open_state = mode
+        self.local_file_fp = None
+
+        if self.dropbox:
+            with self.config.timer.phase('transfer'):
+                self.local_file_fp = self.dropbox.open(self.cache_file_name, mode)
+            return self.local_file_fp
+
+        if mode == FileModes.READ_ONLY:
+            if self.ftp:
+                with self.config.timer.phase('transfer'):
+                    retrieved = self._retrieve_pickle_file()
+                if not retrieved:
+                    return None
+            else:
+                self.version = self._local_version()
+                self.version_known = True
+
+            try:
+                self.local_file_fp = open(self.local_file, 'rb')
+            except:
+                self.local_file_fp = None
+
+        else:
+            # a new cache file is written alongside the current one, and
+            # only replaces it once complete (and, for a remote cache,
+            # uploaded), so any process that has the current one open (or
+            # mapped) continues to see a whole file.  likewise, anything
+            # appended is only added to the cache file on close.
+            try:
+                self.local_file_fp = open(self._temp_file_name()
+                                          if mode == FileModes.WRITE_ONLY
+                                          else self._append_file_name(), 'wb')
+            except:
+                self.local_file_fp = None
+
+        return self.local_file_fp
+
+    def close(self):
+        """
+        Closes the cache file, committing anything written to it.  Returns
+        False if that was abandoned because the cache file was changed by
+        someone else since we read it.
+        """
+        if self.database:
+            return True
+
+        if self.dropbox:
+            self.local_file_fp = None
+            with self.config.timer.phase('transfer'):
+                return self.dropbox.close()
+
+        if not self.local_file_fp:
+            return True
+
+        try:
+            self.local_file_fp.close()
+        except:
+            pass
+        self.local_file_fp = None
+
+        if self.local_file_open_state == FileModes.READ_ONLY:
+            return True
+
+        if self.local_file_open_state == FileModes.WRITE_ONLY:
+            pending_file = self._temp_file_name()
+        else:
+            pending_file = self._append_file_name()
+
+        try:
+            if self.ftp:
+                with self.config.timer.phase('transfer'):
+                    committed = self._commit_remote(pending_file)
+            else:
+                committed = self._commit_local(pending_file)
+        finally:
+            if os.path.exists(pending_file):
+                os.remove(pending_file)
+
+        if committed and self.mirror and (not self.ftp):
+            # we are working from a stale mirror (the remote could not
+            # be reached), which now holds changes the remote lacks
+            self.mirror.invalidate()
+
+        return committed
+
+    def _commit_remote(self, pending_file):
+        from ftplib import all_errors
+
+        try:
+            current = self._ftp_validator()
+        except all_errors:
+            current = None
+            if self.version_known:
+                print 'Error: Could not check the cache file on FTP'
+                sys.exit(1)
+
+        if self.version_known and (current != self.version):
+            return False
+
+        if self.local_file_open_state == FileModes.APPEND:
+            if not self._append_pickle_file():
+                print 'Error: Could not append to cache file on FTP'
+                sys.exit(1)
+        else:
+            # upload the (presumably) updated cache file
+            if not self._store_pickle_file():
+                print 'Error: Could not store cache file to FTP'
+                sys.exit(1)
+
+        self.version = self.mirror.validator
+        self.version_known = self.version is not None
+        return True
+
+    def _commit_local(self, pending_file):
+        try:
+            locked = self._lock()
+        except OSError, error_object:
+            print 'Error: Could not lock cache file "%s": %s' % \
+                (self.local_file, str(error_object))
+            sys.exit(1)
+        if not locked:
+            print 'Error: Could not lock cache file "%s"' % self.local_file
+            sys.exit(1)
+
+        try:
+            if self.version_known and (self._local_version() != self.version):
+                return False
+
+            if self.local_file_open_state == FileModes.APPEND:
+                # appending never disturbs what is already in the file
+                with open(self.local_file, 'ab') as local_output:
+                    with open(pending_file, 'rb') as pending_input:
+                        while True:
+                            data = pending_input.read(1024 * 1024)
+                            if not data:
+                                break
+                            local_output.write(data)
+            elif not self._replace_local_file(pending_file):
+                print 'Error: Could not replace cache file "%s"' % self.local_file
+                sys.exit(1)
+
+            self.version = self._local_version()
+            self.version_known = True
+        finally:
+            self._unlock()
+
+        return True
+
+    def _local_version(self):
+        try:
+            info = os.stat(self.local_file)
+        except OSError:
+            return None
+        return '%d %d %r' % (info.st_ino, info.st_size, info.st_mtime)
+
+    def _lock_file_name(self):
+        return '%s.lock' % self.local_file
+
+    def _lock(self):
+        """
+        Returns True once the lock is held, or False if another agent held
+        it for longer than LOCKTIMEOUT.  Raises OSError if the lock cannot
+        be taken for any other reason (e.g., the folder is not writable).
+        """
+        lock_file = self._lock_file_name()
+        give_up = time.time() + LOCKTIMEOUT
+        while True:
+            try:
+                os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except OSError, error_object:
+                if error_object.errno != errno.EEXIST:
+                    raise
+
+            try:
+                if (time.time() - os.path.getmtime(lock_file)) > LOCKEXPIRY:
+                    # whoever held it is long gone
+                    os.remove(lock_file)
+                    continue
+            except OSError:
+                # (it went away while we looked; we wait our turn as usual)
+                pass
+
+            if time.time() > give_up:
+                return False
+            time.sleep(0.1)
+
+    def _unlock(self):
+        try:
+            os.remove(self._lock_file_name())
+        except OSError:
+            pass
+
+    def _temp_file_name(self):
+        return '%s.%d.tmp' % (self.local_file, os.getpid())
+
+    def _append_file_name(self):
+        return '%s.%d.append' % (self.local_file, os.getpid())
+
+    def _replace_local_file(self, file_name):
+        try:
+            if sys.platform == 'win32':
+                # Windows will not rename over an existing file
+                if os.path.exists(self.local_file):
+                    os.remove(self.local_file)
+            os.rename(file_name, self.local_file)
+        except:
+            return False
+        return True
+
+    def _ftp_validator(self):
+        # the remote file's modification time and size, or None if it does
+        # not exist (yet)
+        from ftplib import error_perm
+
+        try:
+            modified = self.ftp.sendcmd('MDTM %s' % self.cache_file_name)
+        except error_perm:
+            return None
+        self.ftp.voidcmd('TYPE I')
+        size = self.ftp.size(self.cache_file_name)
+        return '%s %s' % (modified.split()[-1], size)
+
+    def _retrieve_pickle_file(self):
+        """
+        Brings the mirror up to date with the remote cache file, only
+        transferring the file if it has changed.  Returns False if there
+        is no cache file to be read.
+        """
+        if not self.ftp:
+            return True
+
+        from ftplib import all_errors
+
+        temp_file = self.mirror.temp_file_name()
+        self.version = None
+        self.version_known = False
+        try:
+            validator = self._ftp_validator()
+            self.version = validator
+            self.version_known = True
+            if validator is None:
+                self.mirror.discard()
+                return False
+
+            if not self.mirror.matches(validator):
+                with open(temp_file, 'wb') as local_output:
+                    self.ftp.retrbinary('RETR %s' % self.cache_file_name, local_output.write)
+                self.bytes_transferred += os.path.getsize(temp_file)
+                self.mirror.replace(temp_file, validator)
+        except all_errors + (OSError,), error_object:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            self.version_known = False
+            print 'Warning: FTP cache file could not be retrieved: %s' % str(error_object)
+            if not self.mirror.usable_when_stale(self.config.stale_if_error):
+                return False
+            print 'Warning: Using the local copy last matched %d seconds ago: "%s"' % \
+                (int(self.mirror.age()), self.local_file)
+
+        return True
+
+    def _store_pickle_file(self):
+        if self.ftp:
+            from ftplib import all_errors
+
+            with open(self._temp_file_name(), 'rb') as local_file_input:
+                try:
+                    self.ftp.storbinary('STOR %s' % self.cache_file_name, local_file_input)
+                except:
+                    return False
+            self.bytes_transferred += os.path.getsize(self._temp_file_name())
+
+            # what we uploaded is now the mirror of the remote file
+            try:
+                self.mirror.replace(self._temp_file_name(), self._ftp_validator())
+            except all_errors + (OSError,):
+                self.mirror.discard()
+
+        return True
+
+    def _append_pickle_file(self):
+        if self.ftp:
+            from ftplib import all_errors
+
+            with open(self._append_file_name(), 'rb') as local_file_input:
+                try:
+                    self.ftp.storbinary('APPE %s' % self.cache_file_name, local_file_input)
+                except:
+                    return False
+            self.bytes_transferred += os.path.getsize(self._append_file_name())
+
+            # bring the mirror along too, provided nobody else appended to
+            # the remote file in the meantime
+            try:
+                if self.mirror.validator is not None:
+                    with open(self.mirror.file_name, 'ab') as mirror_output:
+                        mirror_output.write(open(self._append_file_name(), 'rb').read())
+                validator = self._ftp_validator()
+                if (self.mirror.validator is not None) and (validator is not None) and \
+                   (int(validator.split()[-1]) == os.path.getsize(self.mirror.file_name)):
+                    self.mirror.update(validator)
+                else:
+                    self.mirror.discard()
+            except all_errors + (OSError,):
+                self.mirror.discard()
+
+        return True
+
+    def _parse_ftp_path(self):
+        result = re.search(r'^ftp:\/\/([\da-z]+):([^\@]+)\@([^\/\s]+)\/(.+)$', self.path)
+        if not result:
+            return False
+
+        self.ftp_username = result.group(1)
+        self.ftp_password = result.group(2)
+        self.ftp_address = result.group(3)
+        self.ftp_path = result.group(4)
+
+        # take the username/password info out of any displayed value
+        self.ftp_display = 'ftp://%s/%s' % (self.ftp_address, self.ftp_path)
+        return True
+
+    def _connect(self):
+        # opens the FTP connection, the first time the cache is used
+        if not self.ftp_pending:
+            return
+        self.ftp_pending = False
+
+        with self.config.timer.phase('transfer'):
+            connected = self._connect_to_ftp()
+        if not connected:
+            print 'Warning: FTP cache folder could not be accessed: "%s"' % self.path
+            self.local_file = os.path.join(tempfile.gettempdir(), self.cache_file_name)
+            self._use_stale_mirror()
+
+    def _connect_to_ftp(self):
+        from ftplib import FTP
+
+        try:
+            self.ftp = FTP(self.ftp_address, timeout=self.config.remote_timeout)
+        except:
+            self.ftp = None
+            return False
+
+        try:
+            self.ftp.login(self.ftp_username, self.ftp_password)
+        except:
+            self.ftp.close()
+            self.ftp = None
+            return False
+
+        #print self.ftp.getwelcome()
+
+        try:
+            self.ftp.cwd(self.ftp_path)
+        except:
+            self.ftp.close()
+            self.ftp = None
+            return False
+
+        return True
+
+    def __str__(self):
+        # (formatting the cache must not open the FTP connection, so one
+        # not yet opened is shown by its location)
+        if self.ftp or self.ftp_pending:
+            return '%s/%s' % (self.ftp_display, self.cache_file_name)
+        if self.dropbox:
+            return str(self.dropbox)
+        if self.database:
+            return str(self.database)
+        if self.mirror:
+            # standing in for an unreachable remote
+            return self.local_file
+        return os.path.join(os.path.abspath(self.path), self.cache_file_name)
@@ -0,0 +1,134 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import sys
+import md5
+import json
+import time
+import tempfile
+
+from daemon_client import user_folder, make_user_folder, owned_by_user, private_to_user
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: cache_mirror.py                                                #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module keeps a persistent local copy of a remote (FTP or  #
+#          Dropbox) cache file, along with what is needed to tell         #
+#          cheaply whether the remote file has changed since.             #
+#-------------------------------------------------------------------------#
+
+MIRRORFOLDER = 'tcww_mirror'
+
+class CacheMirror(object):
+    """
+    A local copy of a remote cache file.  The 'validator' is an opaque
+    string describing the remote file when it was copied (e.g., its FTP
+    modification time and size, or its Dropbox revision); if the remote
+    still reports the same validator, the copy can be used as-is.
+    """
+    def __init__(self, remote_location, cache_file_name):
+        super(CacheMirror, self).__init__()
+
+        # the copy is trusted without reading the remote file, so it is
+        # kept where no one else can put one of their own in its place
+        folder = os.path.join(user_folder(), MIRRORFOLDER)
+        if make_user_folder() and (not os.path.isdir(folder)):
+            try:
+                os.mkdir(folder, 0700)
+            except OSError:
+                pass
+        if not (private_to_user(user_folder()) and private_to_user(folder)):
+            print 'Warning: The cache mirror folder "%s" does not belong to this ' \
+                  'user alone; the remote cache will be copied afresh.' % folder
+            # (one of our own, which is left behind)
+            folder = tempfile.mkdtemp(prefix='tcww_mirror_')
+
+        # the remote location (without credentials) distinguishes mirrors
+        # of identically-named cache files kept in different places
+
+        self.file_name = os.path.join(folder, '%s_%s' % \
+                                      (md5.new(remote_location).hexdigest()[:12],
+                                       cache_file_name))
+        self.meta_file = '%s.meta' % self.file_name
+
+        self.validator = None   # describes the remote file the copy matches
+        self.checked = None     # when the copy was last known to match
+
+        if owned_by_user(self.meta_file):
+            try:
+                with open(self.meta_file) as meta_input:
+                    meta = json.load(meta_input)
+                self.validator = meta['validator']
+                self.checked = meta['checked']
+            except:
+                self.validator = None
+                self.checked = None
+
+    def exists(self):
+        # (a copy that is not ours is as good as none)
+        return owned_by_user(self.file_name)
+
+    def matches(self, validator):
+        return (validator is not None) and \
+               (self.validator == validator) and \
+               self.exists()
+
+    def age(self):
+        if self.checked is None:
+            return None
+        return time.time() - self.checked
+
+    def usable_when_stale(self, stale_limit):
+        """
+        True if the copy may stand in for an unreachable remote: it must
+        have matched the remote no more than 'stale_limit' seconds ago.
+        """
+        age = self.age()
+        return (stale_limit > 0) and \
+               (age is not None) and \
+               (age <= stale_limit) and \
+               self.exists()
+
+    def temp_file_name(self):
+        return '%s.%d.tmp' % (self.file_name, os.getpid())
+
+    def replace(self, file_name, validator):
+        """
+        Moves the freshly transferred 'file_name' into place as the copy
+        of the remote file described by 'validator'.
+        """
+        if sys.platform == 'win32':
+            # Windows will not rename over an existing file
+            if os.path.exists(self.file_name):
+                os.remove(self.file_name)
+        os.rename(file_name, self.file_name)
+        self.update(validator)
+
+    def update(self, validator):
+        self.validator = validator
+        self.checked = time.time()
+        self._write_meta()
+
+    def invalidate(self):
+        # the copy no longer matches any remote file, but still holds the
+        # most recent baseline we know of
+        self.validator = None
+        self._write_meta()
+
+    def discard(self):
+        for file_name in [self.file_name, self.meta_file]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        self.validator = None
+        self.checked = None
+
+    def _write_meta(self):
+        try:
+            with open(self.meta_file, 'w') as meta_output:
+                json.dump({'validator' : self.validator, 'checked' : self.checked}, meta_output)
+        except IOError:
+            pass
@@ -1,282 +1,527 @@
-# pylint: disable=missing-docstring
-# pylint: disable=missing-docstring
-# pylint: disable=bad-whitespace
-
-import os
-import re
-import sys
-import socket
-
-from optparse import OptionParser
-import xml.dom.minidom as minidom
-
-from cache_file import CacheFile
-
-#-------------------------------------------------------------------------#
-#     App: TeamCity9 Warning Watcher                                      #
-#  Module: config.py                                                      #
-#  Author: Bob Hood                                                       #
-# License: LGPL-3.0                                                       #
-#   PyVer: 2.7.x                                                          #
-#  Detail: This module is responsible for reading in the TCWW             #
-#          configurations and establishing the environment they directs.  #
-#-------------------------------------------------------------------------#
-
-class TeamCity(object):
-    MICROSOFT, GCC = range(2)
-
-    def __init__(self):
-        self.agent_name = None
-        self.project_name = None
-        self.config_name = None
-        self.branch_name = None
-        self.build_number = 0
-        self.build_step = 0
-
-        self.build_agent_path = None
-        self.build_agent_log_path = None
-
-        self.warning_text = None
-        self.warning_regex = None
-        self.warning_format = None
-        self.warning_format_regex = [".+\\((\\d+)\\) : warning C\\d+:",
-                                     ".+:(\\d+):(\\d+): warning: "]
-        #self.warning_compress = False
-
-        self.config_keys = []
-
-        # map with key being compound of Project, Config, BuildType, and value
-        # is a list of interested parties
-        self.interested_parties = {}
-
-        self.cache_ftp = None
-
-    def validate(self):
-        result = True
-        if not self.agent_name:
-            print "An agent name is required",
-            result = False
-        elif not self.project_name:
-            print "A project name is required",
-            result = False
-        elif not self.config_name:
-            print "A config name is required",
-            result = False
-        elif not self.branch_name:
-            print "A branch name is required",
-            result = False
-        elif self.build_number is 0:
-            print "A build number is required",
-            result = False
-        else:
-            if (self.warning_text is None) and \
-               (self.warning_regex is None) and \
-               (self.warning_format is None):
-                print "A warning pattern of some kind if required",
-                result = False
-
-        return result
-
-class Config(object):
-
-    # pylint: disable=too-many-instance-attributes
-    # This is a data-only class
-
-    # pylint: disable=too-few-public-methods
-    # This is a data-only class
-
-    def __init__(self):
-        # this is were previous scans are stored
-        self.cache_file = None
-
-        parser = OptionParser()
-        parser.add_option("-b", "--build-number", type="int", dest="build_number",
-                          metavar="<number>",
-                          default=0, help="The current build number.")
-        parser.add_option("-p", "--project", dest="project_name", default='',
-                          metavar="<project_name>",
-                          help="The name of the project being built.")
-        parser.add_option("-a", "--agent", dest="agent_name", default=socket.gethostname(),
-                          metavar="<agent_name>",
-                          help="The name of the build agent performing the build.")
-        parser.add_option("-S", "--build-step", type="int", dest="build_step",
-                          metavar="<build_step>",
-                          default=0, help="A specific build step to review for warnings.")
-        parser.add_option("-c", "--config-name", dest="config_name", default='',
-                          metavar="<config_name>",
-                          help="The name of the project configuration being built.")
-        parser.add_option("-B", "--branch-name", dest="branch_name", default='',
-                          metavar="<branch>",
-                          help="The branch being processed.")
-        parser.add_option("-e", "--inflations-are-errors", action="store_true",
-                          dest="inflations_are_errors", default=False,
-                          help="If new warnings (inflations) are detected, " \
-                                "the build will fail in TeamCity.")
-        parser.add_option("-i", "--report-deflation", action="store_true",
-                          dest="report_deflations", default=False,
-                          help="Warnings missing from the current builds " \
-                                "(deflations) are also reported.")
-        parser.add_option("-s", "--silence-inflation", action="store_true",
-                          dest="silence_inflations", default=False,
-                          help="New warnings detected are not reported " \
-                                "('inflations-are-errors' is still enforced).")
-        parser.add_option("-f", "--fail-on-fragment", action="append",
-                          dest="fail_on_fragment", default=[],
-                          metavar="<text_fragment>",
-                          help="If the specified text fragment is detected in " \
-                                "the build output, automatically fail the build.")
-        parser.add_option("-x", "--reset-cache", action="store_true",
-                          dest="reset_cache", default=False,
-                          help="Clear any previously saved cache before processing.")
-        parser.add_option("-D", "--debug", action="store_true",
-                          dest="debug_mode", default=False,
-                          help="Print extra processing information (will add to log output)")
-
-        (options, _) = parser.parse_args()
-
-        self.teamcity = TeamCity()
-        self.teamcity.agent_name = options.agent_name
-        self.teamcity.project_name = options.project_name
-        self.teamcity.config_name = options.config_name
-        self.teamcity.branch_name = options.branch_name
-        self.teamcity.build_number = int(options.build_number)
-        self.teamcity.build_step = int(options.build_step)
-
-        self.inflations_are_errors = options.inflations_are_errors
-        self.report_deflations = options.report_deflations
-        self.silence_inflations = options.silence_inflations
-        self.fail_on_fragment = options.fail_on_fragment
-
-        self.reset_cache = options.reset_cache
-
-        self.debug_mode = options.debug_mode
-
-        self.teamcity.config_keys.append(options.project_name)
-        self.teamcity.config_keys.append('%s_%s' % (options.project_name, options.config_name))
-
-        self._read_config()
-
-        if not self.teamcity.validate():
-            print '; disabling WarningWatcher'
-            self.config_file = None
-
-        self.working_prefix = os.getcwd().lower()
-        if 'build_system' in self.working_prefix:
-            ndx = self.working_prefix.index('build_system')
-            self.working_prefix = self.working_prefix[:ndx - 1]
-        else:
-            self.working_prefix = None
-
-    def _dump_dir(self, path, indent=0):
-        for file_name in os.listdir(path):
-            file_path = os.path.join(path, file_name)
-            print '%s%s' % (' ' * indent, file_path)
-            if os.path.isdir(file_path):
-                self._dump_dir(file_path, indent + 2)
-
-    def _read_config(self):
-        self.config_file = os.path.join(os.path.split(os.path.realpath(__file__))[0],
-                                        'builders_conf', '%s.xml' % self.teamcity.agent_name)
-        if not os.path.exists(self.config_file):
-            # see if we can access them using the environment
-            if 'WWBLDRCFG' in os.environ:
-                self.config_file = os.path.join(os.environ['WWBLDRCFG'], '%s.xml' % \
-                    self.teamcity.agent_name)
-            if not os.path.exists(self.config_file):
-                self.config_file = None
-                return
-
-        dom = minidom.parse(self.config_file)
-        settings_node = dom.getElementsByTagName("Settings")[0]
-        counter = 0
-        while counter < len(settings_node.childNodes):
-            child1 = settings_node.childNodes[counter]
-            if child1.nodeType == child1.ELEMENT_NODE:
-                if child1.tagName == 'Cache':
-                    self.cache_file = CacheFile(self, child1.getAttribute('value').strip())
-                elif child1.tagName == 'AgentPath':
-                    self.teamcity.build_agent_path = \
-                        os.path.normpath(child1.getAttribute('value').strip())
-                    if not os.path.exists(self.teamcity.build_agent_path):
-                        print 'Error: TeamCity BuildAgent path cannot be accessed: "%s"' % \
-                            self.teamcity.build_agent_path
-                        sys.exit(1)
-                    self.teamcity.build_agent_log_path = \
-                        os.path.join(self.teamcity.build_agent_path, 'logs')
-                    if not os.path.exists(self.teamcity.build_agent_log_path):
-                        print 'Error: TeamCity BuildAgent log path cannot be accessed: "%s"' % \
-                            self.teamcity.build_agent_log_path
-                        sys.exit(1)
-                elif child1.tagName == 'WarningText':
-                    self.teamcity.warning_text = child1.getAttribute('value')
-                elif child1.tagName == 'WarningRegex':
-                    try:
-                        self.teamcity.warning_regex = re.compile('(%s)' % \
-                            child1.getAttribute('value'))
-                    except:
-                        print 'Error: TeamCity BuildAgent warning pattern ' \
-                              'cannot be compiled: "%s"' % \
-                            child1.getAttribute('value')
-                        sys.exit(1)
-                elif child1.tagName == 'WarningFormat':
-                    compiler_type = child1.getAttribute('value').lower()
-                    if compiler_type not in ['microsoft', 'visualstudio', 'gcc']:
-                        print 'Error: TeamCity BuildAgent warning type unrecognized: "%s"' % \
-                            child1.getAttribute('value')
-                        sys.exit(1)
-                    if compiler_type in ['microsoft', 'visualstudio']:
-                        self.teamcity.warning_format = TeamCity.MICROSOFT
-                    else:
-                        self.teamcity.warning_format = TeamCity.GCC
-            counter += 1
-
-        if self.teamcity.warning_text and self.teamcity.warning_regex:
-            print 'Error: Only one of "WarningText" or "WarningRegex" ' \
-                  'can be defined for Agent "%s"' % \
-                        self.teamcity.agent_name
-            sys.exit(1)
-
-        if self.cache_file is None:
-            # put them in the system temp folder
-            self.cache_file = CacheFile(self)
-
-        ip_key = self.teamcity.project_name
-        self.teamcity.interested_parties[ip_key] = []
-
-        project_config_file = os.path.join(os.path.split(os.path.realpath(__file__))[0],
-                                           'builders_conf', '%s_%s.xml' % \
-                                               (self.teamcity.agent_name,
-                                                self.teamcity.project_name))
-        if os.path.exists(project_config_file):
-            dom = minidom.parse(project_config_file)
-            settings_node = dom.getElementsByTagName("Settings")[0]
-            counter = 0
-            while counter < len(settings_node.childNodes):
-                child1 = settings_node.childNodes[counter]
-                if child1.nodeType == child1.ELEMENT_NODE:
-                    if child1.tagName == 'InterestedParties':
-                        self.teamcity.interested_parties[ip_key] += [
-                            t.strip().encode('ascii') for t in \
-                                child1.firstChild.data.split(',')]
-                counter += 1
-
-        ip_key = '%s_%s' % (self.teamcity.project_name, self.teamcity.config_name)
-        self.teamcity.interested_parties[ip_key] = []
-
-        project_config_file = os.path.join(os.path.split(os.path.realpath(__file__))[0], \
-            'builders_conf', '%s_%s_%s.xml' % \
-                (self.teamcity.agent_name,
-                 self.teamcity.project_name,
-                 self.teamcity.config_name))
-        if os.path.exists(project_config_file):
-            dom = minidom.parse(project_config_file)
-            settings_node = dom.getElementsByTagName("Settings")[0]
-            counter = 0
-            while counter < len(settings_node.childNodes):
-                child1 = settings_node.childNodes[counter]
-                if child1.nodeType == child1.ELEMENT_NODE:
-                    if child1.tagName == 'InterestedParties':
-                        self.teamcity.interested_parties[ip_key] += [
-                            t.strip().encode('ascii') for t in \
-                                child1.firstChild.data.split(',')]
-                counter += 1
+# pylint: disable=missing-docstring
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import re
+import sys
+import md5
+import json
+import socket
+
+from optparse import OptionParser
+
+from cache_file import CacheFile
+from build_journal import JOURNALLIMIT
+from phase_timer import PhaseTimer
+from daemon_client import user_folder, make_user_folder, private_to_user
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: config.py                                                      #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module is responsible for reading in the TCWW             #
+#          configurations and establishing the environment they directs.  #
+#-------------------------------------------------------------------------#
+
+# the builders_conf/ folder is found relative to the code.  this is settled
+# when the module is loaded, as the watcher daemon changes into the working
+# folder of each step that it runs.
+APP_FOLDER = os.path.split(os.path.realpath(__file__))[0]
+
+# the settings read from the builders_conf/ files are kept in a snapshot,
+# which is used in place of the files for as long as none of them changes
+SNAPSHOTVERSION = 2
+
+def _file_signature(file_name):
+    # what tells us that a file has changed (None if it does not exist)
+    try:
+        info = os.stat(file_name)
+    except OSError:
+        return None
+    return (info.st_mtime, info.st_size)
+
+class TeamCity(object):
+    MICROSOFT, GCC = range(2)
+
+    def __init__(self):
+        self.agent_name = None
+        self.project_name = None
+        self.config_name = None
+        self.branch_name = None
+        self.build_number = 0
+        self.build_step = 0
+
+        self.build_agent_path = None
+        self.build_agent_log_path = None
+
+        self.warning_text = None
+        self.warning_regex = None
+        self.warning_format = None
+        self.warning_format_regex = [re.compile(".+\\((\\d+)\\) : warning C\\d+:"),
+                                     re.compile(".+:(\\d+):(\\d+): warning: ")]
+        # a literal fragment every warning of the format contains; it
+        # is far cheaper to test for than the expression is to evaluate
+        self.warning_format_prefilter = [") : warning C",
+                                         ": warning: "]
+        #self.warning_compress = False
+
+        self.config_keys = []
+
+        # map with key being compound of Project, Config, BuildType, and value
+        # is a list of interested parties
+        self.interested_parties = {}
+
+        self.cache_ftp = None
+
+    def validate(self):
+        result = True
+        if not self.agent_name:
+            print "An agent name is required",
+            result = False
+        elif not self.project_name:
+            print "A project name is required",
+            result = False
+        elif not self.config_name:
+            print "A config name is required",
+            result = False
+        elif not self.branch_name:
+            print "A branch name is required",
+            result = False
+        elif self.build_number is 0:
+            print "A build number is required",
+            result = False
+        else:
+            if (self.warning_text is None) and \
+               (self.warning_regex is None) and \
+               (self.warning_format is None):
+                print "A warning pattern of some kind if required",
+                result = False
+
+        return result
+
+class Config(object):
+
+    # pylint: disable=too-many-instance-attributes
+    # This is a data-only class
+
+    # pylint: disable=too-few-public-methods
+    # This is a data-only class
+
+    def __init__(self, argv=None):
+        # where the time of the step goes (see phase_timer.py)
+        self.timer = PhaseTimer()
+        self.timer.start('config')
+
+        # this is were previous scans are stored
+        self.cache_file = None
+
+        # this is where local working state (e.g., the build index) is kept
+        self.state_path = None
+
+        parser = OptionParser()
+        parser.add_option("-b", "--build-number", type="int", dest="build_number",
+                          metavar="<number>",
+                          default=0, help="The current build number.")
+        parser.add_option("-p", "--project", dest="project_name", default='',
+                          metavar="<project_name>",
+                          help="The name of the project being built.")
+        parser.add_option("-a", "--agent", dest="agent_name", default=socket.gethostname(),
+                          metavar="<agent_name>",
+                          help="The name of the build agent performing the build.")
+        parser.add_option("-S", "--build-step", type="int", dest="build_step",
+                          metavar="<build_step>",
+                          default=0, help="A specific build step to review for warnings.")
+        parser.add_option("-A", "--all-steps", action="store_true",
+                          dest="all_steps", default=False,
+                          help="Review every step of the build in one pass, each " \
+                                "against its own cached baseline.")
+        parser.add_option("-c", "--config-name", dest="config_name", default='',
+                          metavar="<config_name>",
+                          help="The name of the project configuration being built.")
+        parser.add_option("-B", "--branch-name", dest="branch_name", default='',
+                          metavar="<branch>",
+                          help="The branch being processed.")
+        parser.add_option("-e", "--inflations-are-errors", action="store_true",
+                          dest="inflations_are_errors", default=False,
+                          help="If new warnings (inflations) are detected, " \
+                                "the build will fail in TeamCity.")
+        parser.add_option("-i", "--report-deflation", action="store_true",
+                          dest="report_deflations", default=False,
+                          help="Warnings missing from the current builds " \
+                                "(deflations) are also reported.")
+        parser.add_option("-s", "--silence-inflation", action="store_true",
+                          dest="silence_inflations", default=False,
+                          help="New warnings detected are not reported " \
+                                "('inflations-are-errors' is still enforced).")
+        parser.add_option("-f", "--fail-on-fragment", action="append",
+                          dest="fail_on_fragment", default=[],
+                          metavar="<text_fragment>",
+                          help="If the specified text fragment is detected in " \
+                                "the build output, automatically fail the build.")
+        parser.add_option("--fail-on-fragment-file", action="append",
+                          dest="fail_on_fragment_files", default=[],
+                          metavar="<file>",
+                          help="Read text fragments for '--fail-on-fragment' from the " \
+                                "specified file, one per line ('#' starts a comment line).")
+        parser.add_option("-x", "--reset-cache", action="store_true",
+                          dest="reset_cache", default=False,
+                          help="Clear any previously saved cache before processing.")
+        parser.add_option("-z", "--compress-cache", action="store_true",
+                          dest="compress_cache", default=False,
+                          help="Compress the cache file when it is written.")
+        parser.add_option("-m", "--map-cache", action="store_true",
+                          dest="map_cache", default=False,
+                          help="Memory-map a local, uncompressed cache file instead " \
+                                "of reading it, loading warnings only as needed.")
+        parser.add_option("-J", "--journal", action="store_true",
+                          dest="journal_cache", default=False,
+                          help="Keep the cache as a journal of per-build changes, " \
+                                "so each run only adds what changed.")
+        parser.add_option("--journal-limit", type="int", dest="journal_limit",
+                          default=JOURNALLIMIT, metavar="<count>",
+                          help="The number of builds journaled before the cache " \
+                                "is compacted into a new snapshot (default %d)." % \
+                                JOURNALLIMIT)
+        parser.add_option("--changes-since", type="int", dest="changes_since",
+                          default=None, metavar="<number>",
+                          help="Report the warnings added and removed since this " \
+                                "earlier build, as held in a SQLite cache, instead " \
+                                "of processing the build.")
+        parser.add_option("--stale-if-error", type="int", dest="stale_if_error",
+                          default=0, metavar="<seconds>",
+                          help="If a remote (FTP or Dropbox) cache cannot be reached, " \
+                                "use the local copy of it if it was current within " \
+                                "this many seconds (default 0: never).")
+        parser.add_option("--remote-timeout", type="int", dest="remote_timeout",
+                          default=60, metavar="<seconds>",
+                          help="How long to wait on a remote (FTP) cache before " \
+                                "giving up on it (default 60).")
+        parser.add_option("-N", "--no-build-index", action="store_false",
+                          dest="build_index", default=True,
+                          help="Do not use (or update) the persistent index of " \
+                                "build locations within the TeamCity logs.")
+        parser.add_option("-E", "--scan-engine", type="choice", dest="scan_engine",
+                          choices=['readline', 'mmap'], default='readline',
+                          metavar="<engine>",
+                          help="The engine used to scan the TeamCity logs: " \
+                                "'readline' (default) or 'mmap'.")
+        parser.add_option("-w", "--workers", type="int", dest="scan_workers",
+                          default=1, metavar="<count>",
+                          help="The number of processes that scan the TeamCity logs " \
+                                "(default 1; 0 uses one for each CPU).")
+        parser.add_option("-d", "--diff-engine", type="choice", dest="diff_engine",
+                          choices=['merge', 'difflib', 'fingerprint'], default='merge',
+                          metavar="<engine>",
+                          help="The engine used to compare warnings: 'merge' " \
+                                "(default), 'difflib' (WarningFormat only) or " \
+                                "'fingerprint' (requires NumPy).")
+        parser.add_option("--no-daemon", action="store_true",
+                          dest="no_daemon", default=False,
+                          help="Run the step in this process, even if the watcher " \
+                                "daemon is running.")
+        parser.add_option("--no-statistics", action="store_false",
+                          dest="report_statistics", default=True,
+                          help="Do not report the step's timings and counts to " \
+                                "TeamCity as build statistics.")
+        parser.add_option("--profile", dest="profile_file", default=None,
+                          metavar="<file>",
+                          help="Profile the step, and write the (cProfile) " \
+                                "statistics to this file.")
+        parser.add_option("--no-config-snapshot", action="store_false",
+                          dest="config_snapshot", default=True,
+                          help="Read the builders_conf/ files, rather than the " \
+                                "snapshot of the settings last read from them.")
+        parser.add_option("-D", "--debug", action="store_true",
+                          dest="debug_mode", default=False,
+                          help="Print extra processing information (will add to log output)")
+
+        # 'argv' defaults to our own command line (the watcher daemon
+        # passes in those of the steps it runs)
+        (options, _) = parser.parse_args(argv)
+
+        self.teamcity = TeamCity()
+        self.teamcity.agent_name = options.agent_name
+        self.teamcity.project_name = options.project_name
+        self.teamcity.config_name = options.config_name
+        self.teamcity.branch_name = options.branch_name
+        self.teamcity.build_number = int(options.build_number)
+        self.teamcity.build_step = int(options.build_step)
+        self.all_steps = options.all_steps
+
+        self.inflations_are_errors = options.inflations_are_errors
+        self.report_deflations = options.report_deflations
+        self.silence_inflations = options.silence_inflations
+        self.fail_on_fragment = options.fail_on_fragment
+        for file_name in options.fail_on_fragment_files:
+            self.fail_on_fragment.extend(self._read_fragments(file_name))
+
+        self.reset_cache = options.reset_cache
+        self.compress_cache = options.compress_cache
+        self.map_cache = options.map_cache
+        self.journal_cache = options.journal_cache
+        self.journal_limit = max(0, options.journal_limit)
+        self.changes_since = options.changes_since
+        self.stale_if_error = options.stale_if_error
+        self.remote_timeout = options.remote_timeout
+        self.build_index = options.build_index
+        self.scan_engine = options.scan_engine
+        self.scan_workers = max(0, options.scan_workers)
+        self.diff_engine = options.diff_engine
+        self.report_statistics = options.report_statistics
+        self.profile_file = options.profile_file
+        self.config_snapshot = options.config_snapshot
+
+        if self.all_steps:
+            if self.teamcity.build_step != 0:
+                print 'Error: A build step cannot be given with --all-steps'
+                sys.exit(1)
+            if self.journal_cache:
+                print 'Warning: The cache is not journaled with --all-steps'
+                self.journal_cache = False
+            if self.changes_since is not None:
+                print 'Error: --changes-since compares the builds of a single step'
+                sys.exit(1)
+
+        self.debug_mode = options.debug_mode
+
+        self.teamcity.config_keys.append(options.project_name)
+        self.teamcity.config_keys.append('%s_%s' % (options.project_name, options.config_name))
+
+        self._read_config()
+
+        if not self.teamcity.validate():
+            print '; disabling WarningWatcher'
+            self.config_file = None
+
+        self.working_prefix = os.getcwd().lower()
+        if 'build_system' in self.working_prefix:
+            ndx = self.working_prefix.index('build_system')
+            self.working_prefix = self.working_prefix[:ndx - 1]
+        else:
+            self.working_prefix = None
+
+        self.timer.stop('config')
+
+    def _dump_dir(self, path, indent=0):
+        for file_name in os.listdir(path):
+            file_path = os.path.join(path, file_name)
+            print '%s%s' % (' ' * indent, file_path)
+            if os.path.isdir(file_path):
+                self._dump_dir(file_path, indent + 2)
+
+    def _read_fragments(self, file_name):
+        fragments = []
+        try:
+            with open(file_name) as fragment_file:
+                for line in fragment_file:
+                    fragment = line.rstrip('\r\n')
+                    if (not fragment.strip()) or fragment.lstrip().startswith('#'):
+                        continue
+                    fragments.append(fragment)
+        except IOError, error_object:
+            print 'Error: Fragment file cannot be read: "%s" (%s)' % \
+                (file_name, str(error_object))
+            sys.exit(1)
+        return fragments
+
+    def _read_config(self):
+        self.config_file = os.path.join(APP_FOLDER,
+                                        'builders_conf', '%s.xml' % self.teamcity.agent_name)
+        if not os.path.exists(self.config_file):
+            # see if we can access them using the environment
+            if 'WWBLDRCFG' in os.environ:
+                self.config_file = os.path.join(os.environ['WWBLDRCFG'], '%s.xml' % \
+                    self.teamcity.agent_name)
+            if not os.path.exists(self.config_file):
+                self.config_file = None
+                return
+
+        config_files = [self.config_file,
+                        os.path.join(APP_FOLDER,
+                                     'builders_conf', '%s_%s.xml' % \
+                                         (self.teamcity.agent_name,
+                                          self.teamcity.project_name)),
+                        os.path.join(APP_FOLDER,
+                                     'builders_conf', '%s_%s_%s.xml' % \
+                                         (self.teamcity.agent_name,
+                                          self.teamcity.project_name,
+                                          self.teamcity.config_name))]
+
+        # the files are noted before they are read, so one that changes
+        # while it is being read is not taken to be unchanged next time
+        files = [(file_name, _file_signature(file_name)) for file_name in config_files]
+
+        settings = None
+        if self.config_snapshot:
+            settings = self._read_snapshot(files)
+        if settings is None:
+            settings = self._parse_settings(config_files)
+            if self.config_snapshot:
+                self._write_snapshot(files, settings)
+
+        self._apply_settings(settings)
+
+    def _snapshot_file_name(self, files):
+        # one for each set of builders_conf/ files, kept in the folder that
+        # belongs to this user alone
+        return os.path.join(user_folder(),
+                            'tcww_%s.config' % \
+                                md5.new('\n'.join([f[0] for f in files])).hexdigest()[:12])
+
+    def _read_snapshot(self, files):
+        """
+        Returns the settings last read from the builders_conf/ files, or
+        None if any of the files has changed since (or there are none).
+        A snapshot that someone else could have written is not used.
+        """
+        snapshot_file_name = self._snapshot_file_name(files)
+        if not (private_to_user(os.path.dirname(snapshot_file_name)) and \
+                private_to_user(snapshot_file_name)):
+            return None
+        try:
+            with open(snapshot_file_name, 'rb') as snapshot_input:
+                snapshot = json.load(snapshot_input)
+            if snapshot['version'] != SNAPSHOTVERSION:
+                return None
+            # (the signatures come back as lists)
+            if snapshot['files'] != json.loads(json.dumps(files)):
+                return None
+            settings = snapshot['settings']
+            settings['interested_parties'] = \
+                [[party.encode('ascii') for party in parties] \
+                 for parties in settings['interested_parties']]
+            return settings
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def _write_snapshot(self, files, settings):
+        if not make_user_folder():
+            return
+        snapshot_file_name = self._snapshot_file_name(files)
+        try:
+            if os.path.lexists(snapshot_file_name):
+                os.remove(snapshot_file_name)
+            snapshot_output = os.fdopen(os.open(snapshot_file_name,
+                                                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600),
+                                        'wb')
+            with snapshot_output:
+                json.dump({'version'  : SNAPSHOTVERSION,
+                           'files'    : files,
+                           'settings' : settings}, snapshot_output)
+        except (IOError, OSError):
+            # (it is only a shortcut; the files are read next time)
+            pass
+
+    def _parse_settings(self, config_files):
+        """
+        Reads the settings of the agent from its builders_conf/ file, and
+        the interested parties of the project and configuration from theirs
+        (if they exist).
+        """
+        import xml.dom.minidom as minidom
+
+        settings = {'cache'              : None,
+                    'agent_path'         : None,
+                    'warning_text'       : None,
+                    'warning_regex'      : None,
+                    'warning_format'     : None,
+                    'interested_parties' : [self._read_interested_parties(config_files[1]),
+                                            self._read_interested_parties(config_files[2])]}
+
+        dom = minidom.parse(config_files[0])
+        settings_node = dom.getElementsByTagName("Settings")[0]
+        counter = 0
+        while counter < len(settings_node.childNodes):
+            child1 = settings_node.childNodes[counter]
+            if child1.nodeType == child1.ELEMENT_NODE:
+                if child1.tagName == 'Cache':
+                    settings['cache'] = child1.getAttribute('value').strip()
+                elif child1.tagName == 'AgentPath':
+                    settings['agent_path'] = \
+                        os.path.normpath(child1.getAttribute('value').strip())
+                elif child1.tagName == 'WarningText':
+                    settings['warning_text'] = child1.getAttribute('value')
+                elif child1.tagName == 'WarningRegex':
+                    try:
+                        re.compile('(%s)' % child1.getAttribute('value'))
+                    except:
+                        print 'Error: TeamCity BuildAgent warning pattern ' \
+                              'cannot be compiled: "%s"' % \
+                            child1.getAttribute('value')
+                        sys.exit(1)
+                    settings['warning_regex'] = child1.getAttribute('value')
+                elif child1.tagName == 'WarningFormat':
+                    compiler_type = child1.getAttribute('value').lower()
+                    if compiler_type not in ['microsoft', 'visualstudio', 'gcc']:
+                        print 'Error: TeamCity BuildAgent warning type unrecognized: "%s"' % \
+                            child1.getAttribute('value')
+                        sys.exit(1)
+                    if compiler_type in ['microsoft', 'visualstudio']:
+                        settings['warning_format'] = TeamCity.MICROSOFT
+                    else:
+                        settings['warning_format'] = TeamCity.GCC
+            counter += 1
+
+        if settings['warning_text'] and settings['warning_regex']:
+            print 'Error: Only one of "WarningText" or "WarningRegex" ' \
+                  'can be defined for Agent "%s"' % \
+                        self.teamcity.agent_name
+            sys.exit(1)
+
+        return settings
+
+    def _read_interested_parties(self, project_config_file):
+        import xml.dom.minidom as minidom
+
+        interested_parties = []
+        if os.path.exists(project_config_file):
+            dom = minidom.parse(project_config_file)
+            settings_node = dom.getElementsByTagName("Settings")[0]
+            counter = 0
+            while counter < len(settings_node.childNodes):
+                child1 = settings_node.childNodes[counter]
+                if child1.nodeType == child1.ELEMENT_NODE:
+                    if child1.tagName == 'InterestedParties':
+                        interested_parties += [
+                            t.strip().encode('ascii') for t in \
+                                child1.firstChild.data.split(',')]
+                counter += 1
+        return interested_parties
+
+    def _apply_settings(self, settings):
+        if settings['cache'] is not None:
+            self.cache_file = CacheFile(self, settings['cache'])
+
+        if settings['agent_path'] is not None:
+            self.teamcity.build_agent_path = settings['agent_path']
+            if not os.path.exists(self.teamcity.build_agent_path):
+                print 'Error: TeamCity BuildAgent path cannot be accessed: "%s"' % \
+                    self.teamcity.build_agent_path
+                sys.exit(1)
+            self.teamcity.build_agent_log_path = \
+                os.path.join(self.teamcity.build_agent_path, 'logs')
+            if not os.path.exists(self.teamcity.build_agent_log_path):
+                print 'Error: TeamCity BuildAgent log path cannot be accessed: "%s"' % \
+                    self.teamcity.build_agent_log_path
+                sys.exit(1)
+
+        self.teamcity.warning_text = settings['warning_text']
+        if settings['warning_regex'] is not None:
+            self.teamcity.warning_regex = re.compile('(%s)' % settings['warning_regex'])
+        self.teamcity.warning_format = settings['warning_format']
+
+        if self.cache_file is None:
+            # put them in the system temp folder
+            self.cache_file = CacheFile(self)
+
+        # local state lives alongside the cache (or the local copy of it)
+        self.state_path = self.cache_file.local_folder()
+
+        project_parties, config_parties = settings['interested_parties']
+        self.teamcity.interested_parties[self.teamcity.project_name] = list(project_parties)
+        self.teamcity.interested_parties['%s_%s' % (self.teamcity.project_name,
+                                                    self.teamcity.config_name)] = \
+            list(config_parties)
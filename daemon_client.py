@@ -0,0 +1,153 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import md5
+import json
+import socket
+import tempfile
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: daemon_client.py                                               #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module hands a Warning Watcher step to the watcher daemon #
+#          (see watcher_daemon.py), if one is running.  It deliberately   #
+#          imports nothing but the standard library, so a step that the   #
+#          daemon answers never loads the rest of the system.             #
+#-------------------------------------------------------------------------#
+
+# a request is a single line of JSON:
+#
+#    { "argv" : [ <command line arguments> ],
+#      "cwd" : <working folder>,
+#      "environment" : { <the variables the Watcher consults> } }
+#
+# and the daemon answers with a single line of JSON:
+#
+#    { "result" : <exit code>, "output" : <stdout>, "errors" : <stderr> }
+#
+# strings are carried as latin-1, so that whatever bytes the logs (or the
+# command line) hold arrive unchanged.
+
+CONNECTTIMEOUT = 2.0
+
+# the environment variables that affect how a step is run
+ENVIRONMENT = ['WWBLDRCFG']
+
+class DaemonError(Exception):
+    """
+    The daemon accepted the step, but no answer came back; the step may
+    or may not have been run.
+    """
+    pass
+
+def user_folder():
+    """
+    The folder (in the system temp folder) that belongs to the current user
+    alone.  The daemon runs steps as the user it runs as, so its socket is
+    kept here, where no one else can reach the socket, or put one of their
+    own in its place; so is anything else a step trusts without checking.
+    """
+    if hasattr(os, 'getuid'):
+        return os.path.join(tempfile.gettempdir(), 'tcww-%d' % os.getuid())
+    # (Windows gives each user a temp folder in their own profile)
+    return os.path.join(tempfile.gettempdir(), 'tcww')
+
+def make_user_folder():
+    """
+    Creates user_folder() if it does not exist yet.  Returns True if it
+    belongs to the current user alone.
+    """
+    folder = user_folder()
+    if not os.path.isdir(folder):
+        try:
+            os.mkdir(folder, 0700)
+        except OSError:
+            pass
+    return private_to_user(folder)
+
+def daemon_socket_path():
+    """
+    Each copy of the Watcher has its own daemon, since builders_conf/ is
+    found relative to the code.  'WWDAEMONSOCKET' overrides the location.
+    """
+    if 'WWDAEMONSOCKET' in os.environ:
+        return os.environ['WWDAEMONSOCKET']
+
+    folder = os.path.split(os.path.realpath(__file__))[0]
+    return os.path.join(user_folder(),
+                        'tcww_%s.sock' % md5.new(folder).hexdigest()[:12])
+
+def owned_by_user(path):
+    """
+    True if 'path' exists, and belongs to the current user.
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    if not hasattr(os, 'getuid'):
+        # Windows reports no owner here; what is kept in user_folder() is
+        # kept out of reach of other users by the permissions of the
+        # profile it is in
+        return True
+    return info.st_uid == os.getuid()
+
+def private_to_user(path):
+    """
+    True if 'path' belongs to the current user, and no one else has any
+    access to it.
+    """
+    if not owned_by_user(path):
+        return False
+    return (not hasattr(os, 'getuid')) or ((os.lstat(path).st_mode & 077) == 0)
+
+def daemon_available():
+    return hasattr(socket, 'AF_UNIX') and os.path.exists(daemon_socket_path())
+
+def run_in_daemon(argv):
+    """
+    Runs the step described by 'argv' in the daemon.  Returns a (result,
+    output, errors) tuple, or None if no daemon could be reached (nothing
+    was run).  Raises DaemonError if the daemon was reached, but did not
+    answer.
+    """
+    if not daemon_available():
+        return None
+
+    if not private_to_user(daemon_socket_path()):
+        # (only a daemon run as this user can be trusted with the step)
+        print 'Warning: Ignoring the watcher daemon socket "%s"; it does not ' \
+              'belong to this user alone.' % daemon_socket_path()
+        return None
+
+    request = {'argv' : list(argv),
+               'cwd' : os.getcwd(),
+               'environment' : dict([(name, os.environ[name]) \
+                                     for name in ENVIRONMENT if name in os.environ])}
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.settimeout(CONNECTTIMEOUT)
+            connection.connect(daemon_socket_path())
+            connection.sendall('%s\n' % json.dumps(request, encoding='latin-1'))
+        except socket.error:
+            # no daemon is listening (e.g., it left a stale socket behind)
+            return None
+
+        # the step runs for as long as it needs to
+        connection.settimeout(None)
+        try:
+            reply = connection.makefile('rb').readline()
+            answer = json.loads(reply)
+            return (int(answer['result']),
+                    answer['output'].encode('latin-1'),
+                    answer['errors'].encode('latin-1'))
+        except (socket.error, ValueError, KeyError, TypeError), error_object:
+            raise DaemonError(str(error_object) or 'the daemon closed the connection')
+    finally:
+        connection.close()
@@ -1,637 +1,947 @@
-# pylint: disable=missing-docstring
-# pylint: disable=bad-whitespace
-# pylint: disable=too-many-instance-attributes
-# Classes may contain as many instance attributes required to perform their function
-
-import re
-import sys
-import difflib
-
-from constants import FileModes
-from build_data import BuildData
-
-#-------------------------------------------------------------------------#
-#     App: TeamCity9 Warning Watcher                                      #
-#  Module: delta_generator.py                                             #
-#  Author: Bob Hood                                                       #
-# License: LGPL-3.0                                                       #
-#   PyVer: 2.7.x                                                          #
-#  Detail: Contains the code to monitor the logs of a specific TeamCity   #
-#          Build Agent and generate warning message differentials.        #
-#-------------------------------------------------------------------------#
-
-def _strip_number_runs(line):
-    new_line = line
-    while True:
-        result = re.search('(\\d+)', new_line)
-        if not result:
-            break
-        new_line = new_line[:result.start(1)] + new_line[result.end(1):]
-    return new_line
-
-class DeltaGenerator(object):
-    def __init__(self, config, log_manager):
-        super(DeltaGenerator, self).__init__()
-        self.config = config
-        self.log_manager = log_manager
-
-        self.error_message = ''
-
-        # set up our markers
-        self.build_start = '--------- [ '           # this indicates the start of a build
-        self.build_end = 'Process exited with code' # this indicates the end of a build
-
-        self.latest_build = None
-        self.latest_build_step = 0
-        self.latest_warning_compression = set()
-        self.latest_failure_fragments = set()
-
-        self.cached_build = None
-        self.current_step = None
-
-        self._restore_state()
-
-    def _generate_delta(self):
-        """
-        This method is used when the user specifies their own detection data
-        with either WarningText or WatningRegex.  It doesn't 'normalize' the
-        lines (e.g., remove line numbers) which will often lead to false
-        positives.
-        """
-        result_code = 0
-
-        cached_set = set()
-        for warning in self.cached_build.warnings:
-            cached_set.add(warning)
-        latest_set = set()
-        for warning in self.latest_build.warnings:
-            latest_set.add(warning)
-
-        # subtract the current Set from the previous to see what is new
-        inflations = latest_set - cached_set
-
-        if self.config.debug_mode:
-            print 'Inflations:'
-            if len(inflations):
-                for line in inflations:
-                    print '    ::', line
-            else:
-                print '    (none)'
-
-        # subtract the previous Set from the current to see what is now missing
-        deflations = cached_set - latest_set
-
-        if self.config.debug_mode:
-            print 'Deflations:'
-            if len(deflations):
-                for line in deflations:
-                    print '    ::', line
-            else:
-                print '    (none)'
-
-        if len(deflations) and self.config.report_deflations:
-            info_tuple = None
-            if self.config.teamcity.warning_regex:
-                # calculate the actual number of warnings
-                deflation_set = set()
-                for line in deflations:
-                    if line.endswith('\n'):
-                        line = line.rstrip()
-                    result = re.search(self.config.teamcity.warning_regex, line)
-                    if result and result.lastindex:
-                        if result.group(1) not in deflation_set:
-                            deflation_set.add(result.group(1))
-                info_tuple = (len(deflation_set),
-                              's' if len(deflation_set) > 1 else '',
-                              'were' if len(deflation_set) > 1 else 'was')
-            else:
-                info_tuple = (len(deflations),
-                              's' if len(deflations) > 1 else '',
-                              'were' if len(deflations) > 1 else 'was')
-
-            print '%d previous warning%s %s no longer detected in the build:' % info_tuple
-
-            for line in deflations:
-                if line.endswith('\n'):
-                    line = line.rstrip()
-                print '   -', line
-            print ''
-
-        if len(inflations):
-            if self.config.inflations_are_errors:
-                self.error_message = "##teamcity[buildProblem description='%d new " \
-                                      "warning%s discovered' identity='WarningWatcher']" % \
-                    (len(inflations), 's' if len(inflations) > 1 else '')
-                result_code = 1
-
-            if not self.config.silence_inflations:
-                info_tuple = None
-                if self.config.teamcity.warning_regex:
-                    # calculate the actual number of warnings
-                    inflation_set = set()
-                    for line in inflations:
-                        if line.endswith('\n'):
-                            line = line.rstrip()
-                        result = re.search(self.config.teamcity.warning_regex, line)
-                        if result and result.lastindex:
-                            if result.group(1) not in inflation_set:
-                                inflation_set.add(result.group(1))
-                    info_tuple = (len(inflation_set),
-                                  's' if len(inflation_set) > 1 else '',
-                                  'were' if len(inflation_set) > 1 else 'was')
-                else:
-                    info_tuple = (len(inflations),
-                                  's' if len(inflations) > 1 else '',
-                                  'were' if len(inflations) > 1 else 'was')
-
-                print '%d new warning%s %s detected in this build:' % info_tuple
-
-                for line in inflations:
-                    if line.endswith('\n'):
-                        line = line.rstrip()
-                    print '   +', line
-
-                if False: """
-                # various Skype notification attempts (none of which I've been able
-                # to actually get to work with Skype so far)
-
-                #Use Windows Script Host to inject text into a Skype window
-
-                shell = win32com.client.Dispatch("WScript.Shell")
-                shell.AppActivate("Alerts.%s" % self.config.teamcity.project_name)
-                win32api.Sleep(500)
-                shell.SendKeys(msg)
-                shell.SendKeys("{ENTER}")
-                win32api.Sleep(2500)
-                # --------------------------
-                msg2skype_path = os.path.join(os.path.split(os.path.realpath(__file__))[0], 'MsgToSkype.exe')
-                ip_group = {}
-                for key in self.config.teamcity.config_keys:
-                    if key in self.config.teamcity.interested_parties:
-                        for ip in self.config.teamcity.interested_parties[key]:
-                            ip_group[ip] = key.replace('_', '.')
-
-                if len(ip_group) and os.path.exists(msg2skype_path):
-                    # send out notifications
-                    for ip in ip_group:
-                        msg = 'TCWW: Build %d of project "%s" encountered %d new warning%s.' % \
-                            (self.latest_build.number,
-                             ip_group[ip],
-                             len(inflations),
-                             's' if len(inflations) > 1 else '')
-
-                        command = [msg2skype_path, '-U', ip, msg]
-                        try:
-                            output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
-                            if 'Unable to attach' in output:
-                                # try it again
-                                output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
-                        except:
-                            pass
-                """
-
-    def _generate_delta_format(self):
-        """
-        This method is used with the WarningFormat option.  It takes many more
-        liberties with the lines of text, most notably 'normalizing' them based
-        on the format indicated to (hopefully) reduce the number of false
-        positives.
-        """
-        result_code = 0
-
-        format_regex = self.config.teamcity.warning_format_regex[
-            self.config.teamcity.warning_format ]
-
-        # logic: Create 'normalized' lists that strip out the line numbers
-        # so that movement of warnings do not produce false-positives.  then
-        # use difflib to generate a unified diff between the two 'normalized'
-        # lists. line numbers in the unified diff will correspond to the lines
-        # in the 'raw' lists, which will be used for display (because a
-        # warning message without a line number is pretty useless).
-
-        # sanitize each warning down to it's essence for best matching
-        def _sanitize(line, expression):
-            # first, remove the 'warning' chunk from the string (which will
-            # include line numbers)
-            while True:
-                result = re.search(expression, line)
-                if result is None:
-                    break
-                line = line[:result.start(0)] + line[result.end(0):]
-
-            # next, any runs of multiple spaces probably means
-            # something that doesn't add to the warning detection
-            result = re.search(' {2,}', line)
-            if result:
-                line = line[:result.start(0)]
-
-            # next, tabs are bad
-            try:
-                index = line.index('\t')
-            except:
-                pass
-            else:
-                line = line[:index]
-
-            # next, if a single warning line has multiple lines,
-            # probably doesn't add to the warning detection
-            try:
-                index = line.index('\n')
-            except:
-                pass
-            else:
-                line = line[:index]
-
-            # last, remove any explanatory text because, as above,
-            # it probably doesn't add to the warning detection
-            try:
-                index = line.index(',')
-            except:
-                pass
-            else:
-                line = line[:index]
-
-            return line
-
-        cached_list = []
-        line_no = 0
-        for warning in self.cached_build.warnings:
-            cached_list.append((_sanitize(warning, format_regex), line_no))
-            line_no += 1
-
-        # sort
-        cached_list.sort(key=lambda x: x[0])
-        cached_strings = [s[0] for s in cached_list]
-
-        if self.config.debug_mode:
-            with open('cached_list.txt', 'w') as output:
-                for warning_str, _ in cached_list:
-                    output.write('%s\n' % warning_str)
-            open('cached_strings.txt', 'w').write('\n'.join(cached_strings))
-
-        latest_list = []
-        line_no = 0
-        for warning in self.latest_build.warnings:
-            latest_list.append((_sanitize(warning, format_regex), line_no))
-            line_no += 1
-
-        # sort
-        latest_list.sort(key=lambda x: x[0])
-        latest_strings = [s[0] for s in latest_list]
-
-        if self.config.debug_mode:
-            with open('latest_list.txt', 'w') as output:
-                for warning_str, _ in latest_list:
-                    output.write('%s\n' % warning_str)
-            open('latest_strings.txt', 'w').write('\n'.join(latest_strings))
-
-        unified = []
-        for line in difflib.unified_diff(cached_strings, \
-                                         latest_strings, \
-                                         fromfile="cached_list", \
-                                         tofile="latest_list"):
-            unified.append(line)
-
-        if self.config.debug_mode:
-            open('unified.txt', 'w').write('\n'.join(unified))
-
-        # walk the unified diff and determine what messages are new,
-        # and what messages have gone away, if any
-
-        inflations = []
-        deflations = []
-
-        before_line = 0
-        #before_count = 0
-        after_line = 0
-        #after_count = 0
-
-        for line in unified:
-            if line.startswith('--- '):
-                # 'before file' (i.e., cached list)
-                pass
-
-            elif line.startswith('+++ '):
-                # 'after file' (i.e., latest list)
-                pass
-
-            elif line.startswith('@@ '):
-                # hunk
-
-                #before_count = 0
-                #after_count = 0
-
-                result = re.search(
-                    r'@@\s*([+,-])(\d+)(\s*,\s*(\d+))?(\s*([+,-])(\d+)(\s*,\s*(\d+))?)?\s*@@',
-                    line)
-
-                # the above expression will produce a 9-tuple value.
-                # some examples:
-                #      input: @@ -1 +1 @@
-                #     result: ('-', '1', None, None, ' +1', '+', '1', None, None)
-                #
-                #      input: @@ -1,4 +1,4 @@
-                #     result: ('-', '1', ',4', '4', ' +1,4', '+', '1', ',4', '4')
-                #
-                #      input: @@ -103,6 +103,8 @@
-                #     result: ('-', '103', ',6', '6', ' +103,8', '+', '103', ',8', '8')
-
-                before_line = int(result.group(2))
-                #if result.group(4) is not None:
-                #    before_count = int(result.group(4))
-
-                after_line = int(result.group(7))
-                #if result.group(9) is not None:
-                #    after_count = int(result.group(9))
-
-            else:
-                # we're processing a hunk
-                if line.startswith('-'):
-                    # this is a warning that no longer exists in the 'before
-                    # file' (deflation)
-                    deflations.append(self.cached_build.warnings[cached_list[before_line-1][1]])
-                    before_line += 1
-
-                elif line.startswith('+'):
-                    # this is a new warning in the 'after file' (inflation)
-                    inflations.append(self.latest_build.warnings[latest_list[after_line-1][1]])
-                    after_line += 1
-
-                else:
-                    # this line is common to both lists
-                    before_line += 1
-                    after_line += 1
-
-        if self.config.debug_mode:
-            print 'Inflations:'
-            if len(inflations):
-                for line in inflations:
-                    print '    ::', line
-            else:
-                print '    (none)'
-
-            print 'Deflations:'
-            if len(deflations):
-                for line in deflations:
-                    print '    ::', line
-            else:
-                print '    (none)'
-
-        if len(deflations) and self.config.report_deflations:
-            info_tuple = (len(deflations),
-                          's' if len(deflations) > 1 else '',
-                          'were' if len(deflations) > 1 else 'was')
-
-            print '%d previous warning%s %s no longer detected in the build:' % info_tuple
-
-            for line in deflations:
-                if line.endswith('\n'):
-                    line = line.rstrip()
-                print '   -', line
-            print ''
-
-        if len(inflations):
-            if self.config.inflations_are_errors:
-                self.error_message = "##teamcity[buildProblem description='%d " \
-                    "new warning%s discovered' identity='WarningWatcher']" % \
-                    (len(inflations), 's' if len(inflations) > 1 else '')
-                result_code = 1
-
-            if not self.config.silence_inflations:
-                info_tuple = (len(inflations),
-                              's' if len(inflations) > 1 else '',
-                              'were' if len(inflations) > 1 else 'was')
-
-                print '%d new warning%s %s detected in this build:' % info_tuple
-
-                for line in inflations:
-                    if line.endswith('\n'):
-                        line = line.rstrip()
-                    print '   +', line
-
-        if (len(deflations) == 0) and (len(inflations) == 0):
-            print 'No warning differences detected within build #%d.' \
-                % self.config.teamcity.build_number
-
-        if self.config.debug_mode:
-            sys.exit(0)     # prevent modification of the current cache
-
-        return result_code
-
-    def run(self):
-        result_code = 0
-
-        warning_compression = set()
-        fragments_triggering_failure = set()
-
-        build_step_count = 0    # which step of the build are we currently examining?
-        done = False
-
-        # walk all logs, oldest first, to find the current build
-        current_log = self.log_manager.get_oldest()
-        if not current_log:
-            print 'Warning: Failed to locate TeamCity logs'
-            print '    - Is the Builder running?'
-            print '    - Is the configured path correct? (%s)' \
-                % self.config.teamcity.build_agent_log_path
-            return 1
-
-        log_file = open(current_log.file_name, 'r')
-
-        log_line = log_file.readline()
-        while len(log_line) and (not done):
-            if log_line.endswith('\n'):
-                log_line = log_line.rstrip()
-            if self.build_start in log_line:
-                if self.config.teamcity.build_step != 0:
-                    assert self.current_step is None, \
-                        'Build start detected in current build'
-
-                # extract the build id
-                result = re.search(r'\-\-\- \[ (.+) \] \-\-\-', log_line)
-                if result:
-                    build_name = result.group(1)
-                    if build_name.startswith('%s::%s' % \
-                        (self.config.teamcity.project_name,
-                         self.config.teamcity.config_name)):
-                        result = re.search(r'(.+) \#(\d+)', build_name)
-                        if result:
-                            build_prefix, build_number = result.groups()
-                            build_number = int(build_number)
-                            if build_number == self.config.teamcity.build_number:
-                                build_step_count += 1
-                                if (self.config.teamcity.build_step == 0) or \
-                                   (build_step_count == self.config.teamcity.build_step):
-                                    self.current_step = BuildData()
-                                    self.current_step.id = build_name
-                                    self.current_step.prefix = build_prefix
-                                    self.current_step.number = build_number
-
-                                    warning_compression = set()
-                                    fragments_triggering_failure = set()
-
-            elif (self.build_end in log_line) and (self.current_step is not None):
-                # the build must end successfully to be a valid differential candidate
-                result = re.search(r'exited with code (\d+)', log_line)
-                if result.group(1) != '0':
-                    self.current_step = None
-
-                elif self.config.teamcity.build_step != 0:
-                    # if enough builds have been cached, perform a differential
-                    # on their warnings
-                    if self.cached_build and self.current_step:
-                        if self.config.teamcity.warning_format is not None:
-                            result_code = self._generate_delta_format()
-                        else:
-                            result_code = self._generate_delta()
-                    else:
-                        print 'First run; current warnings signature has been " \
-                            "cached to "%s".' % str(self.config.cache_file)
-
-                    self.cached_build = self.current_step
-                    self._save_state()
-                    done = True
-
-                else:   # we are only going to process the latest step with warnings
-                    self.latest_build_step = build_step_count
-                    if len(self.current_step.warnings):
-                        self.latest_build = self.current_step
-                        self.latest_warning_compression = warning_compression
-                        self.latest_failure_fragments = fragments_triggering_failure
-
-            else:
-                if (self.current_step is not None) and (' out - ' in log_line):
-                    # normalize the line (i.e., strip off the TeamCity prefix)
-                    index = log_line.index(' out - ') + 7
-                    log_line = log_line[index:]
-
-                    if self.config.working_prefix is not None:
-                        log_line_lower = log_line.lower()
-                        if log_line_lower.startswith(self.config.working_prefix):
-                            log_line = '...%s' % log_line[len(self.config.working_prefix):]
-
-                    log_lines = [log_line]
-                    if '[-W' in log_line:     # OS X warning line; fix it up a bit
-                        log_lines = []
-                        while '[-W' in log_line:
-                            ndx = log_line.index(' [-W')
-                            log_lines.append(log_line[:ndx])
-                            while log_line[ndx] != ']':
-                                ndx += 1
-                            log_line = log_line[ndx + 1:]
-
-                    for line in log_lines:
-                        result = None
-                        if self.config.teamcity.warning_regex:
-                            result = re.search(self.config.teamcity.warning_regex, line)
-                            if result and result.lastindex:
-                                if result.group(1) not in warning_compression:
-                                    warning_compression.add(result.group(1))
-                        elif self.config.teamcity.warning_format is not None:
-                            result = re.search(
-                                self.config.teamcity.warning_format_regex[
-                                    self.config.teamcity.warning_format],
-                                line)
-                            if result:
-                                if result.group(0) not in warning_compression:
-                                    warning_compression.add(result.group(0))
-                        else:
-                            result = (self.config.teamcity.warning_text in line)
-
-                        if result:
-                            #self.current_step.warnings.add(_strip_number_runs(line))
-                            self.current_step.warnings.append(line)
-
-                        if len(self.config.fail_on_fragment):
-                            for fragment in self.config.fail_on_fragment:
-                                if fragment in line:
-                                    fragments_triggering_failure.add(fragment)
-
-            log_line = log_file.readline()
-            if len(log_line) == 0:
-                # a build's output can span logs, so here
-                # we roll the log, if necessary
-                log_file.close()
-                current_log = self.log_manager.get_newer(current_log.key)
-                if current_log is not None:
-                    log_file = open(current_log.file_name, 'r')
-                    log_line = log_file.readline()
-
-        if self.config.teamcity.build_step == 0:
-            if self.cached_build and self.latest_build:
-                if self.config.teamcity.warning_format is not None:
-                    result_code = self._generate_delta_format()
-                else:
-                    result_code = self._generate_delta()
-            else:
-                print 'First run; current warnings signature has been ' \
-                      'cached to "%s".' % str(self.config.cache_file)
-
-            self.cached_build = self.latest_build
-            self._save_state()
-
-        if len(self.latest_failure_fragments):
-            print 'The following text fragments triggered a build failure:'
-            for fragment in self.latest_failure_fragments:
-                print '   -', fragment
-            self.error_message = "##teamcity[buildProblem description='Failure " \
-                "text fragments detected in build output' identity='WarningWatcher']"
-            return 1
-
-        if (self.config.teamcity.build_step != 0) and \
-           (build_step_count != self.config.teamcity.build_step):
-            print 'Warning: Failed to locate build #%d step %d in the TeamCity logs' \
-                % (self.config.teamcity.build_number, self.config.teamcity.build_step)
-            print '    - Are the logs too short?'
-            print '    - Is the correct build step (%d) being processed?' \
-                % self.config.teamcity.build_step
-        else:
-            print '%d total warnings matched the pattern in build #%d step %d' \
-                % (len(self.latest_warning_compression),
-                   self.config.teamcity.build_number,
-                   self.latest_build_step)
-            if len(self.latest_warning_compression) == 0:
-                print '    - Did you switch to incremental building?'
-                print '    - Are the logs too short?'
-                print '    - Have warnings been turned off?'
-                print '    - Did the step complete successfully?'
-                if self.config.teamcity.build_step != 0:
-                    print '    - Is the correct build step (%d) being processed?' \
-                        % self.config.teamcity.build_step
-
-        return result_code
-
-    def _save_state(self):
-        #print 'Writing the following warnings to the pickle file:'
-        #for warning in self.cached_build.warnings:
-        #    print '  -', warning
-
-        pickle_file = self.config.cache_file.open(FileModes.WRITE_ONLY)
-        assert pickle_file, 'Error: Could not access cache file: "%s"' % str(self.config.cache_file)
-        self.cached_build.store(pickle_file)
-        self.config.cache_file.close()
-
-        if self.config.debug_mode:
-            print 'Stored state to cache file "%s":' % str(self.config.cache_file)
-            for line in self.cached_build.warnings:
-                print '    ::', line
-
-    def _restore_state(self):
-        if self.config.reset_cache:
-            print 'Resetting cache file "%s".' % str(self.config.cache_file)
-            self.config.cache_file.reset()
-            return
-
-        pickle_file = self.config.cache_file.open(FileModes.READ_ONLY)
-        if not pickle_file:
-            print 'Previous cache file "%s" not found.' % str(self.config.cache_file)
-            return
-
-        self.cached_build = BuildData()
-        self.cached_build.retrieve(pickle_file)
-        self.config.cache_file.close()
-
-        if self.config.debug_mode:
-            print 'Restored state from cache file "%s":' % str(self.config.cache_file)
-            for line in self.cached_build.warnings:
-                print '    ::', line
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+# pylint: disable=too-many-instance-attributes
+# Classes may contain as many instance attributes required to perform their function
+
+import re
+import sys
+import time
+import cPickle
+
+from constants import FileModes, LogEvents
+from build_data import BuildData
+from build_steps import BuildSteps
+from build_journal import BuildJournal
+from build_index import BuildIndex, BUILD_ID_REGEX, BUILD_NUMBER_REGEX
+from fragment_matcher import FragmentMatcher
+from log_pipeline import build_pipeline, OUTPUT_MARKER
+from line_classifier import LineClassifier
+from warning_diff import DIFF_ENGINES
+from warning_normalizer import WarningNormalizer
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: delta_generator.py                                             #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: Contains the code to monitor the logs of a specific TeamCity   #
+#          Build Agent and generate warning message differentials.        #
+#-------------------------------------------------------------------------#
+
+# evaluated for every build end marker, so compiled once (the build start
+# marker expressions are shared with the build index)
+EXIT_CODE_REGEX = re.compile(r'exited with code (\d+)')
+
+# how many times an update of a shared cache is retried after losing a race
+# with another agent
+SAVEATTEMPTS = 5
+
+def _strip_number_runs(line):
+    new_line = line
+    while True:
+        result = re.search('(\\d+)', new_line)
+        if not result:
+            break
+        new_line = new_line[:result.start(1)] + new_line[result.end(1):]
+    return new_line
+
+class DeltaGenerator(object):
+    def __init__(self, config, log_manager, build_index=None, baselines=None):
+        super(DeltaGenerator, self).__init__()
+        self.config = config
+        self.log_manager = log_manager
+
+        # a long-lived caller (the watcher daemon) may keep the builds it
+        # has read in 'baselines', which maps a cache file to a (version,
+        # build, journal) tuple.  a cache file still at that version need
+        # not be read again.
+        self.baselines = baselines
+
+        self.error_message = ''
+        self.new_warnings = 0       # (over every step compared, with --all-steps)
+
+        # set up our markers
+        self.build_start = '--------- [ '           # this indicates the start of a build
+        self.build_end = 'Process exited with code' # this indicates the end of a build
+
+        self.latest_build = None
+        self.latest_build_step = 0
+        self.latest_warning_compression = set()
+        self.latest_failure_fragments = set()
+
+        # with --all-steps, the build of each step that ended successfully,
+        # and how many distinct warnings each had
+        self.latest_steps = BuildSteps()
+        self.latest_step_counts = {}
+
+        self.cached_build = None
+        self.current_step = None
+
+        # set if the cache file is (or is to be) a journal
+        self.journal = None
+
+        # scan state for the build currently being examined
+        self.result_code = 0
+        self.build_step_count = 0
+        self.warning_compression = set()
+        self.fragments_triggering_failure = set()
+        self.classifier = None
+        self.normalizer = None
+
+        # every --fail-on-fragment fragment, looked for in a single pass
+        # over each line (see fragment_matcher.py)
+        self.fragment_matcher = None
+        if len(self.config.fail_on_fragment):
+            self.fragment_matcher = FragmentMatcher(self.config.fail_on_fragment)
+
+        # where the time of the step goes (see phase_timer.py)
+        self.timer = config.timer
+
+        self.build_index = build_index
+        if (self.build_index is None) and self.config.build_index:
+            with self.timer.phase('index'):
+                self.build_index = BuildIndex(self.config, self.log_manager)
+
+    def _generate_delta(self, cached_build, latest_build):
+        """
+        This method is used when the user specifies their own detection data
+        with either WarningText or WatningRegex.  It doesn't 'normalize' the
+        lines (e.g., remove line numbers) which will often lead to false
+        positives.
+        """
+        result_code = 0
+
+        self.timer.start('diff')
+
+        if self._diff_engine() == 'fingerprint':
+            # compare fingerprints of the warnings instead; only the lines
+            # that differ are looked up
+            from warning_fingerprint import diff_build_warnings
+
+            removed, added = diff_build_warnings(cached_build, latest_build)
+            inflations = [latest_build.warnings[ndx] for ndx in added]
+            deflations = [cached_build.warnings[ndx] for ndx in removed]
+        else:
+            cached_set = set()
+            for warning in cached_build.warnings:
+                cached_set.add(warning)
+            latest_set = set()
+            for warning in latest_build.warnings:
+                latest_set.add(warning)
+
+            # subtract the current Set from the previous to see what is new
+            inflations = latest_set - cached_set
+
+            # subtract the previous Set from the current to see what is now missing
+            deflations = cached_set - latest_set
+
+        self.timer.stop('diff')
+
+        if self.config.debug_mode:
+            print 'Inflations:'
+            if len(inflations):
+                for line in inflations:
+                    print '    ::', line
+            else:
+                print '    (none)'
+
+            print 'Deflations:'
+            if len(deflations):
+                for line in deflations:
+                    print '    ::', line
+            else:
+                print '    (none)'
+
+        if len(deflations) and self.config.report_deflations:
+            info_tuple = None
+            if self.config.teamcity.warning_regex:
+                # calculate the actual number of warnings
+                deflation_set = set()
+                for line in deflations:
+                    if line.endswith('\n'):
+                        line = line.rstrip()
+                    result = self.config.teamcity.warning_regex.search(line)
+                    if result and result.lastindex:
+                        if result.group(1) not in deflation_set:
+                            deflation_set.add(result.group(1))
+                info_tuple = (len(deflation_set),
+                              's' if len(deflation_set) > 1 else '',
+                              'were' if len(deflation_set) > 1 else 'was')
+            else:
+                info_tuple = (len(deflations),
+                              's' if len(deflations) > 1 else '',
+                              'were' if len(deflations) > 1 else 'was')
+
+            print '%d previous warning%s %s no longer detected in the build:' % info_tuple
+
+            for line in deflations:
+                if line.endswith('\n'):
+                    line = line.rstrip()
+                print '   -', line
+            print ''
+
+        if len(inflations):
+            if self.config.inflations_are_errors:
+                self.new_warnings += len(inflations)
+                self.error_message = "##teamcity[buildProblem description='%d new " \
+                                      "warning%s discovered' identity='WarningWatcher']" % \
+                    (self.new_warnings, 's' if self.new_warnings > 1 else '')
+                result_code = 1
+
+            if not self.config.silence_inflations:
+                info_tuple = None
+                if self.config.teamcity.warning_regex:
+                    # calculate the actual number of warnings
+                    inflation_set = set()
+                    for line in inflations:
+                        if line.endswith('\n'):
+                            line = line.rstrip()
+                        result = self.config.teamcity.warning_regex.search(line)
+                        if result and result.lastindex:
+                            if result.group(1) not in inflation_set:
+                                inflation_set.add(result.group(1))
+                    info_tuple = (len(inflation_set),
+                                  's' if len(inflation_set) > 1 else '',
+                                  'were' if len(inflation_set) > 1 else 'was')
+                else:
+                    info_tuple = (len(inflations),
+                                  's' if len(inflations) > 1 else '',
+                                  'were' if len(inflations) > 1 else 'was')
+
+                print '%d new warning%s %s detected in this build:' % info_tuple
+
+                for line in inflations:
+                    if line.endswith('\n'):
+                        line = line.rstrip()
+                    print '   +', line
+
+                if False: """
+                # various Skype notification attempts (none of which I've been able
+                # to actually get to work with Skype so far)
+
+                #Use Windows Script Host to inject text into a Skype window
+
+                shell = win32com.client.Dispatch("WScript.Shell")
+                shell.AppActivate("Alerts.%s" % self.config.teamcity.project_name)
+                win32api.Sleep(500)
+                shell.SendKeys(msg)
+                shell.SendKeys("{ENTER}")
+                win32api.Sleep(2500)
+                # --------------------------
+                msg2skype_path = os.path.join(os.path.split(os.path.realpath(__file__))[0], 'MsgToSkype.exe')
+                ip_group = {}
+                for key in self.config.teamcity.config_keys:
+                    if key in self.config.teamcity.interested_parties:
+                        for ip in self.config.teamcity.interested_parties[key]:
+                            ip_group[ip] = key.replace('_', '.')
+
+                if len(ip_group) and os.path.exists(msg2skype_path):
+                    # send out notifications
+                    for ip in ip_group:
+                        msg = 'TCWW: Build %d of project "%s" encountered %d new warning%s.' % \
+                            (latest_build.number,
+                             ip_group[ip],
+                             len(inflations),
+                             's' if len(inflations) > 1 else '')
+
+                        command = [msg2skype_path, '-U', ip, msg]
+                        try:
+                            output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+                            if 'Unable to attach' in output:
+                                # try it again
+                                output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+                        except:
+                            pass
+                """
+
+    def _diff_engine(self):
+        """
+        The name of the engine to compare the builds' warnings with: the
+        one asked for, unless what it needs is not installed.
+        """
+        if self.config.diff_engine == 'fingerprint':
+            from warning_fingerprint import NUMPY_AVAILABLE
+            if not NUMPY_AVAILABLE:
+                print "Warning: The 'fingerprint' diff engine requires NumPy; " \
+                      "using 'merge' instead."
+                return 'merge'
+        return self.config.diff_engine
+
+    def _normalized_keys(self, build):
+        """
+        Returns the sorted (key, line_no) tuples of the build's normalized
+        warnings, computing (and attaching) them if the build doesn't carry
+        keys for the current WarningFormat and normalizer version.
+        """
+        warning_format = self.config.teamcity.warning_format
+        if build.has_keys(warning_format, WarningNormalizer.VERSION):
+            return build.keys
+
+        with self.timer.phase('normalize'):
+            if self.normalizer is None:
+                self.normalizer = WarningNormalizer(
+                    self.config.teamcity.warning_format_regex[warning_format])
+
+            keys = self.normalizer.normalize_all(build.warnings)
+            keys.sort()
+            build.set_keys(keys, warning_format, WarningNormalizer.VERSION)
+        return keys
+
+    def _generate_delta_format(self, cached_build, latest_build):
+        """
+        This method is used with the WarningFormat option.  It takes many more
+        liberties with the lines of text, most notably 'normalizing' them based
+        on the format indicated to (hopefully) reduce the number of false
+        positives.
+        """
+        result_code = 0
+
+        # logic: Create 'normalized' lists that strip out the line numbers
+        # so that movement of warnings do not produce false-positives.  then
+        # sort and compare the two 'normalized' lists.  positions in the
+        # sorted lists carry the index of each warning in the 'raw' lists,
+        # which will be used for display (because a warning message without
+        # a line number is pretty useless).
+
+        # sanitize each warning down to it's essence for best matching
+        # (the cached build will usually have been stored already sanitized)
+        cached_list = self._normalized_keys(cached_build)
+        cached_strings = cached_build.key_names()
+
+        if self.config.debug_mode:
+            with open('cached_list.txt', 'w') as output:
+                for warning_str, _ in cached_list:
+                    output.write('%s\n' % warning_str)
+            open('cached_strings.txt', 'w').write('\n'.join(cached_strings))
+
+        latest_list = self._normalized_keys(latest_build)
+        latest_strings = latest_build.key_names()
+
+        if self.config.debug_mode:
+            if self.normalizer is not None:
+                self.normalizer.report()
+            with open('latest_list.txt', 'w') as output:
+                for warning_str, _ in latest_list:
+                    output.write('%s\n' % warning_str)
+            open('latest_strings.txt', 'w').write('\n'.join(latest_strings))
+
+        # compare the 'normalized' lists, and map the differences back
+        # to the 'raw' warnings for display
+        diff_engine = self._diff_engine()
+        with self.timer.phase('diff'):
+            if diff_engine == 'fingerprint':
+                # (the builds keep their fingerprints for next time)
+                from warning_fingerprint import diff_builds
+                removed, added = diff_builds(cached_build,
+                                             latest_build,
+                                             self.config.debug_mode)
+            else:
+                removed, added = DIFF_ENGINES[diff_engine](cached_strings,
+                                                           latest_strings,
+                                                           self.config.debug_mode)
+
+            deflations = [cached_build.warnings[cached_list[ndx][1]] for ndx in removed]
+            inflations = [latest_build.warnings[latest_list[ndx][1]] for ndx in added]
+
+        if self.config.debug_mode:
+            print 'Inflations:'
+            if len(inflations):
+                for line in inflations:
+                    print '    ::', line
+            else:
+                print '    (none)'
+
+            print 'Deflations:'
+            if len(deflations):
+                for line in deflations:
+                    print '    ::', line
+            else:
+                print '    (none)'
+
+        if len(deflations) and self.config.report_deflations:
+            info_tuple = (len(deflations),
+                          's' if len(deflations) > 1 else '',
+                          'were' if len(deflations) > 1 else 'was')
+
+            print '%d previous warning%s %s no longer detected in the build:' % info_tuple
+
+            for line in deflations:
+                if line.endswith('\n'):
+                    line = line.rstrip()
+                print '   -', line
+            print ''
+
+        if len(inflations):
+            if self.config.inflations_are_errors:
+                self.new_warnings += len(inflations)
+                self.error_message = "##teamcity[buildProblem description='%d " \
+                    "new warning%s discovered' identity='WarningWatcher']" % \
+                    (self.new_warnings, 's' if self.new_warnings > 1 else '')
+                result_code = 1
+
+            if not self.config.silence_inflations:
+                info_tuple = (len(inflations),
+                              's' if len(inflations) > 1 else '',
+                              'were' if len(inflations) > 1 else 'was')
+
+                print '%d new warning%s %s detected in this build:' % info_tuple
+
+                for line in inflations:
+                    if line.endswith('\n'):
+                        line = line.rstrip()
+                    print '   +', line
+
+        if (len(deflations) == 0) and (len(inflations) == 0):
+            print 'No warning differences detected within build #%d.' \
+                % self.config.teamcity.build_number
+
+        if self.config.debug_mode:
+            sys.exit(0)     # prevent modification of the current cache
+
+        return result_code
+
+    def _process_event(self, event, log_line):
+        """
+        The sink of the log pipeline: feeds a single event through the build
+        state machine.  Returns True once the build step of interest has been
+        fully processed.
+        """
+        if event == LogEvents.BUILD_START:
+            if self.config.teamcity.build_step != 0:
+                assert self.current_step is None, \
+                    'Build start detected in current build'
+            elif self.config.all_steps:
+                # a step that never ended does not count
+                self.current_step = None
+
+            # extract the build id
+            result = BUILD_ID_REGEX.search(log_line)
+            if result:
+                build_name = result.group(1)
+                if build_name.startswith('%s::%s' % \
+                    (self.config.teamcity.project_name,
+                     self.config.teamcity.config_name)):
+                    result = BUILD_NUMBER_REGEX.search(build_name)
+                    if result:
+                        build_prefix, build_number = result.groups()
+                        build_number = int(build_number)
+                        if build_number == self.config.teamcity.build_number:
+                            self.build_step_count += 1
+                            if (self.config.teamcity.build_step == 0) or \
+                               (self.build_step_count == self.config.teamcity.build_step):
+                                self.current_step = BuildData()
+                                self.current_step.id = build_name
+                                self.current_step.prefix = build_prefix
+                                self.current_step.number = build_number
+
+                                self.warning_compression = set()
+                                self.fragments_triggering_failure = set()
+
+            if self.config.all_steps and self.build_step_count and (self.current_step is None):
+                # another build has begun, so ours is over
+                return True
+
+        elif event == LogEvents.BUILD_END:
+            # the build must end successfully to be a valid differential candidate
+            result = EXIT_CODE_REGEX.search(log_line)
+            if result.group(1) != '0':
+                self.current_step = None
+
+            elif self.config.teamcity.build_step != 0:
+                # if enough builds have been cached, perform a differential
+                # on their warnings
+                if self.cached_build and self.current_step:
+                    if self.config.teamcity.warning_format is not None:
+                        self.result_code = self._generate_delta_format(self.cached_build,
+                                                                       self.current_step)
+                    else:
+                        self.result_code = self._generate_delta(self.cached_build,
+                                                                self.current_step)
+                else:
+                    print 'First run; current warnings signature has been ' \
+                          'cached to "%s".' % str(self.config.cache_file)
+
+                self._replace_cached_build(self.current_step)
+                with self.timer.phase('cacheWrite'):
+                    self._save_state()
+                return True
+
+            elif self.config.all_steps:
+                # every step is compared against its own baseline once the
+                # scan is done
+                if self.current_step is not None:
+                    self.latest_steps.builds[self.build_step_count] = self.current_step
+                    self.latest_step_counts[self.build_step_count] = len(self.warning_compression)
+                    self.latest_failure_fragments |= self.fragments_triggering_failure
+                    self.current_step = None
+
+            else:   # we are only going to process the latest step with warnings
+                self.latest_build_step = self.build_step_count
+                if len(self.current_step.warnings):
+                    self.latest_build = self.current_step
+                    self.latest_warning_compression = self.warning_compression
+                    self.latest_failure_fragments = self.fragments_triggering_failure
+
+        elif event == LogEvents.WARNING:
+            line, key = log_line
+            if (key is not None) and (key not in self.warning_compression):
+                self.warning_compression.add(key)
+
+            #self.current_step.warnings.add(_strip_number_runs(line))
+            self.current_step.warnings.append(line)
+            self._check_fragments(line)
+
+        else:
+            self._check_fragments(log_line)
+
+        return False
+
+    def _check_fragments(self, line):
+        if self.fragment_matcher is not None:
+            self.fragments_triggering_failure.update(self.fragment_matcher.find_all(line))
+
+    def run(self):
+        if self.config.changes_since is not None:
+            # (a question for the cache alone; the logs are not read)
+            return self._report_changes_since(self.config.changes_since)
+
+        self.result_code = 0
+
+        self.warning_compression = set()
+        self.fragments_triggering_failure = set()
+
+        self.build_step_count = 0    # which step of the build are we currently examining?
+
+        # walk all logs, oldest first, to find the current build
+        current_log = self.log_manager.get_oldest()
+        if not current_log:
+            print 'Warning: Failed to locate TeamCity logs'
+            print '    - Is the Builder running?'
+            print '    - Is the configured path correct? (%s)' \
+                % self.config.teamcity.build_agent_log_path
+            return 1
+
+        # the cache is only read (and a remote one connected to) once there
+        # are logs to compare it with
+        with self.timer.phase('cacheRead'):
+            self._restore_state()
+
+        start_offset = 0
+        if self.build_index:
+            # skip straight to the first step of the build, if we know where it is
+            with self.timer.phase('index'):
+                self.build_index.update()
+                located = self.build_index.locate('%s::%s' % \
+                                                  (self.config.teamcity.project_name,
+                                                   self.config.teamcity.config_name),
+                                                  self.config.teamcity.build_number)
+            if located is not None:
+                current_log, start_offset = located
+
+                if self.config.debug_mode:
+                    print 'Build index located build #%d in "%s" at offset %d' % \
+                        (self.config.teamcity.build_number, current_log.file_name, start_offset)
+
+        # the pipeline hands us every event that could change our state; it
+        # needs to know when we are inside a build so it can pick out that
+        # build's output
+        self.classifier = LineClassifier.create(self.config.teamcity)
+        scan_start = time.time()
+
+        markers = (self.build_start, self.build_end, OUTPUT_MARKER)
+        collecting = lambda: self.current_step is not None
+        if self.config.scan_workers != 1:
+            # (multiprocessing is only loaded for a parallel scan)
+            from parallel_scan import parallel_pipeline
+
+            events = parallel_pipeline(self.config,
+                                       self.classifier,
+                                       self.log_manager,
+                                       current_log,
+                                       start_offset,
+                                       markers,
+                                       collecting,
+                                       self.build_index)
+        else:
+            events = build_pipeline(self.config,
+                                    self.classifier,
+                                    self.log_manager,
+                                    current_log,
+                                    start_offset,
+                                    markers,
+                                    collecting)
+        with self.timer.phase('scan'):
+            for event, payload in events:
+                if self._process_event(event, payload):
+                    break
+
+        if self.config.debug_mode:
+            self.classifier.report(time.time() - scan_start)
+
+        if self.config.all_steps:
+            self._generate_step_deltas()
+
+        elif self.config.teamcity.build_step == 0:
+            if self.cached_build and self.latest_build:
+                if self.config.teamcity.warning_format is not None:
+                    self.result_code = self._generate_delta_format(self.cached_build,
+                                                                   self.latest_build)
+                else:
+                    self.result_code = self._generate_delta(self.cached_build,
+                                                            self.latest_build)
+            else:
+                print 'First run; current warnings signature has been ' \
+                      'cached to "%s".' % str(self.config.cache_file)
+
+            self._replace_cached_build(self.latest_build)
+            with self.timer.phase('cacheWrite'):
+                self._save_state()
+
+        if len(self.latest_failure_fragments):
+            print 'The following text fragments triggered a build failure:'
+            for fragment in self.latest_failure_fragments:
+                print '   -', fragment
+            self.error_message = "##teamcity[buildProblem description='Failure " \
+                "text fragments detected in build output' identity='WarningWatcher']"
+            return 1
+
+        if self.config.all_steps:
+            if not len(self.latest_steps.builds):
+                print 'Warning: Failed to locate a completed step of build #%d in the TeamCity logs' \
+                    % self.config.teamcity.build_number
+                print '    - Are the logs too short?'
+                print '    - Did the steps complete successfully?'
+        elif (self.config.teamcity.build_step != 0) and \
+             (self.build_step_count != self.config.teamcity.build_step):
+            print 'Warning: Failed to locate build #%d step %d in the TeamCity logs' \
+                % (self.config.teamcity.build_number, self.config.teamcity.build_step)
+            print '    - Are the logs too short?'
+            print '    - Is the correct build step (%d) being processed?' \
+                % self.config.teamcity.build_step
+        else:
+            print '%d total warnings matched the pattern in build #%d step %d' \
+                % (len(self.latest_warning_compression),
+                   self.config.teamcity.build_number,
+                   self.latest_build_step)
+            if len(self.latest_warning_compression) == 0:
+                print '    - Did you switch to incremental building?'
+                print '    - Are the logs too short?'
+                print '    - Have warnings been turned off?'
+                print '    - Did the step complete successfully?'
+                if self.config.teamcity.build_step != 0:
+                    print '    - Is the correct build step (%d) being processed?' \
+                        % self.config.teamcity.build_step
+
+        return self.result_code
+
+    def _report_changes_since(self, number):
+        """
+        With --changes-since: prints the warnings added and removed between
+        build 'number' and the latest build held in the (SQLite) cache.
+        """
+        database = self.config.cache_file.database
+        if not database:
+            print 'Error: --changes-since requires a SQLite cache ("sqlite:<file>")'
+            return 1
+
+        with self.timer.phase('cacheRead'):
+            numbers = database.numbers()
+            changes = database.changes_since(number)
+        if changes is None:
+            print 'Error: Build #%d is not held in the cache "%s"' % \
+                (number, str(self.config.cache_file))
+            if numbers:
+                print '    - It holds builds #%s' % ', #'.join([str(held) for held in numbers])
+            return 1
+
+        added, removed = changes
+        print '%d warning%s added, and %d removed, since build #%d:' % \
+            (len(added), 's' if len(added) != 1 else '', len(removed), number)
+        for line in removed:
+            print '   -', line.rstrip()
+        for line in added:
+            print '   +', line.rstrip()
+        return 0
+
+    def _generate_step_deltas(self):
+        """
+        With --all-steps: compares each step of the build with the build
+        last cached for that step, then stores them all together (along
+        with the baselines of any steps this build did not complete).
+        """
+        cached_steps = self.cached_build
+        for step in self.latest_steps.steps():
+            latest_build = self.latest_steps.builds[step]
+            cached_build = cached_steps.builds.get(step) if cached_steps else None
+
+            print 'Build #%d step %d:' % (self.config.teamcity.build_number, step)
+            if cached_build is not None:
+                if self.config.teamcity.warning_format is not None:
+                    result_code = self._generate_delta_format(cached_build, latest_build)
+                else:
+                    result_code = self._generate_delta(cached_build, latest_build)
+                self.result_code = max(self.result_code, result_code)
+            else:
+                print 'First run; step %d warnings signature has been ' \
+                      'cached to "%s".' % (step, str(self.config.cache_file))
+            print '%d total warnings matched the pattern in build #%d step %d' \
+                % (self.latest_step_counts[step], self.config.teamcity.build_number, step)
+            print ''
+
+        if not len(self.latest_steps.builds):
+            # leave the baselines as they are
+            return
+
+        steps = BuildSteps()
+        if cached_steps is not None:
+            steps.builds.update(cached_steps.builds)
+        steps.builds.update(self.latest_steps.builds)
+        # (the steps kept from the cache stay in use)
+        steps.release()
+        self._replace_cached_build(steps)
+        with self.timer.phase('cacheWrite'):
+            self._save_state()
+
+    def report_statistics(self):
+        """
+        Reports where the time of the step went, and how much work was
+        done, to TeamCity as build statistics.
+        """
+        if self.classifier is not None:
+            self.timer.add_counts(self.classifier.counts())
+        self.timer.count('bytesTransferred', self.config.cache_file.transferred())
+        self.timer.report()
+
+    def _replace_cached_build(self, build):
+        # a memory-mapped cache file must be let go of before it is replaced
+        # (any of its builds still in use have been released already)
+        if self.cached_build is not None:
+            self.cached_build.close()
+        self.cached_build = build
+
+    def _cached_builds(self):
+        # the builds held by the cache: one, or (with --all-steps) one for
+        # each step
+        if self.cached_build is None:
+            return []
+        if isinstance(self.cached_build, BuildSteps):
+            return [self.cached_build.builds[step] for step in self.cached_build.steps()]
+        return [self.cached_build]
+
+    def _save_state(self):
+        #print 'Writing the following warnings to the pickle file:'
+        #for warning in self.cached_build.warnings:
+        #    print '  -', warning
+
+        if self.config.teamcity.warning_format is not None:
+            # store the build ready to be compared against next time
+            for build in self._cached_builds():
+                self._normalized_keys(build)
+
+        # whatever we remember of the cache file is about to be out of date
+        self._forget_baseline()
+
+        if self.config.cache_file.database:
+            if self.config.all_steps:
+                # (the baselines of the steps this build did not complete
+                # are already there)
+                stored = self.config.cache_file.database.store_steps(self.latest_steps)
+            else:
+                stored = self.config.cache_file.database.store(self.cached_build)
+            if not stored:
+                sys.exit(1)
+            saved = True
+        else:
+            # another agent sharing the cache may have updated it since we
+            # read it, in which case our update is turned away, and we
+            # re-read the cache and try again
+            for _ in xrange(SAVEATTEMPTS):
+                if self.config.journal_cache:
+                    saved = self._save_journal()
+                else:
+                    pickle_file = self.config.cache_file.open(FileModes.WRITE_ONLY)
+                    assert pickle_file, 'Error: Could not access cache file: "%s"' % \
+                        str(self.config.cache_file)
+                    self.cached_build.store(pickle_file, self.config.compress_cache)
+                    saved = self.config.cache_file.close()
+
+                if saved or (not self._merge_state()):
+                    break
+            else:
+                print 'Warning: Cache file "%s" kept changing; it was not updated.' % \
+                    str(self.config.cache_file)
+
+        if saved and (not self.config.cache_file.database):
+            self._remember_baseline(self.cached_build, self.journal)
+
+        if saved and self.config.debug_mode:
+            print 'Stored state to cache file "%s":' % str(self.config.cache_file)
+            for build in self._cached_builds():
+                for line in build.warnings:
+                    print '    ::', line
+
+    def _save_journal(self):
+        if self.journal is None:
+            self.journal = BuildJournal()
+
+        if self.journal.can_append(self.config.journal_limit):
+            journal_file = self.config.cache_file.open(FileModes.APPEND)
+            assert journal_file, 'Error: Could not access cache file: "%s"' % \
+                str(self.config.cache_file)
+            self.journal.append(journal_file, self.cached_build)
+        else:
+            # start a new journal (or compact the current one)
+            journal_file = self.config.cache_file.open(FileModes.WRITE_ONLY)
+            assert journal_file, 'Error: Could not access cache file: "%s"' % \
+                str(self.config.cache_file)
+            self.journal.store(journal_file, self.cached_build, self.config.compress_cache)
+        if not self.config.cache_file.close():
+            return False
+
+        if self.config.debug_mode:
+            print 'Journaled build #%d: %d warnings added, %d removed; %s' % \
+                (self.cached_build.number, self.journal.added, self.journal.removed,
+                 str(self.journal))
+        return True
+
+    def _merge_state(self):
+        """
+        Our update of the cache was turned away because another agent
+        updated it first.  Re-reads the cache; the newer of its build and
+        ours should be kept.  Returns True if ours should be stored again.
+        """
+        print 'Cache file "%s" was updated by another agent; re-reading it.' % \
+            str(self.config.cache_file)
+
+        build, journal = self._read_state(False)
+        if (build is not None) and self._holds_mode(build) and \
+           (build.number > self.cached_build.number):
+            print '    - It already holds the newer build #%d; leaving it as is.' % \
+                build.number
+            return False
+
+        # ours is the newer build, so it goes on top of what is there now
+        self.journal = journal
+        return True
+
+    def _restore_state(self):
+        if self.config.reset_cache:
+            print 'Resetting cache file "%s".' % str(self.config.cache_file)
+            self.config.cache_file.reset()
+            return
+
+        if self.config.cache_file.database:
+            if self.config.all_steps:
+                self.cached_build = self.config.cache_file.database.retrieve_steps()
+            else:
+                self.cached_build = self.config.cache_file.database.retrieve()
+            if self.cached_build is None:
+                print 'Previous cache file "%s" not found.' % str(self.config.cache_file)
+                return
+            self._report_restored_state()
+            return
+
+        self.cached_build, self.journal = \
+            self._read_state(self.config.map_cache and self.config.cache_file.is_local())
+        if self.cached_build is None:
+            return
+
+        if not self._holds_mode(self.cached_build):
+            if self.config.all_steps:
+                held = 'a single build, rather than one for each step'
+            else:
+                held = 'a build for each step (see --all-steps)'
+            print 'Warning: Cache file "%s" holds %s; it will be rewritten.' % \
+                (str(self.config.cache_file), held)
+            self._replace_cached_build(None)
+            self.journal = None
+            return
+
+        self._report_restored_state()
+
+    def _holds_mode(self, build):
+        # what the cache holds must suit --all-steps (or its absence)
+        return isinstance(build, BuildSteps) == self.config.all_steps
+
+    def _read_state(self, lazy):
+        """
+        Reads the cache file, returning a (build, journal) tuple: the cached
+        build (None if there is none usable), and the journal it came from
+        (None if the cache file is not a journal).
+        """
+        pickle_file = self.config.cache_file.open(FileModes.READ_ONLY)
+        if not pickle_file:
+            print 'Previous cache file "%s" not found.' % str(self.config.cache_file)
+            return (None, None)
+
+        if not lazy:
+            remembered = self._recall_baseline()
+            if remembered is not None:
+                self.config.cache_file.close()
+                return remembered
+
+        build = BuildData()
+        journal = None
+        try:
+            if BuildSteps.is_steps(pickle_file):
+                build = BuildSteps()
+                build.retrieve(pickle_file, lazy)
+            elif BuildJournal.is_journal(pickle_file):
+                journal = BuildJournal()
+                journal.retrieve(pickle_file)
+                build = journal.build()
+                if journal.damaged:
+                    print 'Warning: Cache journal "%s" is incomplete after build #%d; ' \
+                          'it will be rewritten.' % (str(self.config.cache_file),
+                                                     build.number)
+            else:
+                build.retrieve(pickle_file, lazy)
+        except (ValueError, EOFError, cPickle.UnpicklingError), error_object:
+            print 'Warning: Cache file "%s" could not be read; ignoring it.' % \
+                str(self.config.cache_file)
+            if self.config.debug_mode:
+                print '    ::', repr(error_object)
+            build = None
+            journal = None
+        self.config.cache_file.close()
+
+        if (build is not None) and (not lazy):
+            self._remember_baseline(build, journal)
+
+        return (build, journal)
+
+    def _recall_baseline(self):
+        if self.baselines is None:
+            return None
+
+        version = self.config.cache_file.version_token()
+        remembered = self.baselines.get(str(self.config.cache_file))
+        if (version is None) or (remembered is None) or (remembered[0] != version):
+            return None
+
+        if self.config.debug_mode:
+            print 'Cache file "%s" is unchanged; using the build already read.' % \
+                str(self.config.cache_file)
+        return remembered[1:]
+
+    def _remember_baseline(self, build, journal):
+        if self.baselines is None:
+            return
+
+        version = self.config.cache_file.version_token()
+        if version is None:
+            self._forget_baseline()
+        else:
+            self.baselines[str(self.config.cache_file)] = (version, build, journal)
+
+    def _forget_baseline(self):
+        if self.baselines is not None:
+            self.baselines.pop(str(self.config.cache_file), None)
+
+    def _report_restored_state(self):
+        if self.config.debug_mode:
+            print 'Restored state from cache file "%s":' % str(self.config.cache_file)
+            for build in self._cached_builds():
+                for line in build.warnings:
+                    print '    ::', line
@@ -1,265 +1,403 @@
-# pylint: disable=missing-docstring
-# pylint: disable=missing-docstring
-# pylint: disable=bad-whitespace
-# pylint: disable=too-many-instance-attributes
-# Classes may contain as many instance attributes required to perform their function
-
-import os
-import sys
-import md5
-import uuid
-import json
-import time
-import tempfile
-
-DROPBOX_AVAILABLE = True
-try:
-    import dropbox
-except ImportError:
-    DROPBOX_AVAILABLE = False
-
-from constants import FileModes
-
-MAXSINGLEDBFILE = 150*1024*1024
-
-#-------------------------------------------------------------------------#
-#     App: TeamCity9 Warning Watcher                                      #
-#  Module: dropbox.py                                                     #
-#  Author: Bob Hood                                                       #
-# License: LGPL-3.0                                                       #
-#   PyVer: 2.7.x                                                          #
-#  Detail: This module provides an interface to the Dropbox service.      #
-#     URL: https://www.dropbox.com/developers-v1/core/docs                #
-#-------------------------------------------------------------------------#
-
-def _make_dropbox_chunks(datapath, maxsingle):
-    """
-    This function is used in cases where file uploads exceed
-    the single-file limit of MAXSINGLEDBFILE
-    """
-
-    _basename = os.path.basename(datapath)
-    _size = os.path.getsize(datapath)
-    if (maxsingle == 0) or (_size <= maxsingle):
-        yield (datapath, _size)
-    else:
-        _counter = 1
-        _bufsize = 1024*1024
-        with open(datapath, 'rb') as _input:
-            _done = False
-            while not _done:
-                _chunk_name = '%04d_%s' % (_counter, _basename)
-                _chunk_path = os.path.join(tempfile.gettempdir(), _chunk_name)
-
-                _max_single = maxsingle
-                _bytes_read = 0
-                with open(_chunk_path, 'wb') as _output:
-                    while _max_single > 0:
-                        _data_amount = min(_bufsize, _max_single)
-                        _data = _input.read(_data_amount)
-                        if len(_data) == 0:
-                            # end of file
-                            _done = True
-                            break
-                        _output.write(_data)
-                        _max_single -= _data_amount
-                        _bytes_read += len(_data)
-
-                yield (_chunk_path, _bytes_read)
-                os.remove(_chunk_path)
-
-                _counter += 1
-
-class Dropbox(object):
-    def __init__(self, dropbox_path, local_file=None):
-        super(Dropbox, self).__init__()
-
-        self.dropbox = None
-        self.dropbox_token = ''
-        self.dropbox_path = ''
-
-        self.file_name = ''
-        self.local_file_open_state = 0
-        self.local_file_fp = None
-        self.local_file_md5 = 0
-
-        if local_file:
-            self.local_file = local_file
-        else:
-            temp_folder = tempfile.gettempdir()
-            self.local_file = os.path.join(temp_folder, str(uuid.uuid4()))
-
-        if dropbox_path.startswith('dropbox:') and DROPBOX_AVAILABLE:
-            items = dropbox_path.split(':')
-
-            if len(items) < 3:
-                print 'Error: Dropbox missing App access token: "%s"' % dropbox_path
-                sys.exit(1)
-
-            self.dropbox_token = items[1]
-            assert len(self.dropbox_token), \
-                'Error: Dropbox missing App access token: "%s"' % dropbox_path
-
-            self.dropbox_path = items[2]
-            if self.dropbox_path == '/':
-                self.dropbox_path = ''
-
-            try:
-                self.dropbox = dropbox.client.DropboxClient(self.dropbox_token)
-            except:
-                self.dropbox = None
-            else:
-                self._reset()
-
-    def available(self):
-        return self.dropbox is not None
-
-    def open(self, file_name, mode=FileModes.READ_ONLY):
-        if not self.dropbox:
-            return None
-
-        self.file_name = file_name
-        self.local_file_open_state = mode
-        self.local_file_fp = None
-        self.local_file_md5 = ''
-
-        if mode not in [FileModes.READ_ONLY, FileModes.WRITE_ONLY]:
-            return None
-
-        if (mode == FileModes.READ_ONLY) and (not os.path.exists(self.local_file)):
-            if not self._retrieve_file_locally():
-                return None
-
-        try:
-            self.local_file_fp = open(self.local_file,
-                                      'rb' if mode == FileModes.READ_ONLY else 'wb')
-        except IOError:
-            self.local_file_fp = None
-
-        if os.path.exists(self.local_file):
-            data = open(self.local_file).read()
-            local_file_md5 = md5.new()
-            local_file_md5.update(data)
-            self.local_file_md5 = local_file_md5.digest()
-
-        return self.local_file_fp
-
-    def close(self):
-        if (not self.dropbox) or \
-           (not os.path.exists(self.local_file)) or \
-           (not self.local_file_fp):
-            return
-
-        try:
-            self.local_file_fp.close()
-        except:
-            pass
-        self.local_file_fp = None
-
-        if os.path.exists(self.local_file) and \
-           (self.local_file_open_state == FileModes.WRITE_ONLY):
-
-            data = open(self.local_file).read()
-            local_file_md5 = md5.new()
-            local_file_md5.update(data)
-            current_md5 = local_file_md5.digest()
-
-            if self.local_file_md5 != current_md5:
-                # upload the modified file
-                if not self._store_file_remotely():
-                    print "Error: Could not store local file '%s' to Dropbox '%s/%s'" % \
-                        (self.local_file, self.dropbox_path, self.file_name)
-                    sys.exit(1)
-
-        self._reset()
-
-    def _reset(self):
-        if os.path.exists(self.local_file):
-            os.remove(self.local_file)
-
-    def _retrieve_file_locally(self):
-        full_dropbox_path = '%s/%s' % (self.dropbox_path, self.file_name)
-
-        try:
-            with open(self.local_file, 'w') as local_output:
-                with self.dropbox.get_file(full_dropbox_path) as dropbox_input:
-                    local_output.write(dropbox_input.read())
-        except IOError:
-            print "Error: Failed to retrieve remote Dropbox file '%s'" % full_dropbox_path
-            return False
-        except dropbox.rest.ErrorResponse, error_object:
-            if error_object.status == 404:
-                # it probably doesn't exist yet
-                self._reset()
-            else:
-                print "Error %d: Failed to retrieve remote Dropbox file '%s': %s" % \
-                   (error_object.status, full_dropbox_path, error_object.error_msg)
-            return False
-
-        return True
-
-    def _store_file_remotely(self):
-        full_dropbox_path = '%s/%s' % (self.dropbox_path, self.file_name)
-
-        # we can use a chunked uploader for any size file,
-        # but it's really intended for files larger than the
-        # MAXSINGLEDBFILE limit.  for smaller files, though,
-        # the Dropbox.put_file() method is probably lighter
-        # and more efficient.
-
-        file_size = os.stat(self.local_file).st_size
-        if file_size > MAXSINGLEDBFILE:
-            failed = False
-            for chunk in _make_dropbox_chunks(self.local_file, MAXSINGLEDBFILE):
-                with open(chunk[0], 'rb') as local_input:
-                    uploader = self.dropbox.get_chunked_uploader(local_input, chunk[1])
-                    try_counter = 0
-                    while uploader.offset < chunk[1]:
-                        try:
-                            upload_json = uploader.upload_chunked()
-                        except dropbox.rest.ErrorResponse, error_object:
-                            try_counter += 1
-                            print "Warning: Dropbox upload failed; retry count %d" % try_counter
-                            if try_counter == 5:
-                                failed = True
-                                break
-                            time.sleep(1.0)
-
-                    if not failed:
-                        try:
-                            response_json = uploader.finish(full_dropbox_path, overwrite=True)
-                        except dropbox.rest.ErrorResponse, error_object:
-                            print "Dropbox Error %d: File '%s': '%s'" % \
-                                (error_object.status, full_dropbox_path, error_object.message)
-                            return False
-                        except:
-                            print "Error: Failed to add remote Dropbox file '%s'" % \
-                                full_dropbox_path
-                            return False
-                        else:
-                            #json_data = json.loads(response_json)
-                            #print 'Dropbox: Uploaded "%s"' % json_data["path"]
-                            pass
-        else:
-            # simple put_file() will do
-            with open(self.local_file, 'rb') as local_file_input:
-                try:
-                    response_json = self.dropbox.put_file(
-                        full_dropbox_path, local_file_input, overwrite=True)
-                except dropbox.rest.ErrorResponse, error_object:
-                    print "Dropbox Error %d: File '%s': '%s'" % \
-                        (error_object.status, full_dropbox_path, error_object.message)
-                    return False
-                except:
-                    print "Error: Failed to add remote Dropbox file '%s'" % \
-                        full_dropbox_path
-                    return False
-                else:
-                    #json_data = json.loads(response_json)
-                    #print 'Dropbox: Uploaded "%s"' % json_data["path"]
-                    pass
-
-        return True
-
-    def __str__(self):
-        return 'dropbox:%s/%s' % (self.dropbox_path, self.file_name)
+# pylint: disable=missing-docstring
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+# pylint: disable=too-many-instance-attributes
+# Classes may contain as many instance attributes required to perform their function
+
+import os
+import sys
+import md5
+import uuid
+import json
+import time
+import tempfile
+
+DROPBOX_AVAILABLE = True
+try:
+    import dropbox
+except ImportError:
+    DROPBOX_AVAILABLE = False
+
+from constants import FileModes
+
+MAXSINGLEDBFILE = 150*1024*1024
+UPLOADCHUNKSIZE = 4*1024*1024
+HASHBLOCKSIZE = 1024*1024
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: dropbox.py                                                     #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module provides an interface to the Dropbox service.      #
+#     URL: https://www.dropbox.com/developers-v1/core/docs                #
+#-------------------------------------------------------------------------#
+
+def _file_digest(file_name):
+    """
+    Returns an MD5 object that has consumed the contents of 'file_name',
+    read a block at a time.
+    """
+    digest = md5.new()
+    with open(file_name, 'rb') as file_input:
+        while True:
+            data = file_input.read(HASHBLOCKSIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest
+
+class HashingWriter(object):
+    """
+    Wraps a file opened for writing, keeping an MD5 digest of everything
+    written through it, so the file never has to be read back to find out
+    whether it changed.  Anything else is passed to the file itself.
+    """
+    def __init__(self, file_object, digest=None):
+        super(HashingWriter, self).__init__()
+        self.file_object = file_object
+        self.md5 = digest if digest is not None else md5.new()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.file_object.write(data)
+
+    def digest(self):
+        return self.md5.digest()
+
+    def __getattr__(self, name):
+        return getattr(self.file_object, name)
+
+class Dropbox(object):
+    def __init__(self, dropbox_path, local_file=None, mirror=None, stale_limit=0):
+        super(Dropbox, self).__init__()
+
+        self.dropbox = None
+        self.dropbox_token = ''
+        self.dropbox_path = ''
+
+        self.file_name = ''
+        self.local_file_open_state = 0
+        self.local_file_fp = None
+        self.local_file_md5 = 0
+        self.mirror_validator = None
+
+        # the revision of the file when it was last read (None if it did
+        # not exist); uploads are unconditional if it was never read
+        self.rev = None
+        self.rev_known = False
+        self.conflicted = False
+
+        # bytes downloaded and uploaded
+        self.bytes_transferred = 0
+
+        # with a mirror (see cache_mirror.py), the local file is kept between
+        # runs, and only downloaded again if the Dropbox revision changes
+        self.mirror = mirror
+        self.stale_limit = stale_limit
+
+        if mirror:
+            self.local_file = mirror.file_name
+        elif local_file:
+            self.local_file = local_file
+        else:
+            temp_folder = tempfile.gettempdir()
+            self.local_file = os.path.join(temp_folder, str(uuid.uuid4()))
+
+        if dropbox_path.startswith('dropbox:') and DROPBOX_AVAILABLE:
+            items = dropbox_path.split(':')
+
+            if len(items) < 3:
+                print 'Error: Dropbox missing App access token: "%s"' % dropbox_path
+                sys.exit(1)
+
+            self.dropbox_token = items[1]
+            assert len(self.dropbox_token), \
+                'Error: Dropbox missing App access token: "%s"' % dropbox_path
+
+            self.dropbox_path = items[2]
+            if self.dropbox_path == '/':
+                self.dropbox_path = ''
+
+            try:
+                self.dropbox = dropbox.client.DropboxClient(self.dropbox_token)
+            except:
+                self.dropbox = None
+            else:
+                if not self.mirror:
+                    self._reset()
+
+    def available(self):
+        return self.dropbox is not None
+
+    def open(self, file_name, mode=FileModes.READ_ONLY):
+        if not self.dropbox:
+            return None
+
+        self.file_name = file_name
+        self.local_file_open_state = mode
+        self.local_file_fp = None
+        self.local_file_md5 = ''
+
+        if mode not in [FileModes.READ_ONLY, FileModes.WRITE_ONLY, FileModes.APPEND]:
+            return None
+
+        if (mode == FileModes.APPEND) and self.mirror and \
+           self.rev_known and self.mirror.matches(self.rev):
+            # append to what we read; if the file has been changed since,
+            # the upload will find out
+            pass
+        elif mode != FileModes.WRITE_ONLY:
+            # Dropbox cannot append to a file in place, so an appended
+            # file is brought down whole, and sent back whole
+            if (not self._refresh_local_file()) and (mode == FileModes.READ_ONLY):
+                return None
+
+        self.mirror_validator = None
+        if self.mirror and (mode != FileModes.READ_ONLY):
+            # until it is uploaded, the local file matches no revision
+            self.mirror_validator = self.mirror.validator
+            self.mirror.invalidate()
+
+        # a file being written is hashed as it is written; an appended file
+        # picks up from the hash of what it already holds
+        digest = None
+        if (mode != FileModes.READ_ONLY) and os.path.exists(self.local_file):
+            digest = _file_digest(self.local_file)
+            self.local_file_md5 = digest.digest()
+            if mode == FileModes.WRITE_ONLY:
+                digest = None
+
+        try:
+            self.local_file_fp = open(self.local_file,
+                                      {FileModes.READ_ONLY : 'rb',
+                                       FileModes.WRITE_ONLY : 'wb',
+                                       FileModes.APPEND : 'ab'}[mode])
+        except IOError:
+            self.local_file_fp = None
+        else:
+            if mode != FileModes.READ_ONLY:
+                self.local_file_fp = HashingWriter(self.local_file_fp, digest)
+
+        return self.local_file_fp
+
+    def close(self):
+        """
+        Closes the local file, uploading it if it was changed.  Returns
+        False if the upload was abandoned because the Dropbox file was
+        changed by someone else since we read it.
+        """
+        if (not self.dropbox) or \
+           (not os.path.exists(self.local_file)) or \
+           (not self.local_file_fp):
+            return True
+
+        current_md5 = None
+        if self.local_file_open_state in [FileModes.WRITE_ONLY, FileModes.APPEND]:
+            current_md5 = self.local_file_fp.digest()
+
+        try:
+            self.local_file_fp.close()
+        except:
+            pass
+        self.local_file_fp = None
+
+        if os.path.exists(self.local_file) and (current_md5 is not None):
+            if self.local_file_md5 != current_md5:
+                # upload the modified file
+                self.conflicted = False
+                if not self._store_file_remotely():
+                    if self.conflicted:
+                        return False
+                    print "Error: Could not store local file '%s' to Dropbox '%s/%s'" % \
+                        (self.local_file, self.dropbox_path, self.file_name)
+                    sys.exit(1)
+            elif self.mirror and (self.mirror_validator is not None):
+                # unchanged, so it still matches the revision it came from
+                self.mirror.update(self.mirror_validator)
+
+        if not self.mirror:
+            self._reset()
+        return True
+
+    def _reset(self):
+        if self.mirror:
+            self.mirror.discard()
+        elif os.path.exists(self.local_file):
+            os.remove(self.local_file)
+
+    def _refresh_local_file(self):
+        """
+        Makes sure the local file holds the current Dropbox file.  With a
+        mirror, this costs a metadata request unless the file has changed.
+        """
+        self.rev = None
+        self.rev_known = False
+
+        if not self.mirror:
+            if os.path.exists(self.local_file):
+                return True
+            return self._retrieve_file_locally()
+
+        full_dropbox_path = '%s/%s' % (self.dropbox_path, self.file_name)
+
+        try:
+            metadata = self.dropbox.metadata(full_dropbox_path)
+        except dropbox.rest.ErrorResponse, error_object:
+            if error_object.status == 404:
+                # it probably doesn't exist yet
+                self.rev_known = True
+                self.mirror.discard()
+                return False
+            return self._use_stale_file(error_object)
+        except Exception, error_object:
+            return self._use_stale_file(error_object)
+
+        self.rev_known = True
+        if metadata.get('is_deleted', False):
+            self.mirror.discard()
+            return False
+
+        self.rev = metadata['rev']
+        if self.mirror.matches(metadata['rev']):
+            return True
+        return self._retrieve_file_locally(metadata['rev'])
+
+    def _use_stale_file(self, error_object):
+        print "Warning: Failed to check remote Dropbox file '%s/%s': %s" % \
+            (self.dropbox_path, self.file_name, str(error_object))
+        if not self.mirror.usable_when_stale(self.stale_limit):
+            return False
+        print 'Warning: Using the local copy last matched %d seconds ago: "%s"' % \
+            (int(self.mirror.age()), self.local_file)
+        return True
+
+    def _retrieve_file_locally(self, rev=None):
+        full_dropbox_path = '%s/%s' % (self.dropbox_path, self.file_name)
+        output_file = self.mirror.temp_file_name() if self.mirror else self.local_file
+
+        try:
+            with open(output_file, 'wb') as local_output:
+                with self.dropbox.get_file(full_dropbox_path, rev=rev) as dropbox_input:
+                    while True:
+                        data = dropbox_input.read(UPLOADCHUNKSIZE)
+                        if not data:
+                            break
+                        local_output.write(data)
+                        self.bytes_transferred += len(data)
+            if self.mirror:
+                self.mirror.replace(output_file, rev)
+        except IOError:
+            print "Error: Failed to retrieve remote Dropbox file '%s'" % full_dropbox_path
+            return False
+        except dropbox.rest.ErrorResponse, error_object:
+            if error_object.status == 404:
+                # it probably doesn't exist yet
+                self._reset()
+            else:
+                print "Error %d: Failed to retrieve remote Dropbox file '%s': %s" % \
+                   (error_object.status, full_dropbox_path, error_object.error_msg)
+            return False
+
+        return True
+
+    def _store_file_remotely(self):
+        full_dropbox_path = '%s/%s' % (self.dropbox_path, self.file_name)
+
+        # we can use a chunked uploader for any size file,
+        # but it's really intended for files larger than the
+        # MAXSINGLEDBFILE limit.  for smaller files, though,
+        # the Dropbox.put_file() method is probably lighter
+        # and more efficient.
+
+        file_size = os.stat(self.local_file).st_size
+        if file_size > MAXSINGLEDBFILE:
+            # a single upload session covers the whole file; the uploader
+            # reads it straight from disk, one chunk at a time
+            with open(self.local_file, 'rb') as local_input:
+                uploader = self.dropbox.get_chunked_uploader(local_input, file_size)
+                try_counter = 0
+                while uploader.offset < file_size:
+                    try:
+                        uploader.upload_chunked(UPLOADCHUNKSIZE)
+                    except dropbox.rest.ErrorResponse, error_object:
+                        # the uploader keeps the chunk that failed, and
+                        # sends it again
+                        try_counter += 1
+                        print "Warning: Dropbox upload failed; retry count %d" % try_counter
+                        if try_counter == 5:
+                            return False
+                        time.sleep(1.0)
+
+                try:
+                    response_json = uploader.finish(full_dropbox_path,
+                                                    overwrite=not self.rev_known,
+                                                    parent_rev=self.rev)
+                except dropbox.rest.ErrorResponse, error_object:
+                    print "Dropbox Error %d: File '%s': '%s'" % \
+                        (error_object.status, full_dropbox_path, error_object.message)
+                    return False
+                except:
+                    print "Error: Failed to add remote Dropbox file '%s'" % \
+                        full_dropbox_path
+                    return False
+                else:
+                    #json_data = json.loads(response_json)
+                    #print 'Dropbox: Uploaded "%s"' % json_data["path"]
+                    self.bytes_transferred += file_size
+                    return self._uploaded(response_json, full_dropbox_path)
+        else:
+            # simple put_file() will do
+            with open(self.local_file, 'rb') as local_file_input:
+                try:
+                    response_json = self.dropbox.put_file(
+                        full_dropbox_path, local_file_input,
+                        overwrite=not self.rev_known, parent_rev=self.rev)
+                except dropbox.rest.ErrorResponse, error_object:
+                    print "Dropbox Error %d: File '%s': '%s'" % \
+                        (error_object.status, full_dropbox_path, error_object.message)
+                    return False
+                except:
+                    print "Error: Failed to add remote Dropbox file '%s'" % \
+                        full_dropbox_path
+                    return False
+                else:
+                    #json_data = json.loads(response_json)
+                    #print 'Dropbox: Uploaded "%s"' % json_data["path"]
+                    self.bytes_transferred += file_size
+                    return self._uploaded(response_json, full_dropbox_path)
+
+    def _uploaded(self, metadata, full_dropbox_path):
+        try:
+            stored_path = metadata['path']
+            rev = metadata['rev']
+        except (KeyError, TypeError):
+            stored_path = full_dropbox_path
+            rev = None
+
+        if stored_path.lower() != full_dropbox_path.lower():
+            # the file had moved on from the revision we read, so Dropbox
+            # kept ours as a "conflicted copy"; that is not wanted
+            try:
+                self.dropbox.file_delete(stored_path)
+            except:
+                pass
+            if self.mirror:
+                self.mirror.discard()
+            self.conflicted = True
+            return False
+
+        self.rev = rev
+        self.rev_known = rev is not None
+
+        # the local file is now the mirror of the new revision
+        if self.mirror:
+            if rev is not None:
+                self.mirror.update(rev)
+            else:
+                self.mirror.invalidate()
+        return True
+
+    def __str__(self):
+        return 'dropbox:%s/%s' % (self.dropbox_path, self.file_name)
@@ -0,0 +1,116 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import re
+
+AHOCORASICK_AVAILABLE = True
+try:
+    import ahocorasick
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: fragment_matcher.py                                            #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module finds which of the --fail-on-fragment text         #
+#          fragments appear in a line of build output, all of them in a   #
+#          single pass over the line.                                     #
+#-------------------------------------------------------------------------#
+
+# If the 'pyahocorasick' package is installed, its Aho-Corasick automaton
+# does the work.  Otherwise, the fragments are merged into a trie, and the
+# trie written out as a regular expression (so that at each position of the
+# line, only the fragments starting with the character found there are
+# followed, in C).  The expression matches the longest fragment starting
+# at a position; any shorter fragment starting there is a prefix of it.
+
+def _trie_expression(fragments):
+    trie = {}
+    for fragment in fragments:
+        node = trie
+        for character in fragment:
+            node = node.setdefault(character, {})
+        node[None] = True
+
+    def branch(node):
+        children = [re.escape(character) + branch(node[character]) \
+                    for character in sorted([key for key in node if key is not None])]
+        if not children:
+            return ''
+        expression = children[0] if len(children) == 1 else '(?:%s)' % '|'.join(children)
+        if None in node:
+            # a fragment ends here, but a longer one may go on
+            expression = '(?:%s)?' % expression
+        return expression
+
+    return branch(trie)
+
+class FragmentMatcher(object):
+    """
+    Built once from the list of fragments (empty ones are ignored), and
+    then asked about each line.
+    """
+    def __init__(self, fragments):
+        super(FragmentMatcher, self).__init__()
+
+        self.fragments = []
+        for fragment in fragments:
+            if fragment and (fragment not in self.fragments):
+                self.fragments.append(fragment)
+
+        self.automaton = None
+        self.expression = None
+        if not self.fragments:
+            return
+
+        if AHOCORASICK_AVAILABLE:
+            self.automaton = ahocorasick.Automaton()
+            for fragment in self.fragments:
+                self.automaton.add_word(fragment, fragment)
+            self.automaton.make_automaton()
+        else:
+            expression = _trie_expression(self.fragments)
+            self.expression = re.compile(expression)
+            # (the lookahead finds a fragment at every position, even
+            # inside another one)
+            self.positions = re.compile('(?=(%s))' % expression)
+
+            # each fragment, and the fragments that are prefixes of it
+            self.prefixes = {}
+            for fragment in self.fragments:
+                self.prefixes[fragment] = [other for other in self.fragments \
+                                           if fragment.startswith(other)]
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def search(self, line):
+        """
+        True if any of the fragments appear in 'line'.
+        """
+        if self.automaton is not None:
+            for _ in self.automaton.iter(line):
+                return True
+            return False
+        if self.expression is not None:
+            return self.expression.search(line) is not None
+        return False
+
+    def find_all(self, line):
+        """
+        Returns the set of the fragments that appear in 'line'.
+        """
+        if self.automaton is not None:
+            return set([fragment for _, fragment in self.automaton.iter(line)])
+
+        if (self.expression is None) or (self.expression.search(line) is None):
+            # (by far the most common case)
+            return set()
+
+        found = set()
+        for match in self.positions.finditer(line):
+            found.update(self.prefixes[match.group(1)])
+        return found
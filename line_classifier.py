@@ -0,0 +1,143 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: line_classifier.py                                             #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module houses the classifiers that decide whether a line  #
+#          of build output is a warning message.  The classifier is       #
+#          chosen once, from the builder's configuration, instead of      #
+#          re-examining the configuration for every line.                 #
+#-------------------------------------------------------------------------#
+
+class LineClassifier(object):
+    """
+    Base class for the classifiers.  classify() returns None if the line is
+    not a warning, otherwise a (line, compression_key) tuple, where the key
+    identifies the warning for counting purposes and may be None.
+    """
+
+    mode = None
+
+    def __init__(self):
+        super(LineClassifier, self).__init__()
+
+        # throughput counters
+        self.lines = 0          # lines examined
+        self.characters = 0     # characters examined
+        self.evaluations = 0    # regular expression evaluations performed
+        self.matches = 0        # lines identified as warnings
+
+    @staticmethod
+    def create(teamcity):
+        if teamcity.warning_regex:
+            return RegexClassifier(teamcity.warning_regex)
+        if teamcity.warning_format is not None:
+            return FormatClassifier(teamcity.warning_format_regex[teamcity.warning_format],
+                                    teamcity.warning_format_prefilter[teamcity.warning_format])
+        return TextClassifier(teamcity.warning_text)
+
+    def classify(self, line):
+        raise NotImplementedError
+
+    def counts(self):
+        # the throughput counters, as a dictionary that can be handed back
+        # from a worker process (see parallel_scan.py)
+        return dict([(name, value) for name, value in vars(self).items() \
+                     if isinstance(value, (int, long))])
+
+    def add_counts(self, counts):
+        for name, value in counts.items():
+            setattr(self, name, getattr(self, name, 0) + value)
+
+    def report(self, elapsed=None):
+        print 'Classifier (%s): %d lines, %d characters, %d regex evaluations, ' \
+              '%d warnings' % (self.mode, self.lines, self.characters,
+                               self.evaluations, self.matches)
+        if elapsed:
+            print '    %.0f lines/sec, %.0f characters/sec' % \
+                (self.lines / elapsed, self.characters / elapsed)
+
+class RegexClassifier(LineClassifier):
+    """
+    WarningRegex: the (already compiled) expression is searched for in each
+    line; its first group is the compression key.
+    """
+
+    mode = 'regex'
+
+    def __init__(self, expression):
+        super(RegexClassifier, self).__init__()
+        self.search = expression.search
+
+    def classify(self, line):
+        self.lines += 1
+        self.characters += len(line)
+        self.evaluations += 1
+
+        result = self.search(line)
+        if not result:
+            return None
+
+        self.matches += 1
+        return (line, result.group(1) if result.lastindex else None)
+
+class FormatClassifier(LineClassifier):
+    """
+    WarningFormat: a literal fragment that every warning of the format must
+    contain is tested first, so the regular expression is only evaluated
+    for the (few) lines that could actually match.  The whole match is the
+    compression key.
+    """
+
+    mode = 'format'
+
+    def __init__(self, expression, prefilter):
+        super(FormatClassifier, self).__init__()
+        self.search = expression.search
+        self.prefilter = prefilter
+        self.rejected = 0       # lines dismissed by the prefilter
+
+    def classify(self, line):
+        self.lines += 1
+        self.characters += len(line)
+
+        if self.prefilter not in line:
+            self.rejected += 1
+            return None
+
+        self.evaluations += 1
+        result = self.search(line)
+        if not result:
+            return None
+
+        self.matches += 1
+        return (line, result.group(0))
+
+    def report(self, elapsed=None):
+        super(FormatClassifier, self).report(elapsed)
+        print '    %d lines rejected by the "%s" prefilter' % (self.rejected, self.prefilter)
+
+class TextClassifier(LineClassifier):
+    """
+    WarningText: a simple substring test.  There is no compression key.
+    """
+
+    mode = 'text'
+
+    def __init__(self, text):
+        super(TextClassifier, self).__init__()
+        self.text = text
+
+    def classify(self, line):
+        self.lines += 1
+        self.characters += len(line)
+
+        if self.text not in line:
+            return None
+
+        self.matches += 1
+        return (line, None)
@@ -1,102 +1,256 @@
-import os
-import time
-import glob
-import hashlib
-
-#-------------------------------------------------------------------------#
-#     App: TeamCity9 Warning Watcher                                      #
-#  Module: log_manager.py                                                 #
-#  Author: Bob Hood                                                       #
-# License: LGPL-3.0                                                       #
-#   PyVer: 2.7.x                                                          #
-#  Detail: This module gathers up all available TeamCity build logs and   #
-#          stores them in descending chronological order for access by    #
-#          other parts of the system.                                     #
-#-------------------------------------------------------------------------#
-
-class Log(object):
-    def __init__(self, file_name):
-        super(Log, self).__init__()
-
-        self.file_name = file_name
-        self.name = os.path.split(file_name)[-1]
-        self.timestamp = os.stat(file_name).st_mtime
-
-        self.key = None
-        self._calculate_log_signature()
-
-    def _calculate_log_signature(self):
-        m = hashlib.md5()
-        try:
-            with open(self.file_name) as log:
-                for i in range(3):
-                    s = log.readline()
-                    if len(s) == 0:
-                        # not enough lines yet in the file to calculate a key
-                        return
-                    m.update(log.readline())
-
-            self.key = m.digest()
-        except:
-            self.key = None
-
-class LogManager(object):
-    def __init__(self, config):
-        self.config = config
-        self._update_logs()
-
-    def _update_logs(self):
-        # establish our current environment
-        self.logs = []
-        for file_name in glob.glob(os.path.join(self.config.teamcity.build_agent_log_path, 'teamcity-build.log*')):
-            self.logs.append(Log(file_name))
-
-        if len(self.logs):
-            # sort logs by their timestamps
-            # logs at the start of the list are newer than those later in the list
-            self.logs.sort(key=lambda x: x.timestamp, reverse=True)
-
-            # creat a map for quick access by key
-            self.log_map = {}
-            for log in self.logs:
-                self.log_map[log.key] = log
-
-    def get_newer(self, key):
-        newer_log = None
-
-        newer_log_index = None
-        for i in range(len(self.logs)):
-            if self.logs[i].key == key:
-                if i > 0:
-                    newer_log = self.logs[i - 1]
-                    break
-
-        return newer_log
-
-    def get_newest(self):
-        newest_log = None
-
-        if len(self.logs):
-            newest_log = self.logs[0]
-
-        return newest_log
-
-    def get_older(self, key):
-        older_log = None
-
-        older_log_index = None
-        for i in range(len(self.logs)):
-            if self.logs[i].key == key:
-                if i < len(self.logs):
-                    older_log = self.logs[i + 1]
-                    break
-
-        return older_log
-
-    def get_oldest(self):
-        oldest_log = None
-
-        if len(self.logs):
-            oldest_log = self.logs[-1]
-
-        return oldest_log
+import io
+import os
+import bz2
+import gzip
+import time
+import glob
+import hashlib
+import cPickle
+
+LZMA_AVAILABLE = True
+try:
+    from backports import lzma
+except ImportError:
+    try:
+        import lzma
+    except ImportError:
+        LZMA_AVAILABLE = False
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: log_manager.py                                                 #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module gathers up all available TeamCity build logs and   #
+#          stores them in descending chronological order for access by    #
+#          other parts of the system.                                     #
+#-------------------------------------------------------------------------#
+
+# Each log is identified by a signature (Log.key) taken from its first
+# lines, which stays the same as the log is rotated (renamed).  Computing
+# it means opening the log, so the signatures are kept in a catalog
+# alongside the cache (tcww_<agent>.logs), under the log's (inode, size,
+# modification time).  Only logs that are new, or have changed since the
+# last run, are opened again.
+
+SIGNATURELINES = 3
+
+# Older logs may have been compressed once rotated ('.gz', '.bz2' or
+# '.xz').  They are decompressed as they are read, so they hold the same
+# lines (and the same signature, and the same offsets within the build
+# index) as they did before.  A compressed log can only seek forward, by
+# decompressing up to the offset.
+
+def _open_gzip(file_name, buffer_size):
+    # GzipFile's own readline() is slow; a buffered reader over it is not
+    return io.BufferedReader(gzip.GzipFile(file_name, 'rb'),
+                             buffer_size if buffer_size > 0 else io.DEFAULT_BUFFER_SIZE)
+
+def _open_bzip2(file_name, buffer_size):
+    return bz2.BZ2File(file_name, 'r', max(0, buffer_size))
+
+def _open_xz(file_name, buffer_size):
+    return lzma.LZMAFile(file_name, 'rb')
+
+COMPRESSION = {
+    '.gz'  : _open_gzip,
+    '.bz2' : _open_bzip2,
+    '.xz'  : _open_xz,
+}
+
+def log_compression(file_name):
+    """
+    Returns the extension of a compressed log, or None if it is not one.
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    return extension if extension in COMPRESSION else None
+
+def can_read_log(file_name):
+    return (log_compression(file_name) != '.xz') or LZMA_AVAILABLE
+
+def open_log(file_name, buffer_size=-1):
+    """
+    Opens a log for reading, in binary mode, decompressing it on the fly
+    if it is compressed.
+    """
+    compression = log_compression(file_name)
+    if compression is None:
+        return open(file_name, 'rb', buffer_size)
+    return COMPRESSION[compression](file_name, buffer_size)
+
+class Log(object):
+    def __init__(self, file_name, info=None, key=None):
+        super(Log, self).__init__()
+
+        self.file_name = file_name
+        self.name = os.path.split(file_name)[-1]
+
+        # a compressed log is a rotated one, and never changes
+        self.compressed = log_compression(file_name) is not None
+
+        if info is None:
+            info = os.stat(file_name)
+        self.timestamp = info.st_mtime
+        self.identity = (info.st_ino, info.st_size, info.st_mtime)
+
+        # the logs either side of this one (see LogManager)
+        self.newer = None
+        self.older = None
+
+        self.key = key
+        if self.key is None:
+            self._calculate_log_signature()
+
+    def open(self, buffer_size=-1):
+        return open_log(self.file_name, buffer_size)
+
+    def _calculate_log_signature(self):
+        m = hashlib.md5()
+        try:
+            with self.open() as log:
+                for i in range(SIGNATURELINES):
+                    s = log.readline()
+                    if len(s) == 0:
+                        # not enough lines yet in the file to calculate a key
+                        return
+                    m.update(s)
+
+            self.key = m.digest()
+        except:
+            self.key = None
+
+class LogManager(object):
+    CATALOGVERSION = 2
+
+    def __init__(self, config):
+        self.config = config
+
+        # the timer of the step being run (a long-lived LogManager is
+        # handed that of each step in turn)
+        self.timer = config.timer
+        self.timer.start('logs')
+
+        self.catalog_file = None
+        if self.config.state_path is not None:
+            self.catalog_file = os.path.join(self.config.state_path,
+                                             'tcww_%s.logs' % self.config.teamcity.agent_name)
+
+        # (inode, size, modification time) -> Log.key
+        self.catalog = {}
+        self._load_catalog()
+
+        # compressed logs we have no means of reading (already reported)
+        self.unreadable = set()
+
+        self._update_logs()
+
+        self.timer.stop('logs')
+
+    def _load_catalog(self):
+        if self.config.reset_cache or (self.catalog_file is None) or \
+           (not os.path.exists(self.catalog_file)):
+            return
+
+        try:
+            with open(self.catalog_file, 'rb') as catalog_input:
+                version = cPickle.load(catalog_input)
+                if version == LogManager.CATALOGVERSION:
+                    self.catalog = cPickle.load(catalog_input)
+        except:
+            print 'Warning: Log catalog "%s" could not be read; rebuilding.' % self.catalog_file
+            self.catalog = {}
+
+    def _save_catalog(self):
+        if self.catalog_file is None:
+            return
+
+        try:
+            with open(self.catalog_file, 'wb') as catalog_output:
+                cPickle.dump(LogManager.CATALOGVERSION, catalog_output, 2)
+                cPickle.dump(self.catalog, catalog_output, 2)
+        except:
+            print 'Warning: Log catalog "%s" could not be written.' % self.catalog_file
+
+    def refresh(self):
+        """
+        Picks up logs that have been created (or rotated) since.
+        """
+        with self.timer.phase('logs'):
+            self._update_logs()
+
+    def _update_logs(self):
+        # establish our current environment
+        self.logs = []
+        catalog = {}
+        for file_name in glob.glob(os.path.join(self.config.teamcity.build_agent_log_path,
+                                                'teamcity-build.log*')):
+            if not can_read_log(file_name):
+                if file_name not in self.unreadable:
+                    print 'Warning: Skipping compressed log "%s"; reading it requires ' \
+                          'the backports.lzma module.' % file_name
+                    self.unreadable.add(file_name)
+                continue
+
+            try:
+                info = os.stat(file_name)
+            except OSError:
+                # rotated away from beneath us
+                continue
+
+            identity = (info.st_ino, info.st_size, info.st_mtime)
+            log = Log(file_name, info, self.catalog.get(identity))
+            if log.key is not None:
+                catalog[identity] = log.key
+            self.logs.append(log)
+
+        if catalog != self.catalog:
+            self.catalog = catalog
+            self._save_catalog()
+
+        # sort logs by their timestamps
+        # logs at the start of the list are newer than those later in the list
+        self.logs.sort(key=lambda x: x.timestamp, reverse=True)
+
+        # link each log to its neighbours, and create a map for quick access by key
+        self.log_map = {}
+        newer_log = None
+        for log in self.logs:
+            log.newer = newer_log
+            if newer_log is not None:
+                newer_log.older = log
+            newer_log = log
+            if log.key is not None:
+                self.log_map[log.key] = log
+
+    def get_newer(self, key):
+        log = self.log_map.get(key)
+        return log.newer if log is not None else None
+
+    def get_chain(self, log):
+        """
+        Yields 'log' followed by each newer log, oldest first.
+        """
+        while log is not None:
+            yield log
+            log = log.newer
+
+    def get_newest(self):
+        newest_log = None
+
+        if len(self.logs):
+            newest_log = self.logs[0]
+
+        return newest_log
+
+    def get_older(self, key):
+        log = self.log_map.get(key)
+        return log.older if log is not None else None
+
+    def get_oldest(self):
+        oldest_log = None
+
+        if len(self.logs):
+            oldest_log = self.logs[-1]
+
+        return oldest_log
@@ -0,0 +1,220 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import mmap
+
+from constants import LogEvents
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: log_pipeline.py                                                #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module breaks the reading of the TeamCity build logs into #
+#          a chain of streaming stages, each of which can be replaced or  #
+#          timed on its own.                                              #
+#-------------------------------------------------------------------------#
+
+# The pipeline, from source to sink, is:
+#
+#    reader        -> log lines, crossing rotated (and possibly compressed)
+#                     logs (read_logs, map_logs)
+#    splitter      -> (event, line) for build starts/ends and output lines
+#    prefix strip  -> output lines without the TeamCity prefix
+#    suffix split  -> output lines split on the OS X '[-W...]' suffixes
+#    classifier    -> output lines that are warnings become WARNING events
+#    sink          -> the DeltaGenerator
+#
+# Every stage is a generator that consumes the one before it, so only a
+# line (or a read-ahead buffer) is ever held in memory, however large the
+# logs are.
+#
+# The DeltaGenerator decides which build it is interested in, so the reader
+# and splitter are handed a 'collecting' callable that returns True while
+# the sink is inside such a build.  Because the stages are pulled one item
+# at a time, 'collecting' always reflects every event already delivered.
+
+READAHEAD = 1024 * 1024
+
+OUTPUT_MARKER = ' out - '
+
+def _read_log(log, offset, buffer_size=READAHEAD):
+    with log.open(buffer_size) as log_file:
+        log_file.seek(offset)
+        for log_line in log_file:
+            if log_line.endswith('\n'):
+                log_line = log_line.rstrip()
+            yield log_line
+
+def read_logs(log_manager, log, offset, markers, collecting, buffer_size=READAHEAD):
+    """
+    Reader: yields every line of 'log' (starting at 'offset') and of each
+    newer log.  Lines have any trailing whitespace removed if they were
+    newline-terminated.
+    """
+    for current_log in log_manager.get_chain(log):
+        for log_line in _read_log(current_log, offset, buffer_size):
+            yield log_line
+        offset = 0
+
+def _find(buf, fragment, start, end):
+    ndx = buf.find(fragment, start, end)
+    return end if ndx == -1 else ndx
+
+def map_logs(log_manager, log, offset, markers, collecting):
+    """
+    Reader: memory-maps each log and uses find() to jump between the
+    'markers' (build start, build end, output).  Outside of a build only
+    the build start lines are yielded; inside one, the build start/end
+    lines and the output lines are.  Every other line is skipped without
+    ever becoming a string.  (Compressed logs cannot be mapped, and are
+    read line by line.)
+    """
+    build_start, build_end, output = markers
+
+    for current_log in log_manager.get_chain(log):
+        if current_log.compressed:
+            # there is nothing to map; every line is handed on, and the
+            # splitter picks out the same ones
+            for log_line in _read_log(current_log, offset):
+                yield log_line
+            offset = 0
+            continue
+
+        with open(current_log.file_name, 'rb') as log_file:
+            size = os.fstat(log_file.fileno()).st_size
+            if size > offset:
+                buf = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    pos = offset
+
+                    # the next occurrence of each marker at or after 'pos';
+                    # only searched for again once we have moved past it
+                    next_start = next_end = next_output = -1
+
+                    while pos < size:
+                        if next_start < pos:
+                            next_start = _find(buf, build_start, pos, size)
+                        hit = next_start
+
+                        if collecting():
+                            if next_end < pos:
+                                next_end = _find(buf, build_end, pos, size)
+                            if next_output < pos:
+                                next_output = _find(buf, output, pos, size)
+                            hit = min(hit, next_end, next_output)
+
+                        if hit == size:
+                            break
+
+                        # 'pos' is always at the start of a line, so the line
+                        # holding the marker starts at the last newline before it
+                        line_start = buf.rfind('\n', pos, hit) + 1
+                        if line_start == 0:
+                            line_start = pos
+
+                        line_end = buf.find('\n', hit)
+                        if line_end == -1:
+                            log_line = buf[line_start:size]
+                            pos = size
+                        else:
+                            log_line = buf[line_start:line_end].rstrip()
+                            pos = line_end + 1
+
+                        yield log_line
+                finally:
+                    buf.close()
+        offset = 0
+
+READERS = {
+    'readline' : read_logs,
+    'mmap'     : map_logs,
+}
+
+def split_builds(lines, markers, collecting):
+    """
+    Splitter: turns log lines into (event, line) tuples.  Build starts are
+    always reported; build ends and output lines only while collecting.
+    Lines that cannot affect the sink are dropped.
+    """
+    build_start, build_end, output = markers
+    start_event = LogEvents.BUILD_START
+    end_event = LogEvents.BUILD_END
+    output_event = LogEvents.OUTPUT
+
+    for log_line in lines:
+        if build_start in log_line:
+            yield (start_event, log_line)
+        elif collecting():
+            if build_end in log_line:
+                yield (end_event, log_line)
+            elif output in log_line:
+                yield (output_event, log_line)
+
+def strip_prefix(events, working_prefix):
+    """
+    Prefix stripper: removes the TeamCity prefix from output lines, and
+    abbreviates the working folder (if any) to '...'.
+    """
+    output_event = LogEvents.OUTPUT
+    prefix_len = len(working_prefix) if working_prefix is not None else 0
+
+    for event, log_line in events:
+        if event == output_event:
+            log_line = log_line[log_line.index(OUTPUT_MARKER) + len(OUTPUT_MARKER):]
+
+            # only lower-case as much of the line as we need to compare
+            if prefix_len and (log_line[:prefix_len].lower() == working_prefix):
+                log_line = '...%s' % log_line[prefix_len:]
+
+        yield (event, log_line)
+
+def split_suffixes(events):
+    """
+    Suffix splitter: OS X warning lines can carry several warnings, each
+    terminated with a '[-W...]' flag.  Each is yielded as its own line.
+    """
+    output_event = LogEvents.OUTPUT
+
+    for event, log_line in events:
+        if (event != output_event) or ('[-W' not in log_line):
+            yield (event, log_line)
+            continue
+
+        while '[-W' in log_line:
+            ndx = log_line.index(' [-W')
+            yield (event, log_line[:ndx])
+            while log_line[ndx] != ']':
+                ndx += 1
+            log_line = log_line[ndx + 1:]
+
+def classify(events, classifier):
+    """
+    Classifier: output lines that the LineClassifier identifies as warnings
+    become (WARNING, (line, compression_key)) events.  The compression key
+    identifies the warning for counting purposes, and may be None.
+    """
+    output_event = LogEvents.OUTPUT
+    warning_event = LogEvents.WARNING
+    classify_line = classifier.classify
+
+    for event, log_line in events:
+        if event == output_event:
+            warning = classify_line(log_line)
+            if warning is not None:
+                yield (warning_event, warning)
+                continue
+
+        yield (event, log_line)
+
+def build_pipeline(config, classifier, log_manager, log, offset, markers, collecting):
+    """
+    Assembles the standard pipeline, ready to be drained by the sink.
+    """
+    lines = READERS[config.scan_engine](log_manager, log, offset, markers, collecting)
+    events = split_builds(lines, markers, collecting)
+    events = strip_prefix(events, config.working_prefix)
+    events = split_suffixes(events)
+    return classify(events, classifier)
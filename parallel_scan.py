@@ -0,0 +1,282 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import multiprocessing
+
+from itertools import izip
+
+from constants import LogEvents
+from build_index import BUILD_ID_REGEX, BUILD_NUMBER_REGEX
+from fragment_matcher import FragmentMatcher
+from line_classifier import LineClassifier
+from log_manager import open_log
+from log_pipeline import READAHEAD, build_pipeline, \
+                         split_builds, strip_prefix, split_suffixes, classify
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: parallel_scan.py                                               #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module spreads the reading of the TeamCity build logs     #
+#          across a pool of processes, for agents that keep more log      #
+#          than one core can get through in a build step.                 #
+#-------------------------------------------------------------------------#
+
+# The logs to be scanned are cut into chunks (at build markers, where the
+# build index knows of them, and otherwise at line boundaries), and each
+# worker runs the pipeline stages of log_pipeline.py over a chunk of its
+# own.  The DeltaGenerator only collects output from the first start of the
+# build being examined onwards, so a worker only classifies its chunk from
+# the first start of that build within it; before that, it only notes the
+# other builds' starts.  From there, a worker cannot know whether the
+# DeltaGenerator will still be collecting at any given point (e.g., the
+# step might fail), so it classifies all of the rest, and hands back every
+# event that could matter:
+#
+#    build starts, build ends, warnings, and output lines holding one of
+#    the failure fragments
+#
+# The chunks' events are then replayed in log order, applying the same
+# 'collecting' test the splitter would have, so the DeltaGenerator sees
+# exactly the events the serial pipeline gives it -- including those of a
+# build that continues across a log rotation, as the chunks of consecutive
+# logs simply follow each other.  Should the DeltaGenerator still be
+# collecting at the start of a chunk whose opening stretch went
+# unclassified (the build runs on into it), that stretch is scanned again
+# by the serial pipeline.  Where the build index shows that the build has
+# already started before a chunk, the worker classifies the whole chunk.
+
+CHUNKSIZE = 16 * 1024 * 1024
+
+# the settings each worker needs, set once by _start_worker()
+_WORKER = {}
+
+def _start_worker(teamcity, working_prefix, markers, fragments):
+    _WORKER['teamcity'] = teamcity
+    _WORKER['working_prefix'] = working_prefix
+    _WORKER['markers'] = markers
+    # (each worker builds its own matcher; see fragment_matcher.py)
+    _WORKER['fragments'] = FragmentMatcher(fragments) if len(fragments) else None
+
+def _always():
+    return True
+
+def read_range(file_name, start, end, buffer_size=READAHEAD):
+    """
+    Reader: yields the lines of 'file_name' from 'start' up to 'end' (or
+    the end of the file, if None), just as read_logs() would.  Both must
+    be at the start of a line.
+    """
+    with open_log(file_name, buffer_size) as log_file:
+        log_file.seek(start)
+        position = start
+        for log_line in log_file:
+            if (end is not None) and (position >= end):
+                break
+            position += len(log_line)
+            if log_line.endswith('\n'):
+                log_line = log_line.rstrip()
+            yield log_line
+
+def _is_build_start(log_line, teamcity):
+    # the same test the DeltaGenerator applies to a build start line
+    result = BUILD_ID_REGEX.search(log_line)
+    if not result:
+        return False
+    build_name = result.group(1)
+    if not build_name.startswith('%s::%s' % (teamcity.project_name, teamcity.config_name)):
+        return False
+    result = BUILD_NUMBER_REGEX.search(build_name)
+    return bool(result) and (int(result.group(2)) == teamcity.build_number)
+
+def _find_build(file_name, start, end, build_start, teamcity):
+    """
+    Returns the build start lines found in 'file_name' between 'start' and
+    'end' before the first start of the build being examined, and the
+    offset of that start (None, if it is not in the range).
+    """
+    starts = []
+    with open_log(file_name, READAHEAD) as log_file:
+        log_file.seek(start)
+        position = start
+        for log_line in log_file:
+            if (end is not None) and (position >= end):
+                break
+            if build_start in log_line:
+                start_line = log_line.rstrip() if log_line.endswith('\n') else log_line
+                if _is_build_start(start_line, teamcity):
+                    return (starts, position)
+                starts.append(start_line)
+            position += len(log_line)
+
+    return (starts, None)
+
+def _scan_chunk(chunk):
+    file_name, start, end, inherited = chunk
+
+    teamcity = _WORKER['teamcity']
+    markers = _WORKER['markers']
+    fragment_matcher = _WORKER['fragments']
+    output_event = LogEvents.OUTPUT
+
+    starts = []
+    build_offset = start
+    if not inherited:
+        starts, build_offset = _find_build(file_name, start, end, markers[0], teamcity)
+
+    kept = []
+    classifier = LineClassifier.create(teamcity)
+    if build_offset is not None:
+        events = split_builds(read_range(file_name, build_offset, end), markers, _always)
+        events = strip_prefix(events, _WORKER['working_prefix'])
+        events = split_suffixes(events)
+        events = classify(events, classifier)
+
+        for event, payload in events:
+            if event == output_event:
+                # an output line that is not a warning only matters to the
+                # failure fragment check
+                if (fragment_matcher is None) or not fragment_matcher.search(payload):
+                    continue
+            kept.append((event, payload))
+
+    return (starts, build_offset, kept, classifier.counts())
+
+def _chunk_end(file_name, target, size, build_offsets):
+    """
+    Where a chunk that should end near 'target' does end: at the first
+    build marker at or after it, or (if the index knows of none) at the
+    next line boundary.  None means the end of the log.
+    """
+    if target >= size:
+        return None
+
+    if build_offsets is not None:
+        for offset in build_offsets:
+            if offset >= target:
+                return offset if offset < size else None
+        return None
+
+    with open(file_name, 'rb') as log_file:
+        log_file.seek(target)
+        log_file.readline()
+        end = log_file.tell()
+    return end if end < size else None
+
+def plan_chunks(log_manager, log, offset, teamcity, build_index=None, chunk_size=CHUNKSIZE):
+    """
+    Cuts 'log' (from 'offset') and each newer log into (file name, start,
+    end, inherited) chunks of about 'chunk_size' bytes, oldest first.  The
+    last chunk of each log runs to whatever its end is when it is read.
+    'inherited' is set if the build index shows that the build being
+    examined starts before the chunk does.
+    """
+    project_config = '%s::%s' % (teamcity.project_name, teamcity.config_name)
+
+    chunks = []
+    started = False
+    for current_log in log_manager.get_chain(log):
+        build_offsets = None
+        starts = []
+        if build_index is not None:
+            build_offsets = build_index.build_offsets(current_log)
+            starts = build_index.build_offsets(current_log,
+                                               project_config,
+                                               teamcity.build_number) or []
+
+        if current_log.compressed:
+            # a compressed log can only be read from the top, so splitting
+            # it up would only have every worker decompress it again
+            chunks.append((current_log.file_name, offset, None, started))
+            if any(ndx >= offset for ndx in starts):
+                started = True
+            offset = 0
+            continue
+
+        try:
+            size = os.path.getsize(current_log.file_name)
+        except OSError:
+            size = 0
+
+        start = offset
+        while True:
+            end = _chunk_end(current_log.file_name, start + chunk_size, size, build_offsets)
+            chunks.append((current_log.file_name, start, end, started))
+            if any((ndx >= start) and ((end is None) or (ndx < end)) for ndx in starts):
+                started = True
+            if end is None:
+                break
+            start = end
+        offset = 0
+
+    return chunks
+
+def _scan_range(config, classifier, file_name, start, end, markers, collecting):
+    # the serial pipeline, over part of a single log
+    events = split_builds(read_range(file_name, start, end), markers, collecting)
+    events = strip_prefix(events, config.working_prefix)
+    events = split_suffixes(events)
+    return classify(events, classifier)
+
+def worker_count(config):
+    if config.scan_workers > 0:
+        return config.scan_workers
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def parallel_pipeline(config, classifier, log_manager, log, offset, markers, collecting,
+                      build_index=None, chunk_size=CHUNKSIZE):
+    """
+    The parallel counterpart of build_pipeline(): yields the same events,
+    in the same order, to be drained by the sink.  The work done by the
+    workers is added to the counts of 'classifier'.
+    """
+    chunks = plan_chunks(log_manager, log, offset, config.teamcity, build_index, chunk_size)
+    workers = min(worker_count(config), len(chunks))
+    if workers < 2:
+        # not enough log to be worth spreading around
+        for item in build_pipeline(config, classifier, log_manager, log, offset,
+                                   markers, collecting):
+            yield item
+        return
+
+    start_event = LogEvents.BUILD_START
+
+    pool = multiprocessing.Pool(workers,
+                                _start_worker,
+                                (config.teamcity,
+                                 config.working_prefix,
+                                 markers,
+                                 config.fail_on_fragment))
+    try:
+        for chunk, result in izip(chunks, pool.imap(_scan_chunk, chunks)):
+            file_name, start, end, inherited = chunk
+            starts, build_offset, events, counts = result
+            classifier.add_counts(counts)
+
+            unclassified_end = end if build_offset is None else build_offset
+            if (not inherited) and (unclassified_end != start) and collecting():
+                # the build runs on into this chunk, further than the
+                # worker could know; scan what it did not classify
+                for item in _scan_range(config, classifier, file_name, start,
+                                        unclassified_end, markers, collecting):
+                    yield item
+            else:
+                for log_line in starts:
+                    yield (start_event, log_line)
+
+            for event, payload in events:
+                # the splitter's test: build starts always get through,
+                # everything else only while collecting
+                if (event == start_event) or collecting():
+                    yield (event, payload)
+        pool.close()
+    finally:
+        # the sink may stop early, leaving chunks that are not needed
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,113 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import time
+
+from contextlib import contextmanager
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: phase_timer.py                                                 #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module keeps track of where the time of a step goes, and  #
+#          of how much work was done, and reports both to TeamCity as     #
+#          build statistics, to be charted from one build to the next.    #
+#-------------------------------------------------------------------------#
+
+# the phases, in the order they are reported
+PHASES = ['config',      # parsing the command line and builders_conf/
+          'logs',        # finding (and identifying) the TeamCity logs
+          'index',       # bringing the build index up to date
+          'scan',        # reading and classifying the logs
+          'normalize',   # normalizing warnings (WarningFormat)
+          'diff',        # comparing the build's warnings with the cache
+          'cacheRead',   # reading the cache
+          'cacheWrite',  # writing the cache
+          'transfer']    # talking to a remote (FTP or Dropbox) cache
+
+# the counters, and the keys they are reported under
+COUNTERS = [('lines',            'tcww.lines'),
+            ('evaluations',      'tcww.regexEvaluations'),
+            ('matches',          'tcww.warnings'),
+            ('bytesTransferred', 'tcww.bytesTransferred')]
+
+class PhaseTimer(object):
+    """
+    Accumulates the time spent in each phase of a step.  Phases nest, and
+    the time spent in an inner phase is not counted towards the one
+    around it, so the phases add up to the time accounted for; what is
+    left of the whole is reported as 'other'.
+    """
+    def __init__(self):
+        super(PhaseTimer, self).__init__()
+
+        self.started = time.time()
+        self.times = {}         # phase -> seconds
+        self.counters = {}      # counter -> count
+
+        # the phases currently entered, innermost last, each with the time
+        # from which it is being charged
+        self.stack = []
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def start(self, name):
+        now = time.time()
+        if len(self.stack):
+            self._charge(self.stack[-1], now)
+        self.stack.append([name, now])
+
+    def stop(self, name):
+        now = time.time()
+        # phases inside it that were left by an exception end along with it
+        while len(self.stack):
+            entry = self.stack.pop()
+            self._charge(entry, now)
+            if entry[0] == name:
+                break
+        if len(self.stack):
+            # the phase around it picks up from here
+            self.stack[-1][1] = now
+
+    def _charge(self, entry, now):
+        name, since = entry
+        self.times[name] = self.times.get(name, 0.0) + (now - since)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_counts(self, counts):
+        # the throughput counters of a LineClassifier
+        for name, value in counts.items():
+            self.count(name, value)
+
+    def statistics(self):
+        """
+        Returns the (key, value) pairs reported to TeamCity: times are in
+        milliseconds.
+        """
+        total = time.time() - self.started
+
+        result = []
+        for name in PHASES:
+            result.append(('tcww.time.%s' % name, int(self.times.get(name, 0.0) * 1000)))
+        accounted = sum(self.times.values())
+        result.append(('tcww.time.other', int(max(0.0, total - accounted) * 1000)))
+        result.append(('tcww.time.total', int(total * 1000)))
+
+        for name, key in COUNTERS:
+            result.append((key, self.counters.get(name, 0)))
+
+        return result
+
+    def report(self):
+        for key, value in self.statistics():
+            print "##teamcity[buildStatisticValue key='%s' value='%d']" % (key, value)
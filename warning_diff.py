@@ -0,0 +1,158 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import re
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: warning_diff.py                                                #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module houses the engines that compare the normalized     #
+#          warnings of two builds.                                        #
+#-------------------------------------------------------------------------#
+
+# Each engine is a function with the same signature:
+#
+#    engine(cached_keys, latest_keys, debug=False)
+#
+# where both key lists are sorted.  It returns a (removed, added) tuple of
+# lists: the positions within 'cached_keys' of the keys that no longer
+# appear (deflations), and the positions within 'latest_keys' of the keys
+# that are new (inflations).  Keys are compared as a multiset, so a key
+# that appears twice as often as it used to is an inflation.
+
+HUNK_REGEX = re.compile(
+    r'@@\s*([+,-])(\d+)(\s*,\s*(\d+))?(\s*([+,-])(\d+)(\s*,\s*(\d+))?)?\s*@@')
+
+def merge_diff(cached_keys, latest_keys, debug=False):
+    """
+    Walks both sorted lists once, side by side.  Equal keys pair off; a key
+    left over on either side is a deflation (cached) or inflation (latest).
+    Linear in the length of the lists.
+    """
+    removed = []
+    added = []
+
+    cached_len = len(cached_keys)
+    latest_len = len(latest_keys)
+    cached_ndx = 0
+    latest_ndx = 0
+    while (cached_ndx < cached_len) and (latest_ndx < latest_len):
+        cached_key = cached_keys[cached_ndx]
+        latest_key = latest_keys[latest_ndx]
+        if cached_key == latest_key:
+            cached_ndx += 1
+            latest_ndx += 1
+        elif cached_key < latest_key:
+            removed.append(cached_ndx)
+            cached_ndx += 1
+        else:
+            added.append(latest_ndx)
+            latest_ndx += 1
+
+    removed.extend(xrange(cached_ndx, cached_len))
+    added.extend(xrange(latest_ndx, latest_len))
+
+    return (removed, added)
+
+def difflib_diff(cached_keys, latest_keys, debug=False):
+    """
+    The original engine: generates a unified diff between the two lists,
+    and walks its hunks to recover the positions.  Kept as a reference
+    against which merge_diff() can be checked.
+    """
+    import difflib
+
+    unified = []
+    for line in difflib.unified_diff(cached_keys, \
+                                     latest_keys, \
+                                     fromfile="cached_list", \
+                                     tofile="latest_list"):
+        unified.append(line)
+
+    if debug:
+        open('unified.txt', 'w').write('\n'.join(unified))
+
+    # walk the unified diff and determine what messages are new,
+    # and what messages have gone away, if any
+
+    removed = []
+    added = []
+
+    before_line = 0
+    #before_count = 0
+    after_line = 0
+    #after_count = 0
+
+    for line in unified:
+        if line.startswith('--- '):
+            # 'before file' (i.e., cached list)
+            pass
+
+        elif line.startswith('+++ '):
+            # 'after file' (i.e., latest list)
+            pass
+
+        elif line.startswith('@@ '):
+            # hunk
+
+            #before_count = 0
+            #after_count = 0
+
+            result = HUNK_REGEX.search(line)
+
+            # the above expression will produce a 9-tuple value.
+            # some examples:
+            #      input: @@ -1 +1 @@
+            #     result: ('-', '1', None, None, ' +1', '+', '1', None, None)
+            #
+            #      input: @@ -1,4 +1,4 @@
+            #     result: ('-', '1', ',4', '4', ' +1,4', '+', '1', ',4', '4')
+            #
+            #      input: @@ -103,6 +103,8 @@
+            #     result: ('-', '103', ',6', '6', ' +103,8', '+', '103', ',8', '8')
+
+            before_line = int(result.group(2))
+            #if result.group(4) is not None:
+            #    before_count = int(result.group(4))
+
+            after_line = int(result.group(7))
+            #if result.group(9) is not None:
+            #    after_count = int(result.group(9))
+
+        else:
+            # we're processing a hunk
+            if line.startswith('-'):
+                # this is a warning that no longer exists in the 'before
+                # file' (deflation)
+                removed.append(before_line - 1)
+                before_line += 1
+
+            elif line.startswith('+'):
+                # this is a new warning in the 'after file' (inflation)
+                added.append(after_line - 1)
+                after_line += 1
+
+            else:
+                # this line is common to both lists
+                before_line += 1
+                after_line += 1
+
+    return (removed, added)
+
+def fingerprint_diff(cached_keys, latest_keys, debug=False):
+    """
+    Compares 64-bit fingerprints of the keys in NumPy arrays, rather than
+    the keys themselves (see warning_fingerprint.py, which is only loaded
+    when this engine is used).
+    """
+    from warning_fingerprint import fingerprint_diff as engine
+    return engine(cached_keys, latest_keys, debug)
+
+DIFF_ENGINES = {
+    'merge'       : merge_diff,
+    'difflib'     : difflib_diff,
+    'fingerprint' : fingerprint_diff,
+}
@@ -0,0 +1,154 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import sys
+import zlib
+
+NUMPY_AVAILABLE = True
+try:
+    import numpy
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: warning_fingerprint.py                                         #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module compares the warnings of two builds by 64-bit      #
+#          fingerprints held in NumPy arrays, rather than by the warnings #
+#          themselves.  It is only loaded if the 'fingerprint' diff       #
+#          engine is chosen, and needs NumPy.                             #
+#-------------------------------------------------------------------------#
+
+# The fingerprint of a string is Python's own hash of it where that is 64
+# bits wide (it is cached by the string, and the normalizer will usually
+# have computed it already).  Where it is only 32 bits wide (e.g., 64-bit
+# Windows), a CRC of the string makes up the other half.  Two different
+# warnings sharing a fingerprint would be taken for the same warning, but
+# with 64 bits, that is not a practical concern.
+WIDEHASH = sys.maxint > 0xffffffff
+
+def _narrow_fingerprint(key):
+    return ((hash(key) & 0xffffffff) << 32) | (zlib.crc32(key) & 0xffffffff)
+
+def fingerprints(keys):
+    """
+    Returns the fingerprints of 'keys' (any sequence of strings), in the
+    same order, as a NumPy array.
+    """
+    if WIDEHASH:
+        return numpy.fromiter(map(hash, keys), numpy.int64, len(keys))
+    return numpy.fromiter(map(_narrow_fingerprint, keys), numpy.uint64, len(keys))
+
+def _sorted_fingerprints(keys):
+    # the fingerprints in order, and where each came from.  (a stable sort
+    # keeps each run of equal fingerprints in its original order.)
+    prints = fingerprints(keys)
+    order = numpy.argsort(prints, kind='mergesort')
+    return (prints[order], order)
+
+def build_fingerprints(build, source):
+    """
+    Returns the sorted fingerprints of the build's normalized keys (if
+    'source' is 'keys') or of its warnings (if it is 'warnings'), and where
+    each came from.  They are kept with the build, so a build compared
+    again (e.g., the baseline the watcher daemon keeps) is only
+    fingerprinted once.
+    """
+    if (build.fingerprints is None) or (build.fingerprints[0] != source):
+        lines = build.key_names() if source == 'keys' else build.warnings
+        build.fingerprints = (source,) + _sorted_fingerprints(lines)
+    return build.fingerprints[1:]
+
+def _runs(ordered):
+    # where each run of equal fingerprints in 'ordered' starts
+    starts = numpy.empty(len(ordered), bool)
+    starts[:1] = True
+    numpy.not_equal(ordered[1:], ordered[:-1], starts[1:])
+    return starts
+
+def _unpaired(ordered, order, other):
+    """
+    Returns the positions (per 'order') of the fingerprints in 'ordered'
+    left over once each has been paired off with an equal one in 'other'
+    (a multiset difference).  As with merge_diff(), it is the last of a
+    run of equal fingerprints that go unpaired.  Both arrays are sorted.
+    """
+    if not len(ordered):
+        return []
+
+    # each fingerprint's place within its run
+    positions = numpy.arange(len(ordered))
+    starts = _runs(ordered)
+    ranks = positions - numpy.maximum.accumulate(numpy.where(starts, positions, 0))
+
+    # the number of its equals in the other build
+    equals = numpy.zeros(len(ordered), numpy.intp)
+    if len(other):
+        other_starts = numpy.flatnonzero(_runs(other))
+        other_values = other[other_starts]
+        other_counts = numpy.diff(numpy.append(other_starts, len(other)))
+
+        found = numpy.searchsorted(other_values, ordered)
+        found[found == len(other_values)] = 0
+        matched = other_values[found] == ordered
+        equals[matched] = other_counts[found[matched]]
+
+    return numpy.sort(order[ranks >= equals]).tolist()
+
+def _unmatched(ordered, order, other):
+    """
+    Returns the positions (per 'order') of the first of each fingerprint
+    in 'ordered' that does not appear in 'other' at all (a set
+    difference).  Both arrays are sorted.
+    """
+    if not len(ordered):
+        return []
+
+    starts = _runs(ordered)
+    missing = ~numpy.in1d(ordered[starts], other[_runs(other)], assume_unique=True)
+    return numpy.sort(order[starts][missing]).tolist()
+
+def _diff(cached, latest, debug):
+    # 'cached' and 'latest' are (sorted fingerprints, order) tuples
+    removed = _unpaired(cached[0], cached[1], latest[0])
+    added = _unpaired(latest[0], latest[1], cached[0])
+
+    if debug:
+        print 'Fingerprints: %d cached, %d latest; %d removed, %d added' % \
+            (len(cached[0]), len(latest[0]), len(removed), len(added))
+
+    return (removed, added)
+
+def fingerprint_diff(cached_keys, latest_keys, debug=False):
+    """
+    A diff engine (see warning_diff.py): returns the same positions as
+    merge_diff(), but compares the keys' fingerprints, all at once.
+    """
+    return _diff(_sorted_fingerprints(cached_keys),
+                 _sorted_fingerprints(latest_keys),
+                 debug)
+
+def diff_builds(cached_build, latest_build, debug=False):
+    """
+    The WarningFormat comparison: fingerprint_diff() of the two builds'
+    keys, with the fingerprints kept with each build.
+    """
+    return _diff(build_fingerprints(cached_build, 'keys'),
+                 build_fingerprints(latest_build, 'keys'),
+                 debug)
+
+def diff_build_warnings(cached_build, latest_build):
+    """
+    The WarningText/WarningRegex comparison, where each build's warnings
+    are taken as a set: returns a (removed, added) tuple of the positions
+    (within each build's warnings) of the first occurrences of the lines
+    that only appear in one of them, in order.
+    """
+    cached, cached_order = build_fingerprints(cached_build, 'warnings')
+    latest, latest_order = build_fingerprints(latest_build, 'warnings')
+
+    return (_unmatched(cached, cached_order, latest),
+            _unmatched(latest, latest_order, cached))
@@ -0,0 +1,90 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+from collections import OrderedDict
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: warning_normalizer.py                                          #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module reduces WarningFormat warning messages to their    #
+#          essence, so that warnings which merely moved (e.g., changed    #
+#          line numbers) still match from build to build.                 #
+#-------------------------------------------------------------------------#
+
+MEMOSIZE = 100000
+
+# anything following one of these probably doesn't add to the warning
+# detection: runs of spaces, tabs, continuation lines, and the explanatory
+# text that follows a comma
+TRUNCATIONS = ('  ', '\t', '\n', ',')
+
+class WarningNormalizer(object):
+    """
+    Sanitizes warnings against a compiled WarningFormat expression.  Most
+    warnings repeat exactly from build to build, so results are memoized
+    (least-recently-used entries are dropped once MEMOSIZE is reached).
+
+    VERSION must be bumped whenever the normalization rules change, since
+    normalized keys are persisted with the cached build.
+    """
+
+    VERSION = 1
+
+    def __init__(self, expression, memo_size=MEMOSIZE):
+        super(WarningNormalizer, self).__init__()
+
+        self.search = expression.search
+
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.hits = 0
+        self.misses = 0
+
+    def _sanitize(self, line):
+        # first, remove the 'warning' chunk from the string (which will
+        # include line numbers)
+        while True:
+            result = self.search(line)
+            if result is None:
+                break
+            line = line[:result.start(0)] + line[result.end(0):]
+
+        # next, cut the line at the first of whatever doesn't add to the
+        # warning detection
+        cut = len(line)
+        for truncation in TRUNCATIONS:
+            ndx = line.find(truncation, 0, cut)
+            if ndx != -1:
+                cut = ndx
+
+        return line[:cut]
+
+    def normalize(self, line):
+        try:
+            # re-inserting the entry marks it as the most recently used
+            key = self.memo.pop(line)
+        except KeyError:
+            self.misses += 1
+            key = self._sanitize(line)
+            if len(self.memo) >= self.memo_size:
+                self.memo.popitem(last=False)
+        else:
+            self.hits += 1
+
+        self.memo[line] = key
+        return key
+
+    def normalize_all(self, warnings):
+        """
+        Normalizes an entire BuildData.warnings list, returning a list of
+        (key, line_no) tuples in the original order.
+        """
+        normalize = self.normalize
+        return [(normalize(warning), line_no) for line_no, warning in enumerate(warnings)]
+
+    def report(self):
+        print 'Normalizer: %d memo hits, %d misses (%d entries memoized)' % \
+            (self.hits, self.misses, len(self.memo))
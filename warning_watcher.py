@@ -1,52 +1,100 @@
-# pylint: disable=missing-docstring
-# pylint: disable=bad-whitespace
-
-import sys
-
-from config import Config
-from delta_generator import DeltaGenerator
-from log_manager import LogManager
-
-#-------------------------------------------------------------------------#
-#     App: TeamCity9 Warning Watcher                                      #
-#  Module: warning_watcher.py                                             #
-#  Author: Bob Hood                                                       #
-#   PyVer: 2.7.x                                                          #
-# License: LGPL-3.0                                                       #
-#  Detail: This module implements the entry point for the TeamCity        #
-#          Warning Watcher.                                               #
-#                                                                         #
-# Example TC "Command Line" step script:                                  #
-#                                                                         #
-#     cd build_system/warning_watcher                                     #
-#     python warning_watcher.py \                                         #
-#        -b %system.build.number% \                                       #
-#        -p "%system.teamcity.projectName%" \                             #
-#        -a "%teamcity.agent.name%" \                                     #
-#        -c "%system.teamcity.buildConfName%" \                           #
-#        -B "%BranchName%" \                                              #
-#        --report-deflation \                                             #
-#        --inflations-are-errors                                          #
-#                                                                         #
-# Note that the first 5 arguments are required.                           #
-#                                                                         #
-# The TC step should IMMEDIATELY follow the build step that the Warning   #
-# Watcher should evaluate (see screen shots).                             #
-#-------------------------------------------------------------------------#
-
-def main():
-    # load in our configuration settings
-
-    config = Config()
-    if config.config_file is None:
-        print 'BuildAgent config file not found; skipping step.'
-        return
-
-    generator = DeltaGenerator(config, LogManager(config))
-    result = generator.run()
-    if result and len(generator.error_message):
-        print generator.error_message
-    return 0
-
-if __name__ == '__main__':
-    sys.exit(main())
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import sys
+
+from daemon_client import run_in_daemon, DaemonError
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: warning_watcher.py                                             #
+#  Author: Bob Hood                                                       #
+#   PyVer: 2.7.x                                                          #
+# License: LGPL-3.0                                                       #
+#  Detail: This module implements the entry point for the TeamCity        #
+#          Warning Watcher.                                               #
+#                                                                         #
+# Example TC "Command Line" step script:                                  #
+#                                                                         #
+#     cd build_system/warning_watcher                                     #
+#     python warning_watcher.py \                                         #
+#        -b %system.build.number% \                                       #
+#        -p "%system.teamcity.projectName%" \                             #
+#        -a "%teamcity.agent.name%" \                                     #
+#        -c "%system.teamcity.buildConfName%" \                           #
+#        -B "%BranchName%" \                                              #
+#        --report-deflation \                                             #
+#        --inflations-are-errors                                          #
+#                                                                         #
+# Note that the first 5 arguments are required.                           #
+#                                                                         #
+# The TC step should IMMEDIATELY follow the build step that the Warning   #
+# Watcher should evaluate (see screen shots).                             #
+#                                                                         #
+# If the watcher daemon (watcher_daemon.py) is running, the step is       #
+# handed to it, and this process only relays its answer.                  #
+#-------------------------------------------------------------------------#
+
+def run_step(config, log_manager, build_index=None, baselines=None):
+    """
+    Evaluates the build step described by 'config'.  This is shared with
+    the watcher daemon, which supplies its own long-lived state.
+    """
+    from delta_generator import DeltaGenerator
+
+    profiler = None
+    if config.profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    generator = DeltaGenerator(config, log_manager, build_index, baselines)
+    result = generator.run()
+    if result and len(generator.error_message):
+        print generator.error_message
+
+    if profiler is not None:
+        profiler.disable()
+        try:
+            profiler.dump_stats(config.profile_file)
+        except (IOError, OSError), error_object:
+            print 'Warning: Profile could not be written to "%s": %s' % \
+                (config.profile_file, str(error_object))
+
+    if config.report_statistics:
+        generator.report_statistics()
+    return 0
+
+def main():
+    argv = sys.argv[1:]
+    if '--no-daemon' not in argv:
+        try:
+            answer = run_in_daemon(argv)
+        except DaemonError, error_object:
+            # the step may already have been (partly) run, so it is not
+            # safe to run it again here
+            print 'Error: The watcher daemon did not answer: %s' % str(error_object)
+            return 1
+
+        if answer is not None:
+            result, output, errors = answer
+            sys.stdout.write(output)
+            sys.stderr.write(errors)
+            return result
+
+    # no daemon is running; do the work ourselves.  (these are only loaded
+    # now, so that a step the daemon answers does not pay for them.)
+    from config import Config
+    from log_manager import LogManager
+
+    # load in our configuration settings
+
+    config = Config()
+    if config.config_file is None:
+        print 'BuildAgent config file not found; skipping step.'
+        return
+
+    return run_step(config, LogManager(config))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+# pylint: disable=missing-docstring
+# pylint: disable=bad-whitespace
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import threading
+import traceback
+import SocketServer
+
+from optparse import OptionParser
+from cStringIO import StringIO
+
+from config import Config
+from build_index import BuildIndex
+from log_manager import LogManager
+from daemon_client import daemon_socket_path, user_folder, make_user_folder, \
+                          ENVIRONMENT
+from warning_watcher import run_step
+
+#-------------------------------------------------------------------------#
+#     App: TeamCity9 Warning Watcher                                      #
+#  Module: watcher_daemon.py                                              #
+#  Author: Bob Hood                                                       #
+# License: LGPL-3.0                                                       #
+#   PyVer: 2.7.x                                                          #
+#  Detail: This module implements a long-running Warning Watcher that     #
+#          follows the TeamCity build logs as they grow, and runs the     #
+#          steps handed to it by warning_watcher.py over a local socket.  #
+#                                                                         #
+# Start it on the Build Agent host (as the user the agent runs as) with:  #
+#                                                                         #
+#     cd build_system/warning_watcher                                     #
+#     python watcher_daemon.py                                            #
+#                                                                         #
+# and warning_watcher.py steps will be answered by it for as long as it   #
+# runs.  Without it, they do all of their own work, as they always have.  #
+#-------------------------------------------------------------------------#
+
+# how often (seconds) the logs of the agents seen so far are checked for
+# new builds
+POLLINTERVAL = 2.0
+
+# where the platform tells who is at the other end of a Unix domain socket
+# (Linux, where Python 2 does not name it), steps are only taken from the
+# user the daemon runs as; elsewhere, the permissions of the socket (and
+# of its folder) are relied upon
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17 if sys.platform.startswith('linux') else None)
+PEERCRED = struct.Struct('3i')     # pid, uid, gid
+
+def _exit_code(code):
+    # the result sys.exit(code) would have given the process
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print >> sys.stderr, code
+    return 1
+
+class _StepHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+
+        answer = self.server.watcher.run(request)
+        self.wfile.write('%s\n' % json.dumps(answer, encoding='latin-1'))
+
+class _StepServer(SocketServer.UnixStreamServer):
+    # steps are run one at a time (they share the daemon's state, and
+    # each one changes into its own working folder)
+    def __init__(self, socket_path, watcher):
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _StepHandler)
+        self.watcher = watcher
+
+    def server_bind(self):
+        # the socket is created for this user alone
+        umask = os.umask(077)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0600)
+
+    def verify_request(self, request, client_address):
+        if SO_PEERCRED is None:
+            return True
+
+        try:
+            _, uid, _ = PEERCRED.unpack(request.getsockopt(socket.SOL_SOCKET,
+                                                           SO_PEERCRED,
+                                                           PEERCRED.size))
+        except (socket.error, struct.error):
+            uid = None
+        if uid == os.getuid():
+            return True
+
+        print 'Warning: Refused a step from %s' % \
+            ('an unknown user' if uid is None else 'user %d' % uid)
+        sys.stdout.flush()
+        return False
+
+class WatcherDaemon(object):
+    """
+    Keeps, for every agent it has been asked about, the LogManager and
+    the BuildIndex of its logs, and brings them up to date every
+    'poll_interval' seconds; a step then finds its build without having
+    to read the logs itself.  The builds read from each cache file are
+    kept as well, and are reused for as long as the cache file is
+    unchanged.
+    """
+    def __init__(self, socket_path, poll_interval=POLLINTERVAL):
+        super(WatcherDaemon, self).__init__()
+
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+
+        # build agent log folder -> LogManager
+        self.log_managers = {}
+        # (build agent log folder, state folder, agent name) -> BuildIndex
+        self.build_indexes = {}
+        # cache file -> (version, build, journal) (see DeltaGenerator)
+        self.baselines = {}
+
+        # steps, and the following of the logs, take turns
+        self.lock = threading.Lock()
+        self.server = None
+
+    def serve(self):
+        folder = os.path.dirname(self.socket_path)
+        if folder == user_folder():
+            if not make_user_folder():
+                print 'Error: The socket folder "%s" must belong to this user alone' % folder
+                return 1
+
+        if os.path.exists(self.socket_path):
+            if os.lstat(self.socket_path).st_uid != os.getuid():
+                print 'Error: "%s" belongs to another user' % self.socket_path
+                return 1
+
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                print 'Error: A watcher daemon is already listening on "%s"' % \
+                    self.socket_path
+                return 1
+            except socket.error:
+                # left behind by a daemon that did not shut down cleanly
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+
+        try:
+            self.server = _StepServer(self.socket_path, self)
+        except socket.error, error_object:
+            print 'Error: Could not listen on "%s": %s' % (self.socket_path, str(error_object))
+            return 1
+
+        follower = threading.Thread(target=self._follow_logs)
+        follower.daemon = True
+        follower.start()
+
+        print 'Watcher daemon listening on "%s"' % self.socket_path
+        sys.stdout.flush()
+
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+        return 0
+
+    def run(self, request):
+        """
+        Runs a step on behalf of warning_watcher.py (see daemon_client.py
+        for the request and the answer), exactly as it would have run in
+        its own process.
+        """
+        argv = [arg.encode('latin-1') for arg in request.get('argv', [])]
+        cwd = request.get('cwd', os.getcwd()).encode('latin-1')
+        environment = dict([(name.encode('latin-1'), value.encode('latin-1')) \
+                            for name, value in request.get('environment', {}).items()])
+
+        output = StringIO()
+        errors = StringIO()
+
+        with self.lock:
+            saved_cwd = os.getcwd()
+            saved_environment = dict([(name, os.environ.get(name)) for name in ENVIRONMENT])
+            saved_stdout, saved_stderr = sys.stdout, sys.stderr
+
+            sys.stdout, sys.stderr = output, errors
+            try:
+                self._set_environment(environment)
+                os.chdir(cwd)
+                result = self._run_step(argv)
+            except SystemExit, exit_object:
+                result = _exit_code(exit_object.code)
+            except Exception:
+                traceback.print_exc()
+                result = 1
+            finally:
+                sys.stdout, sys.stderr = saved_stdout, saved_stderr
+                os.chdir(saved_cwd)
+                self._set_environment(saved_environment)
+
+        return {'result' : result,
+                'output' : output.getvalue().decode('latin-1'),
+                'errors' : errors.getvalue().decode('latin-1')}
+
+    def _run_step(self, argv):
+        config = Config(argv)
+        if config.config_file is None:
+            print 'BuildAgent config file not found; skipping step.'
+            return 0
+
+        log_manager = self._log_manager(config)
+        return run_step(config,
+                        log_manager,
+                        self._build_index(config, log_manager),
+                        self.baselines)
+
+    def _log_manager(self, config):
+        log_path = config.teamcity.build_agent_log_path
+        log_manager = self.log_managers.get(log_path)
+        if log_manager is None:
+            log_manager = LogManager(config)
+            self.log_managers[log_path] = log_manager
+        else:
+            log_manager.timer = config.timer
+            log_manager.refresh()
+        return log_manager
+
+    def _build_index(self, config, log_manager):
+        if not config.build_index:
+            return None
+
+        key = (config.teamcity.build_agent_log_path,
+               config.state_path,
+               config.teamcity.agent_name)
+        build_index = self.build_indexes.get(key)
+        if (build_index is None) or config.reset_cache:
+            build_index = BuildIndex(config, log_manager)
+            self.build_indexes[key] = build_index
+        return build_index
+
+    def _set_environment(self, environment):
+        for name in ENVIRONMENT:
+            if environment.get(name) is not None:
+                os.environ[name] = environment[name]
+            elif name in os.environ:
+                del os.environ[name]
+
+    def _follow_logs(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                for log_manager in self.log_managers.values():
+                    log_manager.refresh()
+                for build_index in self.build_indexes.values():
+                    try:
+                        build_index.update()
+                    except (IOError, OSError):
+                        # the logs are being rotated; try again next time
+                        pass
+                sys.stdout.flush()
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", "--socket", dest="socket_path", default=daemon_socket_path(),
+                      metavar="<path>",
+                      help="The socket to listen on (default \"%s\"; warning_watcher.py " \
+                           "looks for it there, or where WWDAEMONSOCKET says)." % \
+                           daemon_socket_path())
+    parser.add_option("-P", "--poll-interval", type="float", dest="poll_interval",
+                      default=POLLINTERVAL, metavar="<seconds>",
+                      help="How often the logs are checked for new builds " \
+                           "(default %g)." % POLLINTERVAL)
+
+    (options, _) = parser.parse_args()
+
+    if not hasattr(socket, 'AF_UNIX'):
+        print 'Error: The watcher daemon needs Unix domain sockets, which ' \
+              'this platform does not provide.'
+        return 1
+
+    return WatcherDaemon(options.socket_path, max(0.1, options.poll_interval)).serve()
+
+if __name__ == '__main__':
+    sys.exit(main())